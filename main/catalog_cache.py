@@ -0,0 +1,96 @@
+"""
+Versioned catalog cache
+
+Cached catalog data never expires on its own. Each entry is stored under a key
+derived from the current version numbers of the scopes it depends on, e.g.
+``categories``, ``products``, ``category:<id>`` or ``product:<slug>``. Saving
+or deleting a Product or Category bumps the affected versions (see
+main.signals), after which readers build fresh keys and the old entries simply
+age out of the cache backend.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'catalog:version:{}'
+HIT_KEY = 'catalog:stats:hits'
+MISS_KEY = 'catalog:stats:misses'
+
+
+def _initial_version() -> int:
+    # Time based, so a version key evicted from the cache never restarts at a
+    # number whose entries might still be cached
+    return time.time_ns() // 1000
+
+
+def get_versions(scopes):
+    """Return {scope: version} for scopes, initialising any missing ones"""
+    keys = {VERSION_KEY.format(scope): scope for scope in scopes}
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, scope in keys.items():
+        if key not in found:
+            cache.add(key, _initial_version(), None)
+            found[key] = cache.get(key)
+        versions[scope] = found[key]
+    return versions
+
+
+def bump(*scopes):
+    """Invalidate everything cached under scopes, once the transaction commits"""
+    transaction.on_commit(lambda: _bump_now(scopes))
+
+
+def _bump_now(scopes):
+    for scope in scopes:
+        key = VERSION_KEY.format(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), None)
+
+
+def make_key(name: str, scopes, *parts) -> str:
+    versions = get_versions(scopes)
+    raw = '|'.join([f'{scope}={versions[scope]}' for scope in sorted(versions)] + [str(part) for part in parts])
+    return f'catalog:{name}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def _count(key: str):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def get_or_build(name: str, scopes, build, *parts):
+    """Return the cached value for (name, parts), calling build() on a miss"""
+    key = make_key(name, scopes, *parts)
+    value = cache.get(key)
+    if value is not None:
+        _count(HIT_KEY)
+        return value
+    _count(MISS_KEY)
+    value = build()
+    cache.set(key, value, None)
+    return value
+
+
+def stats():
+    """Return the hit/miss counters and hit ratio since the last reset"""
+    counters = cache.get_many([HIT_KEY, MISS_KEY])
+    hits = counters.get(HIT_KEY, 0)
+    misses = counters.get(MISS_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / total, 4) if total else None,
+    }
+
+
+def reset_stats():
+    cache.delete_many([HIT_KEY, MISS_KEY])
@@ -0,0 +1,240 @@
+"""
+Stand-in payment gateway for offline load tests
+
+FakeGateway is a small asyncio HTTP server answering the calls this app makes
+to its payment providers:
+
+- M-Pesa Daraja: OAuth token, STK push and STK push query (point MpesaClient
+  at it with MPESA_BASE_URL)
+- Stripe: POST /v1/charges (STRIPE_API_BASE)
+- PayPal: OAuth token and POST /v1/payments/payment (PAYPAL_API_BASE)
+
+Every answer takes `latency` seconds plus up to `jitter`, and an `error_rate`
+share of calls is answered with a 503. Payments then settle by themselves:
+`callback_delay` seconds later the gateway posts the final callback, signed
+the way the receiving view checks it (X-Webhook-Signature HMACs with
+MPESA_WEBHOOK_SECRET or PAYPAL_WEBHOOK_SECRET, Stripe-Signature with
+STRIPE_WEBHOOK_SECRET), to the STK push CallBackURL or to the app's PayPal and
+Stripe webhook URLs. A `decline_rate` share of payments fails.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+from django.conf import settings
+
+
+def signature(secret, body: bytes) -> str:
+    """X-Webhook-Signature for body, as verify_webhook_signature computes it"""
+    return hmac.new((secret or '').encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+def stripe_signature(secret, body: bytes) -> str:
+    timestamp = int(time.time())
+    signed = hmac.new((secret or '').encode('utf-8'), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signed}'
+
+
+class FakeGateway:
+    def __init__(self, app_url='http://127.0.0.1:8000', latency=0.0, jitter=0.0, error_rate=0.0,
+                 decline_rate=0.0, callback_delay=1.0, callbacks=True):
+        self.app_url = app_url.rstrip('/')
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+        self.callback_delay = callback_delay
+        self.callbacks = callbacks
+        self.url = None
+        self.stk_pushes = {}
+        self.stats = Counter()
+        self.tasks = set()
+        self.client = None
+
+    async def start(self, host='127.0.0.1', port=9100):
+        self.url = f'http://{host}:{port}'
+        self.client = httpx.AsyncClient(timeout=30)
+        return await asyncio.start_server(self.handle, host, port, backlog=4096)
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if int(headers.get('content-length', 0)):
+                    body = await reader.readexactly(int(headers['content-length']))
+
+                method, target = request_line.decode('latin-1').split()[:2]
+                path = target.split('?', 1)[0]
+                await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+                if random.random() < self.error_rate:
+                    self.stats['injected errors'] += 1
+                    status, payload = 503, {'error': 'Service unavailable'}
+                else:
+                    status, payload = self.respond(method, path, headers, body)
+                self.stats[f'{method} {path} {status}'] += 1
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n'.encode()
+                    + f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, method, path, headers, body):
+        """(status, JSON payload) for one gateway API call"""
+        if path == '/oauth/v1/generate':
+            return 200, {'access_token': f'fake-{uuid.uuid4().hex}', 'expires_in': '3599'}
+        if path == '/mpesa/stkpush/v1/processrequest' and method == 'POST':
+            return self.stk_push(json.loads(body))
+        if path == '/mpesa/stkpushquery/v1/query' and method == 'POST':
+            return self.stk_query(json.loads(body))
+        if path == '/v1/oauth2/token' and method == 'POST':
+            return 200, {'access_token': f'fake-{uuid.uuid4().hex}', 'token_type': 'Bearer', 'expires_in': 32400}
+        if path == '/v1/payments/payment' and method == 'POST':
+            return self.paypal_payment(json.loads(body))
+        if path == '/v1/charges' and method == 'POST':
+            return self.stripe_charge(parse_qs(body.decode()))
+        return 404, {'error': f'No fake for {method} {path}'}
+
+    def stk_push(self, data):
+        checkout_request_id = f'ws_CO_{uuid.uuid4().hex[:20]}'
+        completed = random.random() >= self.decline_rate
+        self.stk_pushes[checkout_request_id] = (time.monotonic() + self.callback_delay, completed)
+        callback = {'Body': {'stkCallback': {
+            'MerchantRequestID': f'm-{checkout_request_id}',
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': 0 if completed else 1032,
+            'ResultDesc': (
+                'The service request is processed successfully.' if completed else 'Request cancelled by user'
+            ),
+        }}}
+        if completed:
+            callback['Body']['stkCallback']['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': data.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'PhoneNumber', 'Value': data.get('PhoneNumber')},
+            ]}
+        self.deliver(data.get('CallBackURL'), callback, 'signature', settings.MPESA_WEBHOOK_SECRET)
+        return 200, {
+            'MerchantRequestID': f'm-{checkout_request_id}',
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def stk_query(self, data):
+        push = self.stk_pushes.get(data.get('CheckoutRequestID'))
+        if push is None:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+        settles_at, completed = push
+        if time.monotonic() < settles_at:
+            return 500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}
+        return 200, {
+            'ResponseCode': '0',
+            'CheckoutRequestID': data['CheckoutRequestID'],
+            'ResultCode': '0' if completed else '1032',
+            'ResultDesc': (
+                'The service request is processed successfully.' if completed else 'Request cancelled by user'
+            ),
+        }
+
+    def paypal_payment(self, data):
+        payment_id = f'PAY-{uuid.uuid4().hex[:24].upper()}'
+        reference = data['transactions'][0].get('custom')
+        completed = random.random() >= self.decline_rate
+        # The fake customer approves (or is declined) after callback_delay
+        self.deliver(f'{self.app_url}/paypal/callback/', {
+            'id': f'WH-{uuid.uuid4().hex[:24].upper()}',
+            'event_type': 'PAYMENT.CAPTURE.COMPLETED' if completed else 'PAYMENT.CAPTURE.DENIED',
+            'resource': {'id': payment_id, 'custom_id': reference},
+        }, 'signature', settings.PAYPAL_WEBHOOK_SECRET)
+        return 201, {
+            'id': payment_id,
+            'intent': 'sale',
+            'state': 'created',
+            'transactions': data['transactions'],
+            'links': [
+                {'href': f'{self.url}/v1/payments/payment/{payment_id}', 'rel': 'self', 'method': 'GET'},
+                {
+                    'href': f'{self.url}/checkoutnow?token=EC-{payment_id[4:]}',
+                    'rel': 'approval_url',
+                    'method': 'REDIRECT',
+                },
+            ],
+        }
+
+    def stripe_charge(self, form):
+        charge_id = f'ch_{uuid.uuid4().hex[:24]}'
+        reference = form.get('metadata[reference]', [''])[0]
+        if random.random() < self.decline_rate:
+            return 402, {'error': {
+                'type': 'card_error', 'code': 'card_declined', 'charge': charge_id,
+                'message': 'Your card was declined.',
+            }}
+        charge = {
+            'id': charge_id,
+            'object': 'charge',
+            'amount': int(form.get('amount', ['0'])[0]),
+            'currency': form.get('currency', ['usd'])[0],
+            'paid': True,
+            'status': 'succeeded',
+            'metadata': {'reference': reference},
+        }
+        self.deliver(f'{self.app_url}/stripe/webhook/', {
+            'id': f'evt_{uuid.uuid4().hex[:24]}',
+            'object': 'event',
+            'type': 'payment_intent.succeeded',
+            'data': {'object': {'id': f'pi_{uuid.uuid4().hex[:24]}', 'object': 'payment_intent',
+                                'metadata': {'reference': reference}}},
+        }, 'stripe', settings.STRIPE_WEBHOOK_SECRET)
+        return 200, charge
+
+    def deliver(self, url, payload, scheme, secret):
+        if not self.callbacks or not url:
+            return
+        task = asyncio.get_running_loop().create_task(self._deliver(url, payload, scheme, secret))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _deliver(self, url, payload, scheme, secret):
+        await asyncio.sleep(self.callback_delay)
+        body = json.dumps(payload).encode()
+        if scheme == 'stripe':
+            headers = {'Stripe-Signature': stripe_signature(secret, body)}
+        else:
+            headers = {'X-Webhook-Signature': signature(secret, body)}
+        try:
+            response = await self.client.post(
+                url, content=body, headers={'Content-Type': 'application/json', **headers}
+            )
+            self.stats[f'callbacks {response.status_code}'] += 1
+        except httpx.HTTPError as e:
+            self.stats[f'callbacks {type(e).__name__}'] += 1
@@ -0,0 +1,186 @@
+"""
+Bounded calls into the Stripe and PayPal SDKs
+
+The SDKs block on the network, so views run them through call() instead of
+on the request thread:
+
+- Each gateway gets its own pool of GATEWAY_MAX_CONCURRENCY threads, guarded
+  by a semaphore of the same size (a bulkhead). A call that finds it full
+  fails at once with GatewayBusy instead of queueing, so a slow Stripe
+  cannot starve PayPal or the rest of the site of workers.
+- The caller waits at most GATEWAY_DEADLINES seconds, then gets
+  DeadlineExceeded and can answer the client. The SDK call carries on in its
+  thread, still holding its slot, and its outcome is handed to the on_late
+  callback when it arrives. Each SDK has its own network timeout
+  (STRIPE_NETWORK_TIMEOUT, and PAYPAL_NETWORK_TIMEOUT through PayPalApi), so
+  a hung call gives its slot back in bounded time.
+- Every call's latency is added to a per-gateway histogram kept in the cache
+  (see histograms() and the gateway_stats command).
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import paypalrestsdk
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+GATEWAYS = ('stripe', 'paypal')
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+OUTCOMES = ('ok', 'error', 'late', 'busy')
+STAT_KEY = 'gateways:{}:{}'
+
+
+class GatewayBusy(Exception):
+    """Raised without calling the gateway when all of its slots are taken"""
+
+
+class DeadlineExceeded(Exception):
+    """The gateway did not answer in time; the call's outcome goes to on_late"""
+
+
+class PayPalApi(paypalrestsdk.Api):
+    """paypalrestsdk.Api that passes a timeout to every HTTP request
+
+    The SDK itself calls requests without one.
+    """
+
+    def __init__(self, options=None, timeout=None, **kwargs):
+        super().__init__(options, **kwargs)
+        self.timeout = timeout
+
+    def http_call(self, url, method, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().http_call(url, method, **kwargs)
+
+
+def deadline(name: str) -> float:
+    return settings.GATEWAY_DEADLINES[name]
+
+
+class Bulkhead:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(size)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f'{name}-gateway')
+
+
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+
+
+def bulkhead(name: str) -> Bulkhead:
+    """The gateway's bulkhead in this process (a new one after fork)"""
+    key = (os.getpid(), name)
+    with _bulkheads_lock:
+        if key not in _bulkheads:
+            _bulkheads[key] = Bulkhead(name, settings.GATEWAY_MAX_CONCURRENCY[name])
+        return _bulkheads[key]
+
+
+def _incr(key: str, delta: int = 1):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key, delta)
+
+
+def _observe(name: str, seconds: float, outcome: str):
+    ms = seconds * 1000
+    bucket = next((f'le_{le}' for le in LATENCY_BUCKETS_MS if ms <= le), 'le_inf')
+    _incr(STAT_KEY.format(name, bucket))
+    _incr(STAT_KEY.format(name, 'sum_ms'), int(ms))
+    _incr(STAT_KEY.format(name, outcome))
+
+
+class _Call:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = False
+        self.abandoned = False
+
+
+def call(name: str, fn, *args, on_late=None, **kwargs):
+    """Run fn(*args, **kwargs) in the gateway's bulkhead, waiting up to its deadline
+
+    Returns fn's result or raises its exception, GatewayBusy, or
+    DeadlineExceeded; in the last case on_late(result, error) is called from
+    the gateway's thread once fn finishes.
+    """
+    pool = bulkhead(name)
+    if not pool.slots.acquire(blocking=False):
+        _incr(STAT_KEY.format(name, 'busy'))
+        raise GatewayBusy(f"All {name} slots are busy")
+    state = _Call()
+
+    def run():
+        started = time.perf_counter()
+        result = error = None
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            error = e
+        finally:
+            pool.slots.release()
+        with state.lock:
+            state.done = True
+            late = state.abandoned
+        _observe(name, time.perf_counter() - started, 'error' if error else 'ok')
+        if late:
+            try:
+                if on_late is not None:
+                    on_late(result, error)
+            except Exception:
+                logger.exception(f"Handling a late {name} result failed")
+            finally:
+                close_old_connections()
+            return None
+        if error is not None:
+            raise error
+        return result
+
+    future = pool.executor.submit(run)
+    try:
+        return future.result(timeout=deadline(name))
+    except FutureTimeout:
+        with state.lock:
+            if not state.done:
+                state.abandoned = True
+                _incr(STAT_KEY.format(name, 'late'))
+                raise DeadlineExceeded(f"{name} did not answer within {deadline(name)}s")
+        # Finished just as the deadline passed
+        return future.result()
+
+
+def histograms() -> dict:
+    """Per gateway: cumulative latency buckets, call count, mean latency and outcome counts"""
+    labels = [f'le_{le}' for le in LATENCY_BUCKETS_MS] + ['le_inf']
+    keys = [STAT_KEY.format(name, label) for name in GATEWAYS for label in labels + ['sum_ms', *OUTCOMES]]
+    values = cache.get_many(keys)
+    result = {}
+    for name in GATEWAYS:
+        counts = [values.get(STAT_KEY.format(name, label), 0) for label in labels]
+        total = sum(counts)
+        cumulative = 0
+        buckets = []
+        for label, count in zip(labels, counts):
+            cumulative += count
+            buckets.append((label[3:], cumulative))
+        result[name] = {
+            'buckets': buckets,
+            'count': total,
+            'mean_ms': values.get(STAT_KEY.format(name, 'sum_ms'), 0) / total if total else None,
+            'outcomes': {outcome: values.get(STAT_KEY.format(name, outcome), 0) for outcome in OUTCOMES},
+        }
+    return result
+
+
+def reset_histograms():
+    labels = [f'le_{le}' for le in LATENCY_BUCKETS_MS] + ['le_inf', 'sum_ms', *OUTCOMES]
+    cache.delete_many([STAT_KEY.format(name, label) for name in GATEWAYS for label in labels])
@@ -0,0 +1,225 @@
+"""
+Idempotency-Key support
+
+Clients on unreliable networks retry POSTs they never saw a response to. A
+view wrapped in @idempotent stores the response to the first request carrying
+a given ``Idempotency-Key`` header and replays it for every retry, so a retry
+creates no rows and makes no gateway calls. Stored responses live in the
+cache for fast replays and in IdempotencyKey rows so they survive cache
+eviction; both are kept for IDEMPOTENCY_KEY_TTL seconds.
+
+While the first request is still running, a short-lived cache lock makes
+concurrent retries get 409 instead of starting a second payment. Reusing a
+key with a different request body is rejected with 422. Successful (2xx) and
+redirect (3xx) responses, validation errors that the same body would always
+get again (STORED_CLIENT_ERRORS), and responses a view marks with
+always_store() are stored. Anything else, such as a 429 from a throttle or a
+5xx, may be retried with the same key. Views mark failures that come after a
+gateway call whose outcome is unknown, so a retry replays them instead of
+charging or prompting the customer again.
+"""
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+CACHE_KEY = 'idempotency:{}'
+LOCK_KEY = 'idempotency:lock:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Rejections that depend only on the request body, not on timing or state
+STORED_CLIENT_ERRORS = (400, 422)
+
+
+def key_ttl() -> int:
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', 60 * 60 * 24)
+
+
+def lock_timeout() -> int:
+    return getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 60)
+
+
+def request_owner(request) -> str:
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    if not request.session.session_key:
+        request.session.save()
+    return f'session:{request.session.session_key}'
+
+
+def request_hash(request) -> str:
+    return hashlib.sha256(b'\n'.join([request.method.encode(), request.path.encode(), request.body])).hexdigest()
+
+
+def stored_response(owner, scope, key):
+    """The stored {hash, status, content_type, location, body} for a key, or None"""
+    cache_key = CACHE_KEY.format(hashlib.sha256(f'{owner}|{scope}|{key}'.encode()).hexdigest())
+    stored = cache.get(cache_key)
+    if stored is None:
+        row = (
+            IdempotencyKey.objects
+            .filter(owner=owner, scope=scope, key=key, created_at__gt=timezone.now() - timedelta(seconds=key_ttl()))
+            .first()
+        )
+        if row is not None:
+            stored = {
+                'hash': row.request_hash,
+                'status': row.status_code,
+                'content_type': row.content_type,
+                'location': row.location,
+                'body': bytes(row.body),
+            }
+            cache.set(cache_key, stored, key_ttl())
+    return cache_key, stored
+
+
+def always_store(response):
+    """Have @idempotent store response for replay, whatever its status"""
+    response.idempotent_always_store = True
+    return response
+
+
+def replayable(response) -> bool:
+    return (
+        200 <= response.status_code < 400
+        or response.status_code in STORED_CLIENT_ERRORS
+        or getattr(response, 'idempotent_always_store', False)
+    )
+
+
+def replay(stored):
+    response = HttpResponse(stored['body'], status=stored['status'], content_type=stored['content_type'])
+    if stored['location']:
+        response['Location'] = stored['location']
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def store(owner, scope, key, fingerprint, response):
+    stored = {
+        'hash': fingerprint,
+        'status': response.status_code,
+        'content_type': response.get('Content-Type', 'application/octet-stream'),
+        'location': response.get('Location', ''),
+        'body': response.content,
+    }
+    try:
+        with transaction.atomic():
+            # Replace a row left over from an expired use of the same key
+            IdempotencyKey.objects.filter(owner=owner, scope=scope, key=key).delete()
+            IdempotencyKey.objects.create(
+                owner=owner,
+                scope=scope,
+                key=key,
+                request_hash=fingerprint,
+                status_code=stored['status'],
+                content_type=stored['content_type'],
+                location=stored['location'],
+                body=stored['body'],
+            )
+    except IntegrityError:
+        pass
+    return stored
+
+
+def begin(request, scope, key):
+    """Return (response, None) to answer without running the view, or (None, state)"""
+    if len(key) > MAX_KEY_LENGTH:
+        return JsonResponse({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}, status=400), None
+
+    owner = request_owner(request)
+    fingerprint = request_hash(request)
+    cache_key, stored = stored_response(owner, scope, key)
+    if stored is not None:
+        if stored['hash'] != fingerprint:
+            return JsonResponse({'error': f'{HEADER} was already used for a different request'}, status=422), None
+        return replay(stored), None
+
+    lock_key = LOCK_KEY.format(cache_key)
+    if not cache.add(lock_key, 1, lock_timeout()):
+        return JsonResponse({'error': 'A request with this Idempotency-Key is still being processed'}, status=409), None
+    return None, {'owner': owner, 'scope': scope, 'key': key, 'hash': fingerprint,
+                  'cache_key': cache_key, 'lock_key': lock_key}
+
+
+def finish(state, response):
+    """Store the view's response for replays and release the lock"""
+    if not replayable(response) or response.streaming or not getattr(response, 'is_rendered', True):
+        cache.delete(state['lock_key'])
+        return response
+    stored = store(state['owner'], state['scope'], state['key'], state['hash'], response)
+
+    def publish():
+        cache.set(state['cache_key'], stored, key_ttl())
+        cache.delete(state['lock_key'])
+
+    # With ATOMIC_REQUESTS the row (and the view's writes) commit after we
+    # return; retries keep getting 409 until then. If the request rolls
+    # back the lock simply times out.
+    transaction.on_commit(publish)
+    return response
+
+
+def idempotent(view):
+    """Replay the stored response for a repeated Idempotency-Key
+
+    Requests without the header, and safe methods, run the view as usual. For
+    DRF views apply it below @api_view, so request.user is the API user.
+    Works on async views too.
+    """
+    scope = f'{view.__module__}.{view.__name__}'
+
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key or request.method in SAFE_METHODS:
+                return await view(request, *args, **kwargs)
+            response, state = await sync_to_async(begin)(request, scope, key)
+            if response is not None:
+                return response
+            try:
+                response = await view(request, *args, **kwargs)
+            except Exception:
+                await cache.adelete(state['lock_key'])
+                raise
+            return await sync_to_async(finish)(state, response)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or request.method in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+        response, state = begin(request, scope, key)
+        if response is not None:
+            return response
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            cache.delete(state['lock_key'])
+            raise
+        return finish(state, response)
+
+    return wrapper
+
+
+def purge_expired(batch_size=1000, now=None) -> int:
+    """Delete stored responses older than IDEMPOTENCY_KEY_TTL; returns how many"""
+    cutoff = (now or timezone.now()) - timedelta(seconds=key_ttl())
+    purged = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(created_at__lte=cutoff).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return purged
+        purged += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
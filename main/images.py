@@ -0,0 +1,104 @@
+"""
+Responsive image derivatives
+
+Product and Category images are resized to a fixed set of widths in WebP and
+JPEG. Derivative names contain a hash of the source file's bytes
+(``derivatives/<hash>/<width>w.<ext>``), so a given URL never changes content
+and can be cached forever by a CDN; replacing the image produces new names.
+
+What was generated is recorded in the model's ``image_variants`` field, which
+the ``responsive_image`` template tag reads without touching storage.
+"""
+import hashlib
+import io
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+
+def derivative_widths():
+    return sorted(getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', (320, 640, 960, 1280)))
+
+
+def needs_derivatives(instance) -> bool:
+    """True when instance has an image whose derivatives are missing or outdated"""
+    if not instance.image:
+        return False
+    return (instance.image_variants or {}).get('source') != instance.image.name
+
+
+def _encode(image, fmt: str) -> bytes:
+    options = dict(FORMATS[fmt])
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, options.pop('format'), **options)
+    return buffer.getvalue()
+
+
+def build_variants(name: str, storage=default_storage) -> dict:
+    """Generate the derivatives of the stored image name and return its manifest"""
+    with storage.open(name, 'rb') as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+
+    with Image.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            has_alpha = 'A' in original.getbands() or 'transparency' in original.info
+            original = original.convert('RGBA' if has_alpha else 'RGB')
+        source_width, source_height = original.size
+
+        # Never upscale; an image narrower than the largest width also gets a
+        # re-encoded derivative at its own size
+        widths = [width for width in derivative_widths() if width < source_width]
+        if source_width <= derivative_widths()[-1]:
+            widths.append(source_width)
+        manifest = {
+            'source': name,
+            'hash': digest,
+            'width': source_width,
+            'height': source_height,
+            'widths': widths,
+        }
+        for fmt in FORMATS:
+            manifest[fmt] = {}
+            for width in widths:
+                path = f'derivatives/{digest}/{width}w.{fmt}'
+                # Content addressed: an existing file already has the right bytes
+                if not storage.exists(path):
+                    height = round(source_height * width / source_width)
+                    resized = original.resize((width, height), Image.LANCZOS)
+                    storage.save(path, ContentFile(_encode(resized, fmt)))
+                manifest[fmt][str(width)] = path
+    return manifest
+
+
+def update_variants(instance):
+    """Regenerate derivatives for a saved Product or Category if its image changed"""
+    if not needs_derivatives(instance):
+        return
+    try:
+        manifest = build_variants(instance.image.name, instance.image.storage)
+    except Exception as e:
+        logger.error(f"Could not generate image derivatives for {instance._meta.label} {instance.pk}: {str(e)}")
+        return
+    instance.image_variants = manifest
+    # update() rather than save() so post_save does not fire again
+    type(instance).objects.filter(pk=instance.pk).update(image_variants=manifest)
+
+
+def srcset(manifest: dict, fmt: str, storage=default_storage) -> str:
+    return ', '.join(f'{storage.url(path)} {width}w' for width, path in manifest.get(fmt, {}).items())
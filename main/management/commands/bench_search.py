@@ -0,0 +1,79 @@
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import search
+from main.models import Category, Product
+
+SYLLABLES = ('ka', 'ro', 'mi', 'zu', 'te', 'lo', 'pa', 'ni', 'sha', 'vo', 'de', 'qui', 'bra', 'fen', 'gor', 'hul')
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare the full-text product search index with the icontains search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=50000, help='Synthetic products to generate')
+        parser.add_argument('--queries', type=int, default=200, help='Queries to time per search path')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = sorted({
+            ''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(5000)
+        })
+        limit = getattr(settings, 'PRODUCT_SEARCH_LIMIT', 500)
+        try:
+            with transaction.atomic():
+                self.populate(rng, vocabulary, options['products'])
+                queries = [rng.choice(vocabulary) for _ in range(options['queries'])]
+                base = Product.objects.filter(available=True)
+
+                indexed = self.time_queries(lambda q: search.search_products(base, q), queries)
+                scanned = self.time_queries(lambda q: list(search.icontains_search(base, q)[:limit]), queries)
+
+                self.report(f"index ({search.search_backend()})", indexed)
+                self.report('icontains', scanned)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def populate(self, rng, vocabulary, count):
+        category = Category.objects.create(name='Benchmark', slug='bench-search-category')
+        products = []
+        for i in range(count):
+            name = ' '.join(rng.choices(vocabulary, k=3))
+            products.append(Product(
+                category=category,
+                name=name,
+                slug=f'bench-search-{i}',
+                description=' '.join(rng.choices(vocabulary, k=30)),
+                price=rng.randint(100, 100000) / 100,
+                image='products/placeholder.png',
+            ))
+        Product.objects.bulk_create(products, batch_size=2000)
+        search.rebuild_index()
+        self.stdout.write(f"Generated {count} products")
+
+    def time_queries(self, run, queries):
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            run(query)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f"{label:>18}: mean {statistics.mean(timings):7.2f} ms  "
+            f"median {statistics.median(timings):7.2f} ms  p95 {p95:7.2f} ms"
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main import catalog_cache
+
+
+class Command(BaseCommand):
+    help = 'Show the catalog cache hit and miss counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = catalog_cache.stats()
+        ratio = 'n/a' if stats['hit_ratio'] is None else f"{stats['hit_ratio']:.2%}"
+        self.stdout.write(f"hits: {stats['hits']}  misses: {stats['misses']}  hit ratio: {ratio}")
+        if options['reset']:
+            catalog_cache.reset_stats()
+            self.stdout.write('Counters reset')
@@ -0,0 +1,131 @@
+import heapq
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import combinations, groupby
+from operator import itemgetter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from main import catalog_cache
+from main.models import AssociationRun, OrderItem, ProductAssociation
+
+CHUNK = 1000
+
+
+class Command(BaseCommand):
+    help = 'Compute "frequently bought together" products from order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=8, help='Neighbours kept per product')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Orders counted per batch')
+        parser.add_argument('--max-basket', type=int, default=50,
+                            help='Skip orders with more distinct products than this (bulk buys add noise)')
+        parser.add_argument('--settle-minutes', type=int, default=10,
+                            help='Ignore orders younger than this, so in-flight checkouts are not skipped')
+        parser.add_argument('--full', action='store_true', help='Discard stored results and rebuild from scratch')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        full = options['full']
+        previous = None if full else AssociationRun.objects.filter(finished_at__isnull=False).first()
+        if previous is None:
+            full = True
+        run = AssociationRun.objects.create(
+            last_order_id=previous.last_order_id if previous else 0,
+            full_rebuild=full,
+        )
+
+        counts, last_order_id, orders = self.count_pairs(
+            run.last_order_id, options['batch_size'], options['max_basket'],
+            timezone.now() - timedelta(minutes=options['settle_minutes']),
+        )
+        if not full:
+            self.merge_existing(counts)
+
+        updated = self.store(counts, options['top'], full)
+
+        run.last_order_id = last_order_id
+        run.orders_processed = orders
+        run.products_updated = updated
+        run.finished_at = timezone.now()
+        run.save()
+        catalog_cache.bump('related')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Full' if full else 'Incremental'} run: {orders} orders, {updated} products updated "
+            f"in {elapsed:.1f}s (up to order {last_order_id})"
+        ))
+
+    def count_pairs(self, after_order_id, batch_size, max_basket, cutoff):
+        """Stream order lines and count co-purchased pairs, batch by batch
+
+        Each batch of baskets is counted with a single Counter.update over all
+        of its pairs (the counting loop runs in C) and then folded into the
+        per-product totals.
+        """
+        items = (
+            OrderItem.objects
+            .filter(order_id__gt=after_order_id, order__created__lt=cutoff)
+            .exclude(order__status='cancelled')
+            .order_by('order_id')
+            .values_list('order_id', 'product_id')
+            .iterator(chunk_size=batch_size)
+        )
+        counts = defaultdict(Counter)
+        batch = Counter()
+        last_order_id = after_order_id
+        orders = 0
+
+        def flush():
+            for (a, b), n in batch.items():
+                counts[a][b] += n
+                counts[b][a] += n
+            batch.clear()
+
+        for order_id, lines in groupby(items, key=itemgetter(0)):
+            basket = sorted({product_id for _, product_id in lines})
+            last_order_id = order_id
+            orders += 1
+            if 1 < len(basket) <= max_basket:
+                batch.update(combinations(basket, 2))
+            if orders % batch_size == 0:
+                flush()
+        flush()
+        return counts, last_order_id, orders
+
+    def merge_existing(self, counts):
+        """Add the stored scores of every product touched by this run
+
+        Only the top neighbours are stored, so a pair that fell out of the top
+        in an earlier run starts again from zero; --full recounts exactly.
+        """
+        product_ids = list(counts)
+        for start in range(0, len(product_ids), CHUNK):
+            rows = ProductAssociation.objects.filter(
+                product_id__in=product_ids[start:start + CHUNK]
+            ).values_list('product_id', 'related_id', 'score')
+            for product_id, related_id, score in rows:
+                counts[product_id][related_id] += score
+
+    def store(self, counts, top, full):
+        rows = []
+        for product_id, neighbours in counts.items():
+            best = heapq.nlargest(top, neighbours.items(), key=lambda item: (item[1], -item[0]))
+            rows.extend(
+                ProductAssociation(product_id=product_id, related_id=related_id, score=score)
+                for related_id, score in best
+            )
+
+        product_ids = list(counts)
+        with transaction.atomic():
+            if full:
+                ProductAssociation.objects.all().delete()
+            else:
+                for start in range(0, len(product_ids), CHUNK):
+                    ProductAssociation.objects.filter(product_id__in=product_ids[start:start + CHUNK]).delete()
+            ProductAssociation.objects.bulk_create(rows, batch_size=CHUNK)
+        return len(product_ids)
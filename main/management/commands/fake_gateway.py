@@ -0,0 +1,61 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.fake_gateway import FakeGateway
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a local stand-in for the M-Pesa, Stripe and PayPal APIs, with signed callbacks. '
+        'Point the app at it with MPESA_BASE_URL, STRIPE_API_BASE and PAYPAL_API_BASE '
+        '(all http://HOST:PORT) and any STRIPE_SECRET_KEY.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9100)
+        parser.add_argument('--app-url', default='http://127.0.0.1:8000',
+                            help='Where to send PayPal and Stripe webhooks (M-Pesa uses the STK push CallBackURL)')
+        parser.add_argument('--latency', type=float, default=0.2, help='Seconds before each answer')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds per answer')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered with a 503')
+        parser.add_argument('--decline-rate', type=float, default=0.0, help='Share of payments that fail')
+        parser.add_argument('--callback-delay', type=float, default=1.0,
+                            help='Seconds between a payment request and its callback')
+        parser.add_argument('--no-callbacks', action='store_true')
+        parser.add_argument('--duration', type=float, default=0,
+                            help='Stop after this many seconds (default: run until interrupted)')
+
+    def handle(self, *args, **options):
+        for name in ('MPESA_WEBHOOK_SECRET', 'PAYPAL_WEBHOOK_SECRET', 'STRIPE_WEBHOOK_SECRET'):
+            if not getattr(settings, name, None):
+                self.stderr.write(f"{name} is not set; the app will reject callbacks signed without it")
+        gateway = FakeGateway(
+            app_url=options['app_url'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            decline_rate=options['decline_rate'],
+            callback_delay=options['callback_delay'],
+            callbacks=not options['no_callbacks'],
+        )
+        try:
+            asyncio.run(self.serve(gateway, options))
+        except KeyboardInterrupt:
+            pass
+        for key, count in sorted(gateway.stats.items()):
+            self.stdout.write(f"{count:>8}  {key}")
+
+    async def serve(self, gateway, options):
+        server = await gateway.start(options['host'], options['port'])
+        self.stdout.write(f"Fake gateway on {gateway.url}, {options['latency']}s latency")
+        try:
+            if options['duration']:
+                await asyncio.sleep(options['duration'])
+            else:
+                await server.serve_forever()
+        finally:
+            server.close()
+            await gateway.close()
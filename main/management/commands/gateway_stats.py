@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from main import gateways
+
+
+class Command(BaseCommand):
+    help = (
+        'Show Stripe and PayPal call latency histograms and outcomes '
+        '(late: answered after the request gave up; busy: refused by the bulkhead)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        for name, stats in gateways.histograms().items():
+            mean = f"{stats['mean_ms']:.0f}ms" if stats['mean_ms'] is not None else '-'
+            outcomes = '  '.join(f"{outcome}: {count}" for outcome, count in stats['outcomes'].items())
+            self.stdout.write(f"{name}: {stats['count']} calls, mean {mean}  {outcomes}")
+            for le, cumulative in stats['buckets']:
+                label = f"<= {le}ms" if le != 'inf' else 'all'
+                self.stdout.write(f"  {label:>10} {cumulative}")
+        if options['reset']:
+            gateways.reset_histograms()
+            self.stdout.write('Counters reset')
@@ -0,0 +1,93 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main import catalog_cache, images
+
+MODELS = {'product': 'main.Product', 'category': 'main.Category'}
+UPDATE_BATCH = 200
+
+
+def _init_worker():
+    # Needed under the spawn start method; a no-op for forked workers
+    if not apps.ready:
+        django.setup()
+
+
+def _build(task):
+    label, pk, name = task
+    try:
+        return label, pk, images.build_variants(name), None
+    except Exception as e:
+        return label, pk, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Generate responsive WebP/JPEG derivatives for product and category images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(MODELS), action='append',
+                            help='Limit to one model (repeatable); defaults to all')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+        parser.add_argument('--force', action='store_true', help='Regenerate even if derivatives are up to date')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        tasks = []
+        for key in options['model'] or sorted(MODELS):
+            model = apps.get_model(MODELS[key])
+            rows = model.objects.exclude(image='').only('pk', 'image', 'image_variants').iterator()
+            tasks.extend(
+                (MODELS[key], obj.pk, obj.image.name)
+                for obj in rows if options['force'] or images.needs_derivatives(obj)
+            )
+        if not tasks:
+            self.stdout.write('All derivatives are up to date')
+            return
+
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+
+        pending = {label: [] for label in MODELS.values()}
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+            for label, pk, manifest, error in pool.map(_build, tasks, chunksize=4):
+                if error:
+                    failed += 1
+                    self.stderr.write(f"{label} {pk}: {error}")
+                    continue
+                pending[label].append((pk, manifest))
+                done += 1
+                if len(pending[label]) >= UPDATE_BATCH:
+                    self.save(label, pending[label])
+        for label, rows in pending.items():
+            self.save(label, rows)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated derivatives for {done} images ({failed} failed) in {elapsed:.1f}s"
+        ))
+
+    def save(self, label, rows):
+        if not rows:
+            return
+        model = apps.get_model(label)
+        objs = [model(pk=pk, image_variants=manifest) for pk, manifest in rows]
+        model.objects.bulk_update(objs, ['image_variants'], batch_size=UPDATE_BATCH)
+        # bulk_update skips the signals that invalidate cached pages showing these images
+        pks = [pk for pk, _ in rows]
+        if label == MODELS['product']:
+            placements = list(model.objects.filter(pk__in=pks).values_list('category_id', 'slug'))
+            catalog_cache.bump(
+                'products',
+                *{f'category:{category_id}' for category_id, _ in placements},
+                *[f'product:{slug}' for _, slug in placements],
+            )
+        else:
+            catalog_cache.bump('categories', *[f'category:{pk}' for pk in pks])
+        rows.clear()
@@ -0,0 +1,308 @@
+import csv
+import json
+import os
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from django.utils.text import slugify
+
+from main import catalog_cache, search
+from main.models import Cart, Category, InventoryMovement, Product
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+UPDATE_FIELDS = ['category', 'name', 'updated_at']
+# Columns an input may leave out; existing products then keep their values,
+# new ones get these defaults
+OPTIONAL_FIELDS = {
+    'description': '',
+    'price': Decimal('0.00'),
+    'stock': 0,
+    'image': '',
+    'available': True,
+}
+SUFFIX_CANDIDATES = 20
+SLUG_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSONL supplier catalog into Product/Category in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row, or JSONL with one product per line')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows written per transaction')
+        parser.add_argument('--checkpoint', help='Progress file (default: <path>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        chunk_size = options['chunk_size']
+
+        skip = 0 if options['restart'] else self.read_checkpoint(checkpoint_path, path)
+        if skip:
+            self.stdout.write(f"Resuming after row {skip}")
+
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        started = time.perf_counter()
+        done = skip
+        totals = {'created': 0, 'updated': 0, 'skipped': 0}
+
+        with open(path, newline='', encoding='utf-8') as handle:
+            rows = self.read_rows(handle, fmt)
+            for _ in islice(rows, skip):
+                pass
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                with transaction.atomic():
+                    counts = self.import_chunk(chunk, done)
+                for key in totals:
+                    totals[key] += counts[key]
+                done += len(chunk)
+                # Only after the chunk is committed; a crash in between just
+                # replays the chunk, which upserts the same rows again
+                self.write_checkpoint(checkpoint_path, path, done)
+
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"{done} rows, {(done - skip) / elapsed:,.0f} rows/s")
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        elapsed = time.perf_counter() - started
+        peak = peak_memory_mb()
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {done - skip} rows in {elapsed:.1f}s ({(done - skip) / max(elapsed, 1e-9):,.0f} rows/s): "
+            f"{totals['created']} created, {totals['updated']} updated, {totals['skipped']} skipped"
+            + (f"; peak memory {peak:.0f} MiB" if peak is not None else '')
+        ))
+        self.stdout.write('Run generate_image_derivatives to build responsive images for new uploads.')
+
+    def read_rows(self, handle, fmt):
+        if fmt == 'csv':
+            yield from csv.DictReader(handle)
+        else:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+
+    def read_checkpoint(self, checkpoint_path, path):
+        try:
+            with open(checkpoint_path) as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return 0
+        if state.get('file') != os.path.abspath(path):
+            raise CommandError(f"{checkpoint_path} belongs to {state.get('file')}; use --restart to ignore it")
+        return int(state.get('rows_done', 0))
+
+    def write_checkpoint(self, checkpoint_path, path, rows_done):
+        tmp_path = f'{checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump({'file': os.path.abspath(path), 'rows_done': rows_done}, handle)
+        os.replace(tmp_path, checkpoint_path)
+
+    def parse(self, row, line_number):
+        """Normalise one input row, or return None (with a warning) if it is unusable"""
+        try:
+            name = str(row.get('name') or '').strip()
+            category = str(row.get('category') or '').strip()
+            if not name or not category:
+                raise ValueError('name and category are required')
+            record = {
+                'name': name[:200],
+                'slug': slugify(row.get('slug') or '')[:50],
+                'category_slug': slugify(category)[:50],
+                'category_name': str(row.get('category_name') or category).strip()[:100],
+            }
+            # Only the optional columns the row has are written
+            if 'description' in row:
+                record['description'] = str(row['description'] or '')
+            if 'price' in row:
+                record['price'] = Decimal(str(row['price'] or '0')).quantize(Decimal('0.01'))
+            if 'stock' in row:
+                record['stock'] = max(int(row['stock'] or 0), 0)
+            if 'image' in row:
+                record['image'] = str(row['image'] or '')
+            if 'available' in row:
+                available = row['available']
+                if isinstance(available, str):
+                    available = available.strip().lower() in TRUE_VALUES
+                record['available'] = bool(available)
+            return record
+        except (ValueError, TypeError, InvalidOperation) as e:
+            self.stderr.write(f"Row {line_number}: skipped ({str(e)})")
+            return None
+
+    def resolve_categories(self, records):
+        missing = {}
+        for record in records:
+            if record['category_slug'] not in self.categories:
+                missing.setdefault(record['category_slug'], record['category_name'])
+        if missing:
+            Category.objects.bulk_create(
+                [Category(slug=slug, name=name) for slug, name in missing.items()],
+                ignore_conflicts=True,
+            )
+            self.categories.update(Category.objects.filter(slug__in=missing).values_list('slug', 'id'))
+
+    def assign_slugs(self, records):
+        """Map each record to a slug, reusing the product it already belongs to
+
+        An explicit slug always identifies the product. A slug derived from the
+        name belongs to an existing product only if that product has the same
+        name; otherwise the first free ``-2``, ``-3``... suffix is used. This
+        keeps re-imports of the same file idempotent.
+        """
+        names = {}
+        for record in records:
+            if not record['slug']:
+                record['base'] = slugify(record['name'])[:50] or 'product'
+                names.setdefault(record['base'], set()).add(record['name'])
+        explicit = {record['slug'] for record in records if record['slug']}
+        existing = self.lookup(set(names) | explicit)
+
+        # Suffixes are only looked up for bases shared by different names,
+        # which keeps the IN list close to one slug per row
+        suffixed = set()
+        for base, base_names in names.items():
+            if len(base_names) > 1 or (base in existing and existing[base][1] not in base_names):
+                suffixed.update(f'{base[:44]}-{n}' for n in range(2, SUFFIX_CANDIDATES + 2))
+        existing.update(self.lookup(suffixed))
+
+        taken = {}
+        for record in records:
+            if record['slug']:
+                taken[record['slug']] = record['name']
+                continue
+            stem = record['base'][:44]
+            options = [record['base']] + [f'{stem}-{n}' for n in range(2, SUFFIX_CANDIDATES + 2)]
+            slug = next(
+                (option for option in options
+                 if taken.get(option, existing.get(option, (None, record['name']))[1]) == record['name']),
+                None,
+            )
+            if slug is None:
+                slug = f'{stem}-{get_random_string(5, SLUG_CHARS)}'
+            record['slug'] = slug
+            taken[slug] = record['name']
+        return {slug: pk for slug, (pk, _) in existing.items()}
+
+    def lookup(self, slugs):
+        if not slugs:
+            return {}
+        rows = Product.objects.filter(slug__in=slugs).values_list('id', 'slug', 'name')
+        return {slug: (pk, name) for pk, slug, name in rows}
+
+    def import_chunk(self, chunk, offset):
+        counts = {'created': 0, 'updated': 0, 'skipped': 0}
+        records = []
+        for number, row in enumerate(chunk, start=offset + 1):
+            record = self.parse(row, number)
+            if record is None:
+                counts['skipped'] += 1
+            else:
+                records.append(record)
+        if not records:
+            return counts
+
+        self.resolve_categories(records)
+        existing = self.assign_slugs(records)
+
+        # Later rows for the same product win
+        by_slug = {record['slug']: record for record in records}
+        # Rows are upserted in groups with the same optional columns, so each
+        # group's UPDATE leaves the columns its rows did not have alone
+        groups = {}
+        category_ids = set()
+        for slug, record in by_slug.items():
+            category_ids.add(self.categories[record['category_slug']])
+            present = tuple(field for field in OPTIONAL_FIELDS if field in record)
+            groups.setdefault(present, []).append(Product(
+                slug=slug,
+                category_id=self.categories[record['category_slug']],
+                name=record['name'],
+                **{field: record.get(field, default) for field, default in OPTIONAL_FIELDS.items()},
+            ))
+
+        previous = {
+            slug: (stock, category_id)
+            for slug, stock, category_id in Product.objects.filter(slug__in=list(by_slug))
+            .values_list('slug', 'stock', 'category_id')
+        }
+        previous_stock = {slug: stock for slug, (stock, _) in previous.items()}
+        # Products moved to another category leave its listing as well
+        category_ids.update(category_id for _, category_id in previous.values())
+        products = []
+        movements = []
+        for present, group in groups.items():
+            # One INSERT ... ON CONFLICT (slug) DO UPDATE per batch; bulk_update's
+            # per-row CASE expressions were ~10x slower for large chunks
+            Product.objects.bulk_create(
+                group,
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['slug'],
+                update_fields=UPDATE_FIELDS + list(present),
+            )
+            if 'description' in present:
+                products.extend(group)
+            else:
+                # Index the stored descriptions, not the blank defaults
+                products.extend(
+                    Product.objects.filter(slug__in=[product.slug for product in group])
+                    .only('id', 'name', 'description')
+                )
+            if 'stock' in present:
+                movements.extend(
+                    InventoryMovement(
+                        product_id=product.pk,
+                        quantity=product.stock - previous_stock.get(product.slug, 0),
+                        reason='import',
+                    )
+                    for product in group if product.stock != previous_stock.get(product.slug, 0)
+                )
+        # bulk writes bypass the post_save handlers that maintain the index
+        # and the inventory ledger
+        search.index_products(products)
+        InventoryMovement.objects.bulk_create(movements)
+        if settings.CART_DENORMALIZED_TOTALS:
+            # Prices may have changed under carts holding these products
+            Cart.objects.filter(items__product__slug__in=list(by_slug)).refresh_totals()
+        # Per chunk, so pages reflect committed rows even if a later chunk fails
+        catalog_cache.bump(
+            'products',
+            'categories',
+            *[f'category:{pk}' for pk in category_ids],
+            *[f'product:{slug}' for slug in by_slug],
+        )
+
+        updated = sum(1 for slug in by_slug if slug in existing)
+        counts['created'] += len(by_slug) - updated
+        counts['updated'] += updated
+        counts['skipped'] += len(records) - len(by_slug)
+        return counts
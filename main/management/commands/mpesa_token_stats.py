@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from main.mpesa import token
+
+
+class Command(BaseCommand):
+    help = 'Show how often the shared M-Pesa access token was fetched, reused or waited for'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        stats = token.stats()
+        self.stdout.write(
+            f"fetches: {stats['fetches']}  hits: {stats['hits']}  waits: {stats['waits']}  errors: {stats['errors']}"
+        )
+        if options['reset']:
+            token.reset_stats()
+            self.stdout.write('Counters reset')
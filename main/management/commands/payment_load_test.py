@@ -0,0 +1,94 @@
+import asyncio
+import statistics
+import time
+from collections import Counter
+
+import httpx
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main.fake_gateway import FakeGateway
+
+USERNAME = 'loadtest-{}'
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test payment initiation against running app servers. Start the servers with '
+        'MPESA_BASE_URL pointing at --gateway-port, e.g. sync: gunicorn -w 4 wave_logistics.wsgi; '
+        'async: uvicorn wave_logistics.asgi:application'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='+',
+                            help='Full URLs to compare, e.g. http://127.0.0.1:8001/payment/initiate/')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--gateway-port', type=int, default=9100, help='Port for the built-in fake gateway')
+        parser.add_argument('--gateway-latency', type=float, default=0.5,
+                            help='Seconds the fake gateway takes to answer')
+        parser.add_argument('--no-gateway', action='store_true',
+                            help='Use a gateway that is already running, e.g. the fake_gateway command')
+
+    def handle(self, *args, **options):
+        # Each payment needs its own user: initiation allows 10 attempts a minute per user
+        tokens = self.tokens(options['requests'] * len(options['targets']))
+        asyncio.run(self.run(tokens, options))
+
+    def tokens(self, count):
+        existing = set(User.objects.filter(username__startswith='loadtest-').values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=USERNAME.format(i), email=f'loadtest-{i}@example.invalid')
+            for i in range(count) if USERNAME.format(i) not in existing
+        ])
+        users = User.objects.filter(username__in=[USERNAME.format(i) for i in range(count)]).order_by('pk')
+        return [str(AccessToken.for_user(user)) for user in users]
+
+    async def run(self, tokens, options):
+        server = None
+        if not options['no_gateway']:
+            # Payments are only initiated here, so no callbacks
+            gateway = FakeGateway(latency=options['gateway_latency'], callbacks=False)
+            server = await gateway.start('127.0.0.1', options['gateway_port'])
+            self.stdout.write(f"Fake gateway on {gateway.url}, {options['gateway_latency']}s latency")
+        try:
+            for index, target in enumerate(options['targets']):
+                batch = tokens[index * options['requests']:(index + 1) * options['requests']]
+                await self.run_target(target, batch, options['concurrency'])
+        finally:
+            if server is not None:
+                server.close()
+                await gateway.close()
+
+    async def run_target(self, url, tokens, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        statuses = Counter()
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            async def one(token):
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post(url, json={
+                            'payment_method': 'mpesa', 'amount': '100', 'phone_number': '0712345678',
+                        }, headers={'Authorization': f'Bearer {token}'})
+                        statuses[response.status_code] += 1
+                    except httpx.HTTPError as e:
+                        statuses[type(e).__name__] += 1
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[one(token) for token in tokens])
+            elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{url}: {len(tokens)} requests, concurrency {concurrency}, {elapsed:.1f}s, "
+            f"{len(tokens) / elapsed:,.1f} req/s; latency p50 {quantiles[49] * 1000:.0f}ms "
+            f"p95 {quantiles[94] * 1000:.0f}ms p99 {quantiles[98] * 1000:.0f}ms; "
+            f"status {dict(statuses)}"
+        )
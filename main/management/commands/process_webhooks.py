@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import webhooks
+
+
+class Command(BaseCommand):
+    help = 'Apply queued payment webhook events in batches, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events claimed per transaction')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, polling every this many seconds when idle (default: drain once)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            totals = {'processed': 0, 'retried': 0, 'failed': 0}
+            while True:
+                counts = webhooks.process_batch(options['batch_size'])
+                for key in totals:
+                    totals[key] += counts[key]
+                if sum(counts.values()) < options['batch_size']:
+                    break
+            elapsed = time.perf_counter() - started
+            handled = sum(totals.values())
+            if handled or not options['interval']:
+                self.stdout.write(
+                    f"{totals['processed']} processed, {totals['retried']} retried, {totals['failed']} failed "
+                    f"in {elapsed:.2f}s ({handled / max(elapsed, 1e-9):,.0f} events/s)"
+                )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
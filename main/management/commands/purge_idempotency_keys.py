@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Delete stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        purged = idempotency.purge_expired(options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"Purged {purged} idempotency keys in {elapsed:.2f}s")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product full-text search index'
+
+    def handle(self, *args, **options):
+        backend = search.search_backend()
+        if backend != 'fts5':
+            self.stdout.write(f"The {backend} backend keeps its index up to date; nothing to rebuild.")
+            return
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
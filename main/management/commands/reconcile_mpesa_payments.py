@@ -0,0 +1,44 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from main import reconciler
+
+
+class Command(BaseCommand):
+    help = 'Resolve M-Pesa payments left pending by lost callbacks, using the STK push status query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=180,
+                            help='Only check payments pending for at least this many seconds')
+        parser.add_argument('--max-age', type=int, default=24 * 60 * 60,
+                            help='Give up on payments older than this many seconds')
+        parser.add_argument('--batch-size', type=int, default=200, help='Payments read and updated together')
+        parser.add_argument('--workers', type=int, default=10, help='Status queries in flight at once')
+        parser.add_argument('--rate', type=float, default=5.0, help='Status queries per second (0 for no limit)')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, starting a pass every this many seconds (default: run once)')
+
+    def handle(self, *args, **options):
+        while True:
+            run = reconciler.reconcile(
+                min_age=timedelta(seconds=options['min_age']),
+                max_age=timedelta(seconds=options['max_age']),
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                rate=options['rate'],
+            )
+            if run.checked or not options['interval']:
+                elapsed = (run.finished_at - run.started_at).total_seconds()
+                latency = (
+                    f"; query latency p50 {run.latency_p50_ms:.0f}ms p95 {run.latency_p95_ms:.0f}ms "
+                    f"max {run.latency_max_ms:.0f}ms" if run.latency_p50_ms is not None else ''
+                )
+                self.stdout.write(
+                    f"{run.checked} checked: {run.completed} completed, {run.failed} failed, "
+                    f"{run.still_pending} still pending, {run.errors} errors in {elapsed:.2f}s{latency}"
+                )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,186 @@
+import csv
+import os
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+from django.db.models import Q
+
+from main.management.commands.import_catalog import peak_memory_mb
+from main.models import MpesaPayment, PaymentTransaction
+
+# Column names in each provider's export, and the statuses meaning "paid"
+SOURCES = {
+    'mpesa': {
+        'id': 'Receipt No.',
+        'reference': 'A/C No.',
+        'amount': 'Paid In',
+        'status': 'Transaction Status',
+        'paid': {'completed'},
+    },
+    'stripe': {
+        'id': 'id',
+        'reference': 'reference (metadata)',
+        'amount': 'Amount',
+        'status': 'Status',
+        'paid': {'paid', 'succeeded'},
+    },
+}
+REPORT_HEADER = [
+    'line', 'problem', 'statement_id', 'reference', 'statement_amount', 'our_amount',
+    'statement_status', 'our_status', 'our_id',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Match an M-Pesa or Stripe statement export against PaymentTransaction/MpesaPayment '
+        'and write the rows that do not agree to a report'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Statement CSV with a header row')
+        parser.add_argument('--source', choices=sorted(SOURCES), required=True)
+        parser.add_argument('--report', help='Mismatch report CSV (default: <path>.mismatches.csv)')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows matched per lookup')
+        for column in ('id', 'reference', 'amount', 'status'):
+            parser.add_argument(f'--{column}-column', help=f"Override the {column} column name")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        source = options['source']
+        self.columns = {
+            key: options[f'{key}_column'] or SOURCES[source][key] for key in ('id', 'reference', 'amount', 'status')
+        }
+        self.paid = SOURCES[source]['paid']
+        self.lookup = self.lookup_mpesa if source == 'mpesa' else self.lookup_stripe
+        report_path = options['report'] or f'{path}.mismatches.csv'
+
+        started = time.perf_counter()
+        self.totals = {'rows': 0, 'matched': 0, 'skipped': 0, 'unknown': 0, 'amount': 0, 'status': 0, 'id': 0}
+        with open(path, newline='', encoding='utf-8-sig') as handle, \
+                open(report_path, 'w', newline='', encoding='utf-8') as report_handle:
+            rows = csv.reader(handle)
+            header = next(rows, None)
+            if header is None:
+                raise CommandError(f"{path} is empty")
+            missing = [name for name in self.columns.values() if name not in header]
+            if missing:
+                raise CommandError(f"{path} has no column(s) {', '.join(missing)}; see --<field>-column")
+            self.indexes = {key: header.index(name) for key, name in self.columns.items()}
+            report = csv.writer(report_handle)
+            report.writerow(REPORT_HEADER)
+
+            line = 1
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                self.match_chunk(chunk, line + 1, report)
+                line += len(chunk)
+                # With DEBUG on, the logged lookups would grow with the file
+                reset_queries()
+                if self.totals['rows'] % 100000 < len(chunk):
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f"{self.totals['rows']} rows, {self.totals['rows'] / elapsed:,.0f} rows/s")
+
+        elapsed = time.perf_counter() - started
+        peak = peak_memory_mb()
+        mismatches = sum(self.totals[key] for key in ('unknown', 'amount', 'status', 'id'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {self.totals['rows']} rows in {elapsed:.1f}s "
+            f"({self.totals['rows'] / max(elapsed, 1e-9):,.0f} rows/s): {self.totals['matched']} matched, "
+            f"{self.totals['skipped']} skipped, {mismatches} mismatches ({self.totals['unknown']} unknown, "
+            f"{self.totals['amount']} amount, {self.totals['status']} status, {self.totals['id']} id) "
+            f"written to {report_path}"
+            + (f"; peak memory {peak:.0f} MiB" if peak is not None else '')
+        ))
+
+    def match_chunk(self, chunk, first_line, report):
+        index = self.indexes
+        records = []
+        for offset, row in enumerate(chunk):
+            self.totals['rows'] += 1
+            try:
+                amount = row[index['amount']].replace(',', '').strip()
+                if not amount:
+                    # Not a payment into the account (fees, withdrawals)
+                    self.totals['skipped'] += 1
+                    continue
+                records.append((
+                    first_line + offset,
+                    row[index['id']].strip(),
+                    row[index['reference']].strip(),
+                    Decimal(amount).quantize(Decimal('0.01')),
+                    row[index['status']].strip(),
+                ))
+            except (IndexError, InvalidOperation):
+                self.totals['skipped'] += 1
+                self.stderr.write(f"Line {first_line + offset}: skipped (unreadable row)")
+
+        transactions, id_references, our_ids = self.lookup(
+            {record[2] for record in records if record[2]}, {record[1] for record in records if record[1]}
+        )
+        for line, statement_id, reference, amount, status in records:
+            by_id = id_references.get(statement_id)
+            if reference not in transactions:
+                reference = by_id
+            transaction = transactions.get(reference)
+            if transaction is None:
+                problem = 'unknown'
+                our_amount = our_status = our_id = ''
+            else:
+                our_amount, our_status = transaction
+                our_id = our_ids.get(reference) or ''
+                paid = status.lower() in self.paid
+                if our_amount != amount:
+                    problem = 'amount'
+                elif paid != (our_status == 'completed'):
+                    problem = 'status'
+                elif (
+                    (by_id is not None and by_id != reference)
+                    or (our_id and statement_id and our_id != statement_id)
+                ):
+                    problem = 'id'
+                else:
+                    self.totals['matched'] += 1
+                    continue
+            self.totals[problem] += 1
+            report.writerow([
+                line, problem, statement_id, reference or '', amount, our_amount, status, our_status, our_id,
+            ])
+
+    def lookup_mpesa(self, references, receipts):
+        """({reference: (amount, status)}, {receipt: reference}, {reference: receipt}) for a chunk"""
+        id_references = {}
+        our_ids = {}
+        for reference, receipt in MpesaPayment.objects.filter(
+            Q(reference__in=references) | Q(transaction_id__in=receipts)
+        ).order_by().values_list('reference', 'transaction_id'):
+            if receipt:
+                id_references[receipt] = reference
+                our_ids[reference] = receipt
+        transactions = {
+            reference: (amount, status)
+            for reference, amount, status in PaymentTransaction.objects.filter(
+                reference__in=references | set(id_references.values())
+            ).order_by().values_list('reference', 'amount', 'status')
+        }
+        return transactions, id_references, our_ids
+
+    def lookup_stripe(self, references, charge_ids):
+        transactions = {}
+        id_references = {}
+        our_ids = {}
+        for reference, amount, status, charge_id in PaymentTransaction.objects.filter(
+            Q(reference__in=references) | Q(transaction_id__in=charge_ids)
+        ).order_by().values_list('reference', 'amount', 'status', 'transaction_id'):
+            transactions[reference] = (amount, status)
+            if charge_id:
+                id_references[charge_id] = reference
+                our_ids[reference] = charge_id
+        return transactions, id_references, our_ids
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import reservations
+
+
+class Command(BaseCommand):
+    help = 'Delete expired checkout stock reservations, and those of settled payments, in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, sweeping every this many seconds (default: sweep once)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            released = reservations.release_expired(options['batch_size'])
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"Released {released} expired reservations in {elapsed:.2f}s")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
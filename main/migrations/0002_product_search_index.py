@@ -0,0 +1,46 @@
+from django.db import migrations
+
+# The DDL is spelled out here rather than taken from main.search, so this
+# migration keeps building the same index whatever that module becomes
+SQLITE_CREATE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS main_product_fts "
+    "USING fts5(name, description, tokenize='porter unicode61')"
+)
+SQLITE_FILL_SQL = (
+    "INSERT INTO main_product_fts (rowid, name, description) "
+    "SELECT id, name, description FROM main_product"
+)
+SQLITE_DROP_SQL = "DROP TABLE IF EXISTS main_product_fts"
+PG_CREATE_SQL = (
+    "CREATE INDEX IF NOT EXISTS main_product_search_idx ON main_product USING GIN "
+    "(to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, '')))"
+)
+PG_DROP_SQL = "DROP INDEX IF EXISTS main_product_search_idx"
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE_SQL)
+        schema_editor.execute(SQLITE_FILL_SQL)
+    elif vendor == 'postgresql':
+        schema_editor.execute(PG_CREATE_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_DROP_SQL)
+    elif vendor == 'postgresql':
+        schema_editor.execute(PG_DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.3 on 2026-10-18 02:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_webhook_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checked', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('still_pending', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('latency_p50_ms', models.FloatField(blank=True, null=True)),
+                ('latency_p95_ms', models.FloatField(blank=True, null=True)),
+                ('latency_max_ms', models.FloatField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='mpesapayment',
+            index=models.Index(fields=['status', 'created_at'], name='main_mpesap_status_90cb62_idx'),
+        ),
+    ]
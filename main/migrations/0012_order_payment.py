@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 02:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_mpesa_reconciliation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='payment',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order', to='main.paymenttransaction'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 02:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_order_payment'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mpesapayment',
+            name='reference',
+            field=models.CharField(db_index=True, default='', max_length=100),
+        ),
+    ]
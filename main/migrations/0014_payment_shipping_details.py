@@ -0,0 +1,23 @@
+# Generated by Django 5.0.3 on 2026-10-18 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_mpesa_payment_reference_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='full_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='shipping_address',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.3 on 2026-10-18 03:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_reservation_payment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='lines',
+            field=models.JSONField(blank=True, default=list, help_text='[product_id, quantity] pairs paid for'),
+        ),
+        migrations.AddField(
+            model_name='paymenttransaction',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
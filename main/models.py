@@ -1,4 +1,8 @@
+from django.conf import settings
 from django.db import models
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.text import slugify
@@ -30,6 +34,12 @@ class PaymentTransaction(models.Model):
     transaction_date = models.DateTimeField(default=timezone.now)
     customer_phone = models.CharField(max_length=15, null=True, blank=True)
     customer_email = models.EmailField(null=True, blank=True)
+    # Who pays, what for and where to ship it: the order placed when the
+    # payment completes (see orders.fulfil_payment)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
+    lines = models.JSONField(default=list, blank=True, help_text='[product_id, quantity] pairs paid for')
+    full_name = models.CharField(max_length=100, blank=True)
+    shipping_address = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -44,10 +54,69 @@ class PaymentTransaction(models.Model):
     def __str__(self):
         return f"{self.payment_method} - {self.reference}"
 
+class IdempotencyKey(models.Model):
+    """Response stored for a client-supplied Idempotency-Key (see main.idempotency)"""
+    key = models.CharField(max_length=255)
+    scope = models.CharField(max_length=100, help_text='View the key was used with')
+    owner = models.CharField(max_length=100, help_text='User or session the key belongs to')
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    content_type = models.CharField(max_length=100)
+    location = models.CharField(max_length=500, blank=True)
+    body = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'scope', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} ({self.status_code})"
+
+class WebhookEvent(models.Model):
+    """A verified payment gateway callback waiting to be applied (see main.webhooks)"""
+    PROVIDERS = (
+        ('mpesa', 'M-Pesa'),
+        ('paypal', 'PayPal'),
+        ('stripe', 'Stripe'),
+        ('gateway', 'Payment gateway'),
+    )
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    )
+
+    provider = models.CharField(max_length=10, choices=PROVIDERS)
+    event_id = models.CharField(max_length=255, help_text="Provider's event ID, used to drop redeliveries")
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'event_id'], name='unique_webhook_event'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} {self.event_id} ({self.status})"
+
 class MpesaPayment(models.Model):
     phone_number = models.CharField(max_length=15, default='')
     amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
-    reference = models.CharField(max_length=100, default='')
+    reference = models.CharField(max_length=100, default='', db_index=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
     description = models.TextField(default='')
     transaction_id = models.CharField(max_length=100, null=True, blank=True)
     transaction_date = models.DateTimeField(null=True, blank=True)
@@ -63,16 +132,38 @@ class MpesaPayment(models.Model):
             models.Index(fields=['phone_number']),
             models.Index(fields=['transaction_id']),
             models.Index(fields=['status']),
+            # Stale pending payments for reconcile_mpesa_payments
+            models.Index(fields=['status', 'created_at']),
         ]
 
     def __str__(self):
         return f"{self.phone_number} - {self.amount}"
 
+class ReconciliationRun(models.Model):
+    """Counts and gateway latency for one reconcile_mpesa_payments pass"""
+    checked = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    still_pending = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    latency_p50_ms = models.FloatField(null=True, blank=True)
+    latency_p95_ms = models.FloatField(null=True, blank=True)
+    latency_max_ms = models.FloatField(null=True, blank=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Reconciliation run at {self.started_at:%Y-%m-%d %H:%M:%S}"
+
 class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to='categories/', blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -96,12 +187,18 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
     image = models.ImageField(upload_to='products/')
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of product_list, with and without a category filter
+            models.Index(fields=['available', '-created_at', '-id']),
+            models.Index(fields=['category', 'available', '-created_at', '-id']),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -115,21 +212,125 @@ class Product(models.Model):
     def is_in_stock(self):
         return self.stock > 0
 
+def cart_totals(prefix=''):
+    """Aggregates for a cart's subtotal and item count
+
+    prefix is the path from the queried model to CartItem, e.g. 'items__' when
+    aggregating over carts.
+    """
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    return {
+        'items_subtotal': Coalesce(
+            Sum(F(f'{prefix}quantity') * F(f'{prefix}product__price'), output_field=money),
+            Value(Decimal('0.00')),
+            output_field=money,
+        ),
+        'items_count': Coalesce(Sum(f'{prefix}quantity'), 0),
+    }
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate each cart with items_subtotal and items_count in the same query"""
+        return self.annotate(**cart_totals('items__'))
+
+    def refresh_totals(self):
+        """Recompute the stored subtotal and item_count of these carts in one UPDATE
+
+        The values are computed from the item rows by the UPDATE itself, so the
+        result is correct whatever was stored before. Edits that lock the cart
+        row first (select_for_update) are serialized, so concurrent edits
+        cannot leave a stale total behind.
+        """
+        items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        totals = cart_totals()
+        return self.update(
+            subtotal=Coalesce(
+                Subquery(items.annotate(total=totals['items_subtotal']).values('total')),
+                Value(Decimal('0.00')),
+            ),
+            item_count=Coalesce(Subquery(items.annotate(total=totals['items_count']).values('total')), 0),
+        )
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Denormalized totals, maintained when CART_DENORMALIZED_TOTALS is on
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'), editable=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
     def __str__(self):
         return f"Cart for {self.user.username}"
 
+    def refresh_totals(self):
+        """Load the subtotal and item count with a single query"""
+        if getattr(settings, 'CART_DENORMALIZED_TOTALS', False):
+            self.refresh_from_db(fields=['subtotal', 'item_count'])
+            self.items_subtotal, self.items_count = self.subtotal, self.item_count
+        else:
+            totals = self.items.aggregate(**cart_totals())
+            self.items_subtotal, self.items_count = totals['items_subtotal'], totals['items_count']
+
     @property
     def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+        # Set by with_totals() or refresh_totals()
+        if not hasattr(self, 'items_subtotal'):
+            self.refresh_totals()
+        # SQLite does not quantize computed decimals
+        return Decimal(self.items_subtotal).quantize(Decimal('0.01'))
 
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        if not hasattr(self, 'items_count'):
+            self.refresh_totals()
+        return self.items_count
+
+class CartItemQuerySet(models.QuerySet):
+    def _changed(self, cart_id):
+        # update() skips the post_save handler that maintains these
+        if getattr(settings, 'CART_DENORMALIZED_TOTALS', False):
+            Cart.objects.filter(pk=cart_id).refresh_totals()
+
+    def add_quantity(self, cart, product, quantity) -> bool:
+        """Add quantity of product to cart; False if that would exceed stock
+
+        Existing lines are incremented by a single conditional UPDATE
+        (quantity = quantity + n WHERE quantity + n <= stock), so concurrent
+        adds neither lose updates nor overshoot stock. A missing line is
+        inserted; if a concurrent request inserted it first, the UPDATE is
+        retried.
+        """
+        in_stock = Exists(Product.objects.filter(pk=OuterRef('product_id'), stock__gte=OuterRef('quantity') + quantity))
+        line = self.filter(in_stock, cart=cart, product=product)
+        if line.update(quantity=F('quantity') + quantity, updated_at=timezone.now()):
+            self._changed(cart.pk)
+            return True
+        if quantity > product.stock:
+            return False
+        try:
+            with transaction.atomic():
+                self.create(cart=cart, product=product, quantity=quantity)
+            return True
+        except IntegrityError:
+            pass
+        if line.update(quantity=F('quantity') + quantity, updated_at=timezone.now()):
+            self._changed(cart.pk)
+            return True
+        return False
+
+    def set_quantity(self, item, quantity) -> bool:
+        """Set a line's quantity in one UPDATE that also checks stock; False if stock is short"""
+        in_stock = Exists(Product.objects.filter(pk=OuterRef('product_id'), stock__gte=quantity))
+        if self.filter(in_stock, pk=item.pk).update(quantity=quantity, updated_at=timezone.now()):
+            item.quantity = quantity
+            self._changed(item.cart_id)
+            return True
+        return False
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
@@ -138,6 +339,8 @@ class CartItem(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartItemQuerySet.as_manager()
+
     class Meta:
         unique_together = ('cart', 'product')
 
@@ -165,8 +368,18 @@ class Order(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     tracking_number = models.CharField(max_length=50, unique=True)
+    # The transaction that paid for the order; one order per transaction
+    payment = models.OneToOneField(
+        PaymentTransaction, on_delete=models.SET_NULL, null=True, blank=True, related_name='order'
+    )
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of order_history
+            models.Index(fields=['user', '-created', '-id']),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.tracking_number:
@@ -210,3 +423,97 @@ class TrackingUpdate(models.Model):
     
     def __str__(self):
         return f"{self.order.tracking_number} - {self.status}"
+
+class ProductAssociation(models.Model):
+    """How often two products were bought together; kept for each product's top neighbours"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='associations')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='associated_with')
+    score = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('product', 'related')
+        indexes = [
+            models.Index(fields=['product', '-score']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} ({self.score})"
+
+class AssociationRun(models.Model):
+    """Bookkeeping for compute_related_products, so later runs can be incremental"""
+    last_order_id = models.BigIntegerField(default=0)
+    full_rebuild = models.BooleanField(default=False)
+    orders_processed = models.PositiveIntegerField(default=0)
+    products_updated = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Association run up to order {self.last_order_id}"
+
+class StockReservation(models.Model):
+    """Stock held for a cart between the start of checkout and payment
+
+    Holds count against a product's available-to-sell figure until they
+    expire, or until the payment they were renewed for fails or completes;
+    such rows are ignored and later deleted by release_expired_reservations.
+    """
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    payment = models.ForeignKey(
+        PaymentTransaction, on_delete=models.SET_NULL, null=True, blank=True, related_name='reservations'
+    )
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'expires_at']),
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for cart {self.cart_id} until {self.expires_at}"
+
+class InventoryMovement(models.Model):
+    """Append-only ledger of stock changes
+
+    Rows are never updated or deleted, and outlive the products and orders
+    they refer to (hence no database constraints on those keys).
+    """
+    REASONS = (
+        ('sale', 'Sale'),
+        ('adjustment', 'Adjustment'),
+        ('import', 'Catalog import'),
+    )
+
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='movements')
+    quantity = models.IntegerField(help_text='Signed change in stock')
+    reason = models.CharField(max_length=20, choices=REASONS)
+    order = models.ForeignKey(
+        Order, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True,
+        related_name='inventory_movements'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['product', '-created_at']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Inventory movements cannot be changed")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Inventory movements cannot be deleted")
+
+    def __str__(self):
+        return f"{self.quantity:+d} x {self.product_id} ({self.reason})"
@@ -3,12 +3,22 @@ M-Pesa Integration Module
 """
 import base64
 import json
+import httpx
 import requests
 from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
 from django.conf import settings
 
-class MpesaClient:
-    """M-Pesa API Client"""
+from . import token as token_cache
+from . import transport
+
+def whole_shillings(amount) -> Decimal:
+    """amount rounded half up to what M-Pesa can charge (whole shillings)"""
+    return Decimal(str(amount)).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+
+
+class BaseMpesaClient:
+    """Configuration and request bodies shared by MpesaClient and AsyncMpesaClient"""
     
     def __init__(self):
         self.env = settings.MPESA_ENVIRONMENT
@@ -17,50 +27,42 @@ class MpesaClient:
         self.shortcode = settings.MPESA_SHORTCODE
         self.passkey = settings.MPESA_PASSKEY
         
-        if self.env == "sandbox":
+        if getattr(settings, 'MPESA_BASE_URL', None):
+            # e.g. a local stand-in gateway for load tests
+            self.base_url = settings.MPESA_BASE_URL.rstrip("/")
+        elif self.env == "sandbox":
             self.base_url = "https://sandbox.safaricom.co.ke"
         else:
             self.base_url = "https://api.safaricom.co.ke"
-            
-        self.access_token = self.get_access_token()
-        
-    def get_access_token(self):
-        """Get M-Pesa API access token"""
+
+    def token_request(self):
         url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
         auth = base64.b64encode(f"{self.consumer_key}:{self.consumer_secret}".encode()).decode()
-        headers = {"Authorization": f"Basic {auth}"}
-        
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()  # Raise exception for non-200 status codes
-            return response.json()["access_token"]
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Failed to get access token: {str(e)}")
-            
+        return url, {"Authorization": f"Basic {auth}"}
+
     def generate_password(self, timestamp):
         """Generate M-Pesa API password"""
         password_str = f"{self.shortcode}{self.passkey}{timestamp}"
         return base64.b64encode(password_str.encode()).decode()
         
-    def stk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
-        """Initiate STK Push transaction"""
+    def stk_push_payload(self, phone_number, amount, callback_url, account_reference, transaction_desc):
         if not phone_number.startswith("254"):
             phone_number = f"254{phone_number.lstrip('0')}"
-            
+
+        amount = Decimal(str(amount))
+        if amount != amount.to_integral_value():
+            # Charge whole_shillings(amount), and record that, instead
+            raise ValueError(f"M-Pesa amounts must be whole shillings, not {amount}")
+
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         password = self.generate_password(timestamp)
-        
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
+
+        return {
             "BusinessShortCode": self.shortcode,
             "Password": password,
             "Timestamp": timestamp,
             "TransactionType": "CustomerPayBillOnline",
-            "Amount": amount,
+            "Amount": int(amount),
             "PartyA": phone_number,
             "PartyB": self.shortcode,
             "PhoneNumber": phone_number,
@@ -68,36 +70,124 @@ class MpesaClient:
             "AccountReference": account_reference,
             "TransactionDesc": transaction_desc
         }
-        
+
+    def status_query_payload(self, checkout_request_id):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        return {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.generate_password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+
+    def api_headers(self, access_token):
+        return {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        }
+
+
+class MpesaClient(BaseMpesaClient):
+    """M-Pesa API Client"""
+
+    @property
+    def access_token(self):
+        return self.get_access_token()
+
+    def get_access_token(self):
+        """Get the shared M-Pesa API access token, fetching a new one only when it is due"""
+        return token_cache.get_token(self.base_url, self.consumer_key, self.fetch_access_token)
+
+    def fetch_access_token(self):
+        """Request a new access token; returns (token, expires_in seconds)"""
+        url, headers = self.token_request()
+
+        try:
+            response = transport.request("GET", url, idempotent=True, headers=headers)
+            response.raise_for_status()  # Raise exception for non-200 status codes
+            data = response.json()
+            return data["access_token"], int(data.get("expires_in", 3599))
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to get access token: {str(e)}")
+
+    def stk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
+        """Initiate STK Push transaction"""
+        payload = self.stk_push_payload(phone_number, amount, callback_url, account_reference, transaction_desc)
+        headers = self.api_headers(self.access_token)
+
         try:
             url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-            response = requests.post(url, json=payload, headers=headers)
+            # Not retried once sent: a repeat would prompt the customer twice
+            response = transport.request("POST", url, idempotent=False, json=payload, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
+            if e.response is not None and e.response.status_code == 401:
+                token_cache.clear(self.base_url, self.consumer_key)
             raise Exception(f"STK push failed: {str(e)}")
             
     def check_payment_status(self, checkout_request_id):
         """Check payment status"""
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        password = self.generate_password(timestamp)
-        
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        
-        payload = {
-            "BusinessShortCode": self.shortcode,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
-        }
-        
+        payload = self.status_query_payload(checkout_request_id)
+        headers = self.api_headers(self.access_token)
+
         try:
             url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
-            response = requests.post(url, json=payload, headers=headers)
+            response = transport.request("POST", url, idempotent=True, json=payload, headers=headers)
+            if transport.is_pending_answer(response):
+                # No ResultCode yet: the customer has not answered the prompt
+                return response.json()
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            raise Exception(f"Payment status check failed: {str(e)}") 
\ No newline at end of file
+            if e.response is not None and e.response.status_code == 401:
+                token_cache.clear(self.base_url, self.consumer_key)
+            raise Exception(f"Payment status check failed: {str(e)}")
+
+
+class AsyncMpesaClient(BaseMpesaClient):
+    """MpesaClient for asyncio code: the same calls as coroutines, over httpx
+
+    Shares the cached token, circuit breaker and retry policy with the
+    synchronous client. It has no blocking counterparts (such as
+    access_token) to call by mistake.
+    """
+
+    async def get_access_token(self):
+        return await token_cache.aget_token(self.base_url, self.consumer_key, self.fetch_access_token)
+
+    async def fetch_access_token(self):
+        url, headers = self.token_request()
+        try:
+            response = await transport.arequest("GET", url, idempotent=True, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+            return data["access_token"], int(data.get("expires_in", 3599))
+        except httpx.HTTPError as e:
+            raise Exception(f"Failed to get access token: {str(e)}")
+
+    async def _post(self, path, payload, idempotent, error):
+        headers = self.api_headers(await self.get_access_token())
+        try:
+            response = await transport.arequest(
+                "POST", f"{self.base_url}{path}", idempotent=idempotent, json=payload, headers=headers
+            )
+            if transport.is_pending_answer(response):
+                # No ResultCode yet: the customer has not answered the prompt
+                return response.json()
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 401:
+                await token_cache.aclear(self.base_url, self.consumer_key)
+            raise Exception(f"{error}: {str(e)}")
+
+    async def stk_push(self, phone_number, amount, callback_url, account_reference, transaction_desc):
+        """Initiate STK Push transaction"""
+        payload = self.stk_push_payload(phone_number, amount, callback_url, account_reference, transaction_desc)
+        return await self._post("/mpesa/stkpush/v1/processrequest", payload, False, "STK push failed")
+
+    async def check_payment_status(self, checkout_request_id):
+        """Check payment status"""
+        payload = self.status_query_payload(checkout_request_id)
+        return await self._post("/mpesa/stkpushquery/v1/query", payload, True, "Payment status check failed")
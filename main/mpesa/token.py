@@ -0,0 +1,188 @@
+"""
+Shared M-Pesa OAuth token
+
+Daraja access tokens are valid for about an hour, so every worker reads the
+current token from the shared cache instead of requesting one per client.
+The token is refreshed MPESA_TOKEN_REFRESH_MARGIN seconds before it expires,
+by one process at a time: whoever wins a cache.add lock fetches it while the
+others keep using the still-valid old token, or, when there is none yet, wait
+for the winner to publish it.
+
+Counters for fetches, cache hits, waits and failed fetches are kept in the
+cache (see stats() and the mpesa_token_stats command).
+"""
+import asyncio
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY = 'mpesa:token:{}'
+LOCK_KEY = 'mpesa:token:lock:{}'
+STAT_KEYS = {
+    'fetches': 'mpesa:token:stats:fetches',
+    'hits': 'mpesa:token:stats:hits',
+    'waits': 'mpesa:token:stats:waits',
+    'errors': 'mpesa:token:stats:errors',
+}
+LOCK_TIMEOUT = 30
+WAIT_INTERVAL = 0.05
+
+
+def refresh_margin() -> int:
+    return getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 5 * 60)
+
+
+def _count(name: str):
+    key = STAT_KEYS[name]
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+async def _acount(name: str):
+    key = STAT_KEYS[name]
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        await cache.aadd(key, 0, None)
+        await cache.aincr(key)
+
+
+def _scope(base_url: str, consumer_key: str) -> str:
+    return hashlib.sha256(f'{base_url}|{consumer_key}'.encode()).hexdigest()[:32]
+
+
+def _entry(token: str, expires_in: int, started: float) -> dict:
+    """The cache entry for a freshly fetched token"""
+    logger.info(f"Fetched M-Pesa access token in {(time.perf_counter() - started) * 1000:.0f}ms")
+    expires_at = time.time() + expires_in
+    return {
+        'token': token,
+        'expires_at': expires_at,
+        'refresh_at': expires_at - min(refresh_margin(), expires_in / 2),
+    }
+
+
+def _fallback(cached, now):
+    """The token to keep using after a failed refresh, or None to re-raise"""
+    if cached and now < cached['expires_at']:
+        # Keep serving the old token; the next caller retries
+        logger.warning("M-Pesa token refresh failed; using the current token until it expires")
+        return cached['token']
+    return None
+
+
+def get_token(base_url: str, consumer_key: str, fetch) -> str:
+    """Return a valid access token for consumer_key, calling fetch() -> (token, expires_in) if needed"""
+    scope = _scope(base_url, consumer_key)
+    token_key = TOKEN_KEY.format(scope)
+    lock_key = LOCK_KEY.format(scope)
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    waited = False
+
+    while True:
+        cached = cache.get(token_key)
+        now = time.time()
+        if cached and now < cached['refresh_at']:
+            _count('hits')
+            return cached['token']
+
+        if cache.add(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                started = time.perf_counter()
+                try:
+                    token, expires_in = fetch()
+                except Exception:
+                    _count('errors')
+                    fallback = _fallback(cached, now)
+                    if fallback is None:
+                        raise
+                    return fallback
+                _count('fetches')
+                cache.set(token_key, _entry(token, expires_in, started), expires_in)
+                return token
+            finally:
+                cache.delete(lock_key)
+
+        # Someone else is refreshing
+        if cached and now < cached['expires_at']:
+            _count('hits')
+            return cached['token']
+        if not waited:
+            _count('waits')
+            waited = True
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for the M-Pesa access token")
+        time.sleep(WAIT_INTERVAL)
+
+
+async def aget_token(base_url: str, consumer_key: str, fetch) -> str:
+    """get_token for async callers; fetch is a coroutine function
+
+    Uses the async cache API, so a shared cache backend is never waited on
+    from the event loop.
+    """
+    scope = _scope(base_url, consumer_key)
+    token_key = TOKEN_KEY.format(scope)
+    lock_key = LOCK_KEY.format(scope)
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    waited = False
+
+    while True:
+        cached = await cache.aget(token_key)
+        now = time.time()
+        if cached and now < cached['refresh_at']:
+            await _acount('hits')
+            return cached['token']
+
+        if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                started = time.perf_counter()
+                try:
+                    token, expires_in = await fetch()
+                except Exception:
+                    await _acount('errors')
+                    fallback = _fallback(cached, now)
+                    if fallback is None:
+                        raise
+                    return fallback
+                await _acount('fetches')
+                await cache.aset(token_key, _entry(token, expires_in, started), expires_in)
+                return token
+            finally:
+                await cache.adelete(lock_key)
+
+        if cached and now < cached['expires_at']:
+            await _acount('hits')
+            return cached['token']
+        if not waited:
+            await _acount('waits')
+            waited = True
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for the M-Pesa access token")
+        await asyncio.sleep(WAIT_INTERVAL)
+
+
+def stats():
+    counters = cache.get_many(STAT_KEYS.values())
+    return {name: counters.get(key, 0) for name, key in STAT_KEYS.items()}
+
+
+def reset_stats():
+    cache.delete_many(STAT_KEYS.values())
+
+
+def clear(base_url: str, consumer_key: str):
+    """Forget the cached token, e.g. after the gateway rejected it"""
+    cache.delete(TOKEN_KEY.format(_scope(base_url, consumer_key)))
+
+
+async def aclear(base_url: str, consumer_key: str):
+    await cache.adelete(TOKEN_KEY.format(_scope(base_url, consumer_key)))
@@ -0,0 +1,273 @@
+"""
+HTTP transport for the M-Pesa client
+
+All Daraja calls go through one requests.Session per process, so TCP and TLS
+connections are kept alive and reused instead of being opened per call, and
+every call has MPESA_CONNECT_TIMEOUT/MPESA_READ_TIMEOUT timeouts, so a slow
+gateway can no longer hold a worker indefinitely.
+
+Idempotent calls (token requests, status queries) are retried up to
+MPESA_MAX_RETRIES times with full-jitter exponential backoff on timeouts,
+connection errors and 429/5xx responses. Calls that must not be repeated (STK
+push) are only retried when the connection could not be opened at all. The
+HTTP 500 Daraja uses to say a payment is still being processed
+(is_pending_answer) is an ordinary answer: it is neither retried nor counted
+against the breaker.
+
+A circuit breaker shared by all workers through the cache counts consecutive
+failed calls. After MPESA_BREAKER_THRESHOLD of them it opens and calls fail
+immediately with GatewayUnavailable for MPESA_BREAKER_RESET seconds; then one
+trial call is let through, and its outcome closes or re-opens the breaker.
+breaker.state() reports this for monitoring.
+
+arequest() applies the same policy for asyncio callers (AsyncMpesaClient)
+through one pooled httpx.AsyncClient per event loop.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Daraja answers an STK push query for a payment the customer has not
+# finished with HTTP 500 and this code; it is an answer, not an outage
+PENDING_ERROR_CODES = {'500.001.1001'}
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 2.0
+
+
+class GatewayUnavailable(Exception):
+    """Raised without calling the gateway while its circuit breaker is open"""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def timeouts():
+    return (_setting('MPESA_CONNECT_TIMEOUT', 3.05), _setting('MPESA_READ_TIMEOUT', 10))
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """The process-wide pooled session (a new one after fork)"""
+    pid = os.getpid()
+    with _sessions_lock:
+        if pid not in _sessions:
+            _sessions.clear()
+            http = requests.Session()
+            pool_size = _setting('MPESA_POOL_SIZE', 10)
+            # Retries are done in request() so they can honour the breaker
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            _sessions[pid] = http
+        return _sessions[pid]
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_client() -> httpx.AsyncClient:
+    """The pooled httpx client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        connect, read = timeouts()
+        limit = _setting('MPESA_ASYNC_MAX_CONNECTIONS', 200)
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def aclose():
+    """Close the running loop's pooled client, e.g. before a worker shuts its loop down"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with its state in the shared cache"""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures_key = f'breaker:{name}:failures'
+        self.open_until_key = f'breaker:{name}:open_until'
+        self.probe_key = f'breaker:{name}:probe'
+
+    @property
+    def threshold(self):
+        return _setting('MPESA_BREAKER_THRESHOLD', 5)
+
+    @property
+    def reset_timeout(self):
+        return _setting('MPESA_BREAKER_RESET', 30)
+
+    def before_call(self):
+        """Raise GatewayUnavailable unless a call may be made now"""
+        open_until = cache.get(self.open_until_key)
+        if open_until is None:
+            return
+        if time.time() < open_until:
+            raise GatewayUnavailable(f"{self.name} circuit open after repeated failures")
+        # Half-open: only one caller gets to try
+        if not cache.add(self.probe_key, 1, self.reset_timeout):
+            raise GatewayUnavailable(f"{self.name} circuit half-open; trial call in progress")
+
+    async def abefore_call(self):
+        """before_call() on the async cache API"""
+        open_until = await cache.aget(self.open_until_key)
+        if open_until is None:
+            return
+        if time.time() < open_until:
+            raise GatewayUnavailable(f"{self.name} circuit open after repeated failures")
+        if not await cache.aadd(self.probe_key, 1, self.reset_timeout):
+            raise GatewayUnavailable(f"{self.name} circuit half-open; trial call in progress")
+
+    def record_success(self):
+        cache.delete_many([self.failures_key, self.open_until_key, self.probe_key])
+
+    async def arecord_success(self):
+        await cache.adelete_many([self.failures_key, self.open_until_key, self.probe_key])
+
+    def record_failure(self):
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            cache.add(self.failures_key, 0, None)
+            failures = cache.incr(self.failures_key)
+        if failures >= self.threshold:
+            cache.set(self.open_until_key, time.time() + self.reset_timeout, None)
+            cache.delete(self.probe_key)
+            logger.error(f"{self.name} circuit opened after {failures} consecutive failures")
+
+    async def arecord_failure(self):
+        try:
+            failures = await cache.aincr(self.failures_key)
+        except ValueError:
+            await cache.aadd(self.failures_key, 0, None)
+            failures = await cache.aincr(self.failures_key)
+        if failures >= self.threshold:
+            await cache.aset(self.open_until_key, time.time() + self.reset_timeout, None)
+            await cache.adelete(self.probe_key)
+            logger.error(f"{self.name} circuit opened after {failures} consecutive failures")
+
+    def state(self) -> dict:
+        values = cache.get_many([self.failures_key, self.open_until_key])
+        open_until = values.get(self.open_until_key)
+        if open_until is None:
+            state = 'closed'
+        elif time.time() < open_until:
+            state = 'open'
+        else:
+            state = 'half-open'
+        return {
+            'name': self.name,
+            'state': state,
+            'consecutive_failures': values.get(self.failures_key, 0),
+            'retry_in': max(round(open_until - time.time(), 1), 0) if open_until else None,
+        }
+
+
+breaker = CircuitBreaker('mpesa')
+
+
+def is_pending_answer(response) -> bool:
+    """True for Daraja's "the transaction is being processed" reply (requests or httpx)"""
+    if response.status_code != 500:
+        return False
+    try:
+        return response.json().get('errorCode') in PENDING_ERROR_CODES
+    except (ValueError, AttributeError):
+        return False
+
+
+def _failed(response) -> bool:
+    return response.status_code in RETRY_STATUSES and not is_pending_answer(response)
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+    """Make a Daraja call through the pooled session, breaker and retry policy
+
+    Raises GatewayUnavailable if the breaker is open, otherwise returns the
+    final response (which may be an error status) or raises the final
+    requests exception.
+    """
+    breaker.before_call()
+    retries = _setting('MPESA_MAX_RETRIES', 2)
+    kwargs.setdefault('timeout', timeouts())
+    attempt = 0
+    while True:
+        response = error = None
+        try:
+            response = session().request(method, url, **kwargs)
+            failed = _failed(response)
+            retryable = idempotent and failed
+        except requests.exceptions.ConnectTimeout as e:
+            # Nothing reached the gateway, so even an STK push may be retried
+            error, failed, retryable = e, True, True
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error, failed, retryable = e, True, idempotent
+        if not retryable or attempt >= retries:
+            break
+        attempt += 1
+        time.sleep(_backoff(attempt))
+
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    if error is not None:
+        raise error
+    return response
+
+
+async def arequest(method: str, url: str, idempotent: bool, **kwargs) -> httpx.Response:
+    """request() for asyncio callers, over httpx and the async cache API"""
+    await breaker.abefore_call()
+    retries = _setting('MPESA_MAX_RETRIES', 2)
+    attempt = 0
+    while True:
+        response = error = None
+        try:
+            response = await async_client().request(method, url, **kwargs)
+            failed = _failed(response)
+            retryable = idempotent and failed
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            error, failed, retryable = e, True, True
+        except httpx.TransportError as e:
+            error, failed, retryable = e, True, idempotent
+        if not retryable or attempt >= retries:
+            break
+        attempt += 1
+        await asyncio.sleep(_backoff(attempt))
+
+    if failed:
+        await breaker.arecord_failure()
+    else:
+        await breaker.arecord_success()
+    if error is not None:
+        raise error
+    return response
@@ -0,0 +1,144 @@
+"""
+Order placement
+
+place_order turns a cart into an order in a fixed number of queries, however
+many lines the cart has: the cart's products are locked and priced with one
+SELECT ... FOR UPDATE, stock is decremented for all of them by one
+conditional UPDATE (see reservations.commit_cart), and the order items and
+inventory ledger rows are written with one bulk INSERT each.
+
+fulfil_payment places the order for a completed payment the same way, from
+the lines and payer recorded on the payment when it started, in the
+transaction that marks the payment completed (see main.payment_states), so
+the cart's reservations become stock decrements exactly once.
+"""
+import logging
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from . import reservations
+from .models import Cart, CartItem, InventoryMovement, Order, OrderItem, Product, TrackingUpdate
+
+logger = logging.getLogger(__name__)
+
+SHIPPING_COST = Decimal('10.00')
+
+
+class EmptyCart(Exception):
+    pass
+
+
+class AmountMismatch(Exception):
+    """The order would cost something other than what its payment covered"""
+
+    def __init__(self, amount, paid):
+        self.amount = amount
+        self.paid = paid
+        super().__init__(f"Order costs {amount} but {paid} was paid")
+
+
+def payment_tolerance(payment) -> Decimal:
+    # M-Pesa charges whole shillings (see mpesa.whole_shillings)
+    return Decimal('0.50') if payment.payment_method == 'mpesa' else Decimal('0.00')
+
+
+def place_order(cart, full_name, email, phone, address, shipping_cost=SHIPPING_COST, payment=None, lines=None):
+    """Create an order from cart, decrement stock and remove the ordered lines from the cart
+
+    lines is {product_id: quantity}, defaulting to the cart's items. An order
+    paid for by payment starts out processing rather than pending, and must
+    cost what was paid.
+
+    Raises EmptyCart, reservations.InsufficientStock if any line can no
+    longer be met, or AmountMismatch; nothing is written in any case.
+    """
+    with transaction.atomic():
+        if lines is None:
+            lines = dict(cart.items.values_list('product_id', 'quantity'))
+        if not lines:
+            raise EmptyCart()
+
+        # Locked in pk order, so concurrent checkouts cannot deadlock
+        prices = dict(
+            Product.objects.select_for_update()
+            .filter(pk__in=lines, available=True)
+            .order_by('pk')
+            .values_list('pk', 'price')
+        )
+        missing = {product_id: 0 for product_id in lines if product_id not in prices}
+        if missing:
+            raise reservations.InsufficientStock(missing)
+        reservations.commit_cart(cart, lines)
+
+        subtotal = sum((prices[product_id] * quantity for product_id, quantity in lines.items()), Decimal('0.00'))
+        if payment is not None and abs(subtotal + shipping_cost - payment.amount) > payment_tolerance(payment):
+            # Raising rolls back the stock decrements
+            raise AmountMismatch(subtotal + shipping_cost, payment.amount)
+        order = Order.objects.create(
+            user=cart.user,
+            full_name=full_name,
+            email=email,
+            phone=phone,
+            address=address,
+            amount=subtotal + shipping_cost,
+            status='processing' if payment else 'pending',
+            payment=payment,
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, quantity=quantity, price=prices[product_id])
+            for product_id, quantity in lines.items()
+        ])
+        InventoryMovement.objects.bulk_create([
+            InventoryMovement(product_id=product_id, quantity=-quantity, reason='sale', order=order)
+            for product_id, quantity in lines.items()
+        ])
+
+        CartItem.objects.filter(cart=cart, product_id__in=lines).delete()
+        if getattr(settings, 'CART_DENORMALIZED_TOTALS', False):
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
+    return order
+
+
+def fulfil_payment(payment):
+    """Place the order for a completed PaymentTransaction from the lines it paid for
+
+    Returns None, leaving the payment completed for staff to refund or fulfil
+    by hand, if it has no payer or lines, its stock has run out, or the lines
+    now cost something other than what was paid.
+    """
+    if payment.user_id is None:
+        logger.warning(f"No user for payment {payment.reference}; order not created")
+        return None
+    user = payment.user
+    cart, _ = Cart.objects.get_or_create(user=user)
+    try:
+        order = place_order(
+            cart,
+            full_name=payment.full_name or user.get_full_name() or user.username,
+            email=payment.customer_email or user.email,
+            phone=payment.customer_phone or '',
+            address=payment.shipping_address,
+            payment=payment,
+            lines={product_id: quantity for product_id, quantity in payment.lines},
+        )
+    except EmptyCart:
+        logger.warning(f"Payment {payment.reference} has no lines; order not created")
+        return None
+    except reservations.InsufficientStock as e:
+        logger.error(
+            f"Payment {payment.reference} completed but products {sorted(e.shortages)} are out of stock; "
+            "order not created"
+        )
+        return None
+    except AmountMismatch as e:
+        logger.error(f"Payment {payment.reference} completed but {e}; order not created")
+        return None
+    TrackingUpdate.objects.create(
+        order=order,
+        status='processing',
+        location='Processing Center',
+        description='Order received and being processed'
+    )
+    return order
@@ -0,0 +1,154 @@
+"""
+Keyset (cursor) pagination
+
+Pages are addressed by the sort key of the row next to them instead of an
+OFFSET, so fetching page 500 costs the same single index range scan as
+fetching page 1. Cursors are opaque URL-safe strings.
+"""
+import base64
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+@dataclass
+class KeysetPage:
+    object_list: List[Any]
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+
+def _cursor_value(value):
+    # Full microsecond precision; DjangoJSONEncoder would truncate to ms
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values, direction: str) -> str:
+    payload = json.dumps({'v': list(values), 'd': direction}, default=_cursor_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """Return (values, direction) from a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction = payload['v'], payload['d']
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(f"Malformed cursor: {str(e)}")
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise InvalidCursor('Malformed cursor')
+    return values, direction
+
+
+def get_page_size(request, default: int = DEFAULT_PAGE_SIZE) -> int:
+    """Read ?page_size= from the request, clamped to MAX_PAGE_SIZE"""
+    try:
+        size = int(request.GET.get('page_size', default))
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _seek_filter(ordering, values, forward: bool) -> Q:
+    """Build the row-value comparison (a, b) < (x, y) as nested Q objects"""
+    condition = Q()
+    for position in reversed(range(len(ordering))):
+        name = ordering[position].lstrip('-')
+        descending = ordering[position].startswith('-')
+        lookup = 'lt' if descending == forward else 'gt'
+        step = Q(**{f'{name}__{lookup}': values[position]})
+        if position < len(ordering) - 1:
+            step |= Q(**{name: values[position]}) & condition
+        condition = step
+    return condition
+
+
+def _key(obj, ordering):
+    return [getattr(obj, name.lstrip('-')) for name in ordering]
+
+
+def paginate_queryset(queryset, ordering, cursor: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE):
+    """Return one KeysetPage of queryset sorted by ordering
+
+    ordering must end in a unique field (normally ``-id``) so every row has a
+    distinct key, and should be backed by a composite index.
+    """
+    ordering = list(ordering)
+    forward = True
+    if cursor:
+        raw_values, direction = decode_cursor(cursor)
+        if len(raw_values) != len(ordering):
+            raise InvalidCursor('Cursor does not match this listing')
+        model_fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in ordering]
+        try:
+            values = [model_field.to_python(value) for model_field, value in zip(model_fields, raw_values)]
+        except Exception as e:
+            raise InvalidCursor(f"Malformed cursor: {str(e)}")
+        forward = direction == 'next'
+        queryset = queryset.filter(_seek_filter(ordering, values, forward))
+
+    if forward:
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+    else:
+        reverse = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+        rows = list(queryset.order_by(*reverse)[:page_size + 1])
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if not forward:
+        rows.reverse()
+
+    # Walking backwards, the row the cursor pointed at is still ahead of us
+    has_next = has_more if forward else True
+    has_previous = bool(cursor) if forward else has_more
+
+    page = KeysetPage(rows)
+    if rows and has_next:
+        page.next_cursor = encode_cursor(_key(rows[-1], ordering), 'next')
+    if rows and has_previous:
+        page.previous_cursor = encode_cursor(_key(rows[0], ordering), 'prev')
+    return page
+
+
+def paginate_list(items, cursor: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE):
+    """Paginate an already ranked, bounded list (such as search hits) by position"""
+    start = 0
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+            raise InvalidCursor('Cursor does not match this listing')
+        start = values[0] if direction == 'next' else max(values[0] - page_size, 0)
+
+    end = start + page_size
+    page = KeysetPage(list(items[start:end]))
+    if end < len(items):
+        page.next_cursor = encode_cursor([end], 'next')
+    if start > 0:
+        page.previous_cursor = encode_cursor([start], 'prev')
+    return page
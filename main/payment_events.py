@@ -0,0 +1,104 @@
+"""
+Payment status notifications
+
+Whatever changes a PaymentTransaction's status calls publish(reference) once
+the change is committed. That bumps a per-payment version counter in the
+cache and wakes the coroutines in this process that are waiting on the
+payment (the server-sent events stream of payment_status_events) straight
+away.
+
+Status changes usually happen in another process (the process_webhooks and
+reconcile_mpesa_payments workers), so every event loop with waiters also runs
+one poller that reads the version counters of all the payments it watches
+with a single cache.aget_many every POLL_INTERVAL seconds. Waiters only use
+the async cache API, so a shared backend is never waited on from the event
+loop. Across processes
+this needs a shared cache backend, as the M-Pesa token and breaker do.
+
+Waking up only means "look again": waiters re-read the transaction, so a
+spurious or missed wake-up costs at most one query or one poll interval.
+"""
+import asyncio
+import threading
+import weakref
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'payment:events:{}'
+VERSION_TTL = 60 * 60
+POLL_INTERVAL = 1.0
+
+_waiters = defaultdict(set)
+_waiters_lock = threading.Lock()
+_pollers = weakref.WeakKeyDictionary()
+
+
+class Waiter:
+    def __init__(self, reference: str, version: int):
+        self.reference = reference
+        self.version = version
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+
+async def aversion(reference: str) -> int:
+    return await cache.aget(VERSION_KEY.format(reference), 0)
+
+
+def publish(reference: str):
+    """Tell waiters in every process that the payment's status changed"""
+    key = VERSION_KEY.format(reference)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, VERSION_TTL)
+        cache.incr(key)
+    with _waiters_lock:
+        waiters = list(_waiters.get(reference, ()))
+    for waiter in waiters:
+        # publish() may run in a worker thread of the waiter's loop
+        waiter.loop.call_soon_threadsafe(waiter.event.set)
+
+
+def publish_on_commit(reference: str):
+    transaction.on_commit(lambda: publish(reference))
+
+
+async def _poll(loop):
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        with _waiters_lock:
+            mine = [waiter for waiters in _waiters.values() for waiter in waiters if waiter.loop is loop]
+        if not mine:
+            _pollers.pop(loop, None)
+            return
+        versions = await cache.aget_many({VERSION_KEY.format(waiter.reference) for waiter in mine})
+        for waiter in mine:
+            if versions.get(VERSION_KEY.format(waiter.reference), 0) != waiter.version:
+                waiter.event.set()
+
+
+async def wait(reference: str, since: int, timeout: float) -> int:
+    """Wait up to timeout seconds for the payment's version to move past since; returns the current version"""
+    waiter = Waiter(reference, since)
+    with _waiters_lock:
+        _waiters[reference].add(waiter)
+    if waiter.loop not in _pollers:
+        _pollers[waiter.loop] = waiter.loop.create_task(_poll(waiter.loop))
+    try:
+        # Published between the caller's read of `since` and registering
+        current = await aversion(reference)
+        if current != since:
+            return current
+        try:
+            await asyncio.wait_for(waiter.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return await aversion(reference)
+    finally:
+        with _waiters_lock:
+            _waiters[reference].discard(waiter)
+            if not _waiters[reference]:
+                del _waiters[reference]
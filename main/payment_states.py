@@ -0,0 +1,83 @@
+"""
+PaymentTransaction state machine
+
+A transaction changes status only through transition(): a single
+UPDATE ... SET status = <new> WHERE reference = ? AND status IN (<allowed>),
+whose row count says whether this caller made the change. The webhook worker,
+the reconciler and the views may race to settle the same payment; exactly one
+of them wins, and the others, like any redelivered event, cost one UPDATE
+that matches no rows.
+
+    pending -> processing -> completed
+    pending, processing -> failed
+
+complete() fulfils the payment (see orders.fulfil_payment) in the same
+database transaction as its transition, so a paid transaction gets its order
+and first TrackingUpdate exactly once. Order.payment is unique as well, as a
+backstop.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from . import orders, payment_events
+from .models import PaymentTransaction
+
+ALLOWED_FROM = {
+    'processing': ('pending',),
+    'completed': ('pending', 'processing'),
+    'failed': ('pending', 'processing'),
+}
+
+
+def _expected(references, status):
+    return PaymentTransaction.objects.filter(reference__in=references, status__in=ALLOWED_FROM[status])
+
+
+def transition(reference: str, status: str, **fields) -> bool:
+    """Move the transaction to status if its current status allows it; True if this call did"""
+    changed = _expected([reference], status).update(status=status, updated_at=timezone.now(), **fields)
+    if changed:
+        payment_events.publish_on_commit(reference)
+    return bool(changed)
+
+
+async def atransition(reference: str, status: str, **fields) -> bool:
+    """transition() for async views, which always autocommit"""
+    changed = await _expected([reference], status).aupdate(status=status, updated_at=timezone.now(), **fields)
+    if changed:
+        payment_events.publish(reference)
+    return bool(changed)
+
+
+def transition_many(references, status: str) -> int:
+    """transition() for many transactions in one UPDATE; returns how many moved
+
+    Only for transitions without side effects (not 'completed').
+    """
+    with transaction.atomic():
+        # Only the transactions that move get a wake-up
+        moving = list(_expected(list(references), status).select_for_update().values_list('reference', flat=True))
+        changed = _expected(moving, status).update(status=status, updated_at=timezone.now())
+    for reference in moving:
+        payment_events.publish_on_commit(reference)
+    return changed
+
+
+def complete(reference: str, **fields):
+    """Mark the transaction paid and fulfil it, once; returns the new Order, or None"""
+    with transaction.atomic():
+        if not transition(reference, 'completed', **fields):
+            return None
+        return orders.fulfil_payment(PaymentTransaction.objects.get(reference=reference))
+
+
+def fail(reference: str) -> bool:
+    return transition(reference, 'failed')
+
+
+def settle(reference: str, completed: bool):
+    """Apply a gateway's final word on a payment; repeats and late reports are no-ops"""
+    if completed:
+        complete(reference)
+    else:
+        fail(reference)
@@ -0,0 +1,76 @@
+"""
+Receipt QR codes and barcodes, rendered on first request and kept in the cache
+
+An image's URL carries what it encodes: its kind and data, signed with
+SECRET_KEY so the view only renders images a receipt page asked for. The
+receipt_image view serves the PNG from the cache, stored under the SHA-256
+of the kind, renderer version and data, and renders it again whenever the
+cache has lost it, so an evicted image costs one render rather than a broken
+receipt. The URL and the bytes behind it never change, so clients may cache
+them for good.
+"""
+import hashlib
+import io
+from typing import Optional, Tuple
+
+import barcode
+import qrcode
+from barcode.writer import ImageWriter
+from django.core import signing
+from django.core.cache import cache
+from django.urls import reverse
+
+# Bump when a renderer's output changes, so clients fetch the new images
+RENDER_VERSION = 1
+IMAGE_KEY = 'receipt_image:{}'
+# Not timestamped, so an image's URL is the same on every receipt page
+signer = signing.Signer(salt='main.receipt_images')
+
+
+def render_qr(data: str) -> bytes:
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_barcode(data: str) -> bytes:
+    buffer = io.BytesIO()
+    barcode.get_barcode_class('code128')(data, writer=ImageWriter()).write(buffer)
+    return buffer.getvalue()
+
+
+RENDERERS = {'qr': render_qr, 'barcode': render_barcode}
+
+
+def digest(kind: str, data: str) -> str:
+    return hashlib.sha256(f'{kind}:{RENDER_VERSION}:{data}'.encode()).hexdigest()
+
+
+def image_url(kind: str, data: str) -> str:
+    """URL of the kind ('qr' or 'barcode') image encoding data"""
+    token = signer.sign_object([kind, RENDER_VERSION, data], compress=True)
+    return reverse('main:receipt_image', args=[token])
+
+
+def load(token: str) -> Optional[Tuple[str, str]]:
+    """(kind, data) from an image_url token, or None if it is forged or out of date"""
+    try:
+        kind, version, data = signer.unsign_object(token)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if kind not in RENDERERS or version != RENDER_VERSION:
+        return None
+    return kind, data
+
+
+def get(kind: str, data: str) -> bytes:
+    """The PNG from the cache, rendered and stored again if it is not there"""
+    key = IMAGE_KEY.format(digest(kind, data))
+    png = cache.get(key)
+    if png is None:
+        png = RENDERERS[kind](data)
+        cache.set(key, png, None)
+    return png
@@ -0,0 +1,174 @@
+"""
+Reconciliation of pending M-Pesa payments
+
+An MpesaPayment whose callback never arrives stays Pending. reconcile() finds
+the ones that have been pending for longer than the STK prompt can stay open
+(with an index range scan on (status, created_at)) and asks Daraja for their
+outcome with the STK push status query.
+
+The queries run concurrently on one event loop through AsyncMpesaClient, at
+most `workers` at a time and no more than `rate` per second, so a large
+backlog neither floods Daraja nor trips its rate limits. Database work stays
+outside the event loop: each chunk is read with one query before the gateway
+calls and its outcomes are written afterwards with bulk updates. A payment
+settled by its callback in the meantime is left alone.
+
+Every pass is recorded as a ReconciliationRun with its counts and the gateway
+latency percentiles.
+"""
+import asyncio
+import logging
+import statistics
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import payment_states
+from .models import MpesaPayment, ReconciliationRun
+from .mpesa import transport
+from .mpesa.mpesa import AsyncMpesaClient
+from .mpesa.transport import GatewayUnavailable
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """Spaces calls on one event loop at least 1/rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        at = max(now, self.next_at)
+        self.next_at = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+def stale_payments(now, min_age: timedelta, max_age: timedelta):
+    """Pending payments old enough to have a final status, oldest first"""
+    return (
+        MpesaPayment.objects
+        .filter(status='Pending', created_at__lte=now - min_age, created_at__gte=now - max_age)
+        .exclude(checkout_request_id='')
+        .order_by('created_at', 'pk')
+    )
+
+
+async def query_all(payments, workers: int, limiter: RateLimiter):
+    """Status query results as [(payment, result or exception, seconds)]"""
+    client = AsyncMpesaClient()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def one(payment):
+        async with semaphore:
+            await limiter.wait()
+            started = time.perf_counter()
+            try:
+                result = await client.check_payment_status(payment.checkout_request_id)
+            except GatewayUnavailable as e:
+                # The breaker is open; don't count its instant refusals as latency
+                return payment, e, None
+            except Exception as e:
+                result = e
+            return payment, result, time.perf_counter() - started
+
+    return await asyncio.gather(*[one(payment) for payment in payments])
+
+
+def apply(results, now) -> dict:
+    """Write final statuses from query results; returns counts for the chunk"""
+    counts = {'completed': 0, 'failed': 0, 'still_pending': 0, 'errors': 0}
+    settled = {}
+    for payment, result, _ in results:
+        if isinstance(result, Exception):
+            counts['errors'] += 1
+            logger.warning(f"Status query for {payment.checkout_request_id} failed: {result}")
+            continue
+        code = result.get('ResultCode')
+        if code in (None, ''):
+            counts['still_pending'] += 1
+            continue
+        payment.status = 'Completed' if str(code) == '0' else 'Failed'
+        payment.result_code = str(code)[:5]
+        payment.result_description = result.get('ResultDesc', '')
+        payment.updated_at = now
+        settled[payment.pk] = payment
+    if not settled:
+        return counts
+
+    with transaction.atomic():
+        # Callbacks processed while we were querying win
+        still_open = set(
+            MpesaPayment.objects.select_for_update()
+            .filter(pk__in=settled, status='Pending')
+            .values_list('pk', flat=True)
+        )
+        payments = [payment for pk, payment in settled.items() if pk in still_open]
+        MpesaPayment.objects.bulk_update(payments, ['status', 'result_code', 'result_description', 'updated_at'])
+
+        # Failures move in one conditional UPDATE; completions one at a
+        # time, since each is fulfilled
+        payment_states.transition_many(
+            [payment.reference for payment in payments if payment.status == 'Failed'], 'failed'
+        )
+        for payment in payments:
+            if payment.status == 'Completed':
+                payment_states.complete(payment.reference)
+
+    for payment in payments:
+        counts['completed' if payment.status == 'Completed' else 'failed'] += 1
+    counts['still_pending'] += len(settled) - len(payments)
+    return counts
+
+
+def reconcile(min_age=timedelta(minutes=3), max_age=timedelta(days=1), batch_size=200,
+              workers=10, rate=5.0, now=None) -> ReconciliationRun:
+    """Query and settle every stale pending payment, a chunk of batch_size at a time"""
+    now = now or timezone.now()
+    run = ReconciliationRun.objects.create(started_at=timezone.now())
+    limiter = RateLimiter(rate)
+    latencies = []
+    last = None
+    # One loop for the whole pass, so its pooled connections are reused
+    # across chunks; the ORM is only used while it is not running
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            chunk = stale_payments(now, min_age, max_age)
+            if last is not None:
+                # Keyset pagination: rows that stay pending are not fetched twice
+                chunk = chunk.filter(created_at__gte=last.created_at).exclude(
+                    created_at=last.created_at, pk__lte=last.pk
+                )
+            chunk = list(chunk[:batch_size])
+            if not chunk:
+                break
+            last = chunk[-1]
+
+            results = loop.run_until_complete(query_all(chunk, workers, limiter))
+            latencies.extend(seconds for _, _, seconds in results if seconds is not None)
+            counts = apply(results, timezone.now())
+            run.checked += len(chunk)
+            for key, value in counts.items():
+                setattr(run, key, getattr(run, key) + value)
+            if any(isinstance(result, GatewayUnavailable) for _, result, _ in results):
+                logger.error("M-Pesa circuit open; stopping reconciliation until the next run")
+                break
+            if len(chunk) < batch_size:
+                break
+    finally:
+        loop.run_until_complete(transport.aclose())
+        loop.close()
+
+    if latencies:
+        latencies.sort()
+        run.latency_p50_ms = statistics.median(latencies) * 1000
+        run.latency_p95_ms = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        run.latency_max_ms = latencies[-1] * 1000
+    run.finished_at = timezone.now()
+    run.save()
+    return run
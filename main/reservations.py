@@ -0,0 +1,178 @@
+"""
+Time-limited stock reservations
+
+Opening checkout holds the cart's quantities for STOCK_RESERVATION_TTL
+seconds. While a hold is live it is subtracted from the product's
+available-to-sell figure, so other shoppers cannot check out the same units.
+Starting a payment renews the holds for its method's PAYMENT_RESERVATION_TTLS
+entry and ties them to the PaymentTransaction, and completing the payment
+turns them into real stock decrements in the same database transaction (see
+orders.fulfil_payment), so a hold is not released while the money for it is
+still in flight. Holds that are never converted simply stop counting once
+they expire or their payment fails, and are deleted in bulk by the
+release_expired_reservations command.
+
+Available-to-sell is always computed as ``stock - SUM(live holds)`` in the
+same query as the product, so reading it takes no locks.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import catalog_cache
+from .models import Product, StockReservation
+
+# Holds tied to a settled payment no longer count
+OPEN_PAYMENT_STATUSES = ('pending', 'processing')
+SETTLED_PAYMENT_STATUSES = ('completed', 'failed')
+
+
+class InsufficientStock(Exception):
+    """Raised with {product_id: units available} for the lines that cannot be met"""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(f"Insufficient stock for products {sorted(shortages)}")
+
+
+def reservation_ttl() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+def payment_reservation_ttl(payment) -> timedelta:
+    """How long holds renewed for payment last, by its payment method"""
+    ttls = getattr(settings, 'PAYMENT_RESERVATION_TTLS', {})
+    return timedelta(seconds=ttls.get(payment.payment_method, reservation_ttl().total_seconds()))
+
+
+def live_holds(now=None):
+    """Holds that still count: unexpired, and not for a failed or completed payment"""
+    return StockReservation.objects.filter(
+        models.Q(payment__isnull=True) | models.Q(payment__status__in=OPEN_PAYMENT_STATUSES),
+        expires_at__gt=now or timezone.now(),
+    )
+
+
+def reserved_quantity(exclude_cart=None):
+    """Units of OuterRef('pk') held by live reservations, optionally ignoring one cart's"""
+    holds = live_holds().filter(product=OuterRef('pk'))
+    if exclude_cart is not None:
+        holds = holds.exclude(cart=exclude_cart)
+    total = holds.order_by().values('product').annotate(total=Sum('quantity')).values('total')
+    return Coalesce(Subquery(total), Value(0), output_field=models.IntegerField())
+
+
+def available_expression(exclude_cart=None):
+    return Greatest(F('stock') - reserved_quantity(exclude_cart), Value(0), output_field=models.IntegerField())
+
+
+def with_available(queryset, exclude_cart=None):
+    """Annotate products with available_to_sell"""
+    return queryset.annotate(available_to_sell=available_expression(exclude_cart))
+
+
+def available_to_sell(product_ids) -> dict:
+    """{product_id: available units} in one query"""
+    return dict(with_available(Product.objects.filter(pk__in=product_ids)).values_list('pk', 'available_to_sell'))
+
+
+def reserve_cart(cart, payment=None, lines=None):
+    """Hold the cart's current quantities, replacing any holds it already has
+
+    With payment, the holds are tied to that PaymentTransaction and last its
+    method's PAYMENT_RESERVATION_TTLS entry rather than STOCK_RESERVATION_TTL.
+    Returns the expiry time, or raises InsufficientStock without holding
+    anything. The cart's products are locked only for the duration of this
+    short transaction, in primary key order so concurrent checkouts cannot
+    deadlock. lines is {product_id: quantity}, defaulting to the cart's
+    items.
+    """
+    if lines is None:
+        lines = dict(cart.items.values_list('product_id', 'quantity'))
+    expires_at = timezone.now() + (payment_reservation_ttl(payment) if payment else reservation_ttl())
+    with transaction.atomic():
+        StockReservation.objects.filter(cart=cart).delete()
+        products = Product.objects.select_for_update().filter(pk__in=lines, available=True).order_by('pk')
+        rows = list(with_available(products).values_list('pk', 'slug', 'available_to_sell'))
+        available = {pk: units for pk, _, units in rows}
+        shortages = {
+            product_id: available.get(product_id, 0)
+            for product_id, quantity in lines.items() if quantity > available.get(product_id, 0)
+        }
+        if shortages:
+            raise InsufficientStock(shortages)
+        StockReservation.objects.bulk_create([
+            StockReservation(
+                cart=cart, product_id=product_id, quantity=quantity, expires_at=expires_at, payment=payment
+            )
+            for product_id, quantity in lines.items()
+        ])
+        # Listings show stock, which a hold leaves alone; cached products are refreshed
+        catalog_cache.bump(*[f'product:{slug}' for _, slug, _ in rows])
+    return expires_at
+
+
+def release_cart(cart):
+    """Drop the cart's holds, e.g. when checkout is abandoned"""
+    StockReservation.objects.filter(cart=cart).delete()
+
+
+def commit_cart(cart, lines=None):
+    """Turn the cart's holds into stock decrements
+
+    lines is {product_id: quantity}, defaulting to the cart's items. All
+    products are decremented by one conditional UPDATE that only succeeds if
+    each product still has the quantity after other carts' live holds, so it
+    works whether or not this cart's own holds are still live. Raises
+    InsufficientStock (and changes nothing) otherwise.
+    """
+    if lines is None:
+        lines = dict(cart.items.values_list('product_id', 'quantity'))
+    if not lines:
+        return
+    quantity = Case(
+        *[When(pk=product_id, then=Value(units)) for product_id, units in lines.items()],
+        output_field=models.IntegerField(),
+    )
+    with transaction.atomic():
+        updated = (
+            Product.objects
+            .filter(pk__in=lines, stock__gte=quantity + reserved_quantity(exclude_cart=cart))
+            .update(stock=F('stock') - quantity, updated_at=timezone.now())
+        )
+        if updated != len(lines):
+            available = dict(
+                with_available(Product.objects.filter(pk__in=lines), exclude_cart=cart)
+                .values_list('pk', 'available_to_sell')
+            )
+            # Raising rolls back the rows that were decremented
+            raise InsufficientStock({
+                product_id: available.get(product_id, 0)
+                for product_id, units in lines.items() if units > available.get(product_id, 0)
+            })
+        StockReservation.objects.filter(cart=cart).delete()
+        # update() skips the signals that invalidate cached listings and products
+        placements = list(Product.objects.filter(pk__in=lines).order_by().values_list('category_id', 'slug'))
+        catalog_cache.bump(
+            'products',
+            *{f'category:{category_id}' for category_id, _ in placements},
+            *[f'product:{slug}' for _, slug in placements],
+        )
+
+
+def release_expired(batch_size=1000, now=None) -> int:
+    """Delete holds that no longer count in batches; returns how many were removed"""
+    now = now or timezone.now()
+    dead = StockReservation.objects.filter(
+        models.Q(expires_at__lte=now) | models.Q(payment__status__in=SETTLED_PAYMENT_STATUSES)
+    )
+    released = 0
+    while True:
+        ids = list(dead.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return released
+        released += StockReservation.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,160 @@
+"""
+Product full-text search
+
+SQLite keeps a separate FTS5 table (``main_product_fts``) whose rowid is the
+product id; it is refreshed from the Product post_save/post_delete signals.
+PostgreSQL uses a GIN expression index over the same tsvector expression that
+the query below matches on, so it needs no bookkeeping at all. Any other
+backend, or a database where the index has not been built yet, falls back to
+the ``icontains`` filter.
+"""
+import logging
+import re
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'main_product_fts'
+PG_DOCUMENT = "to_tsvector('english', coalesce(name, '') || ' ' || coalesce(description, ''))"
+
+SQLITE_CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    "USING fts5(name, description, tokenize='porter unicode61')"
+)
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_backend() -> str:
+    """Return which search implementation the current database supports"""
+    if connection.vendor == 'sqlite':
+        return 'fts5'
+    if connection.vendor == 'postgresql':
+        return 'tsvector'
+    return 'icontains'
+
+
+def _fts5_query(query: str) -> str:
+    """Turn free text into a safe FTS5 MATCH expression
+
+    Every term is quoted so FTS5 operators typed by users are matched
+    literally, and the last term is a prefix match for search-as-you-type.
+    """
+    terms = TERM_RE.findall(query)
+    if not terms:
+        return ''
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _ranked_ids(queryset, query: str, limit: int):
+    """Return the ids of products in queryset matching query, best match first
+
+    The queryset's filters run inside the ranked query (as an IN subquery), so
+    the limit applies to the products it allows rather than the whole catalog.
+    """
+    backend = search_backend()
+    allowed_sql, allowed_params = queryset.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        if backend == 'fts5':
+            match = _fts5_query(query)
+            if not match:
+                return []
+            # Name hits weigh ten times more than description hits
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({allowed_sql}) "
+                f"ORDER BY bm25({FTS_TABLE}, 10.0, 1.0) LIMIT %s",
+                [match, *allowed_params, limit],
+            )
+        else:
+            cursor.execute(
+                f"SELECT id FROM main_product "
+                f"WHERE {PG_DOCUMENT} @@ websearch_to_tsquery('english', %s) AND id IN ({allowed_sql}) "
+                f"ORDER BY ts_rank({PG_DOCUMENT}, websearch_to_tsquery('english', %s)) DESC, id "
+                f"LIMIT %s",
+                [query, *allowed_params, query, limit],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def icontains_search(queryset, query: str):
+    """Unindexed substring search, used when no search index is available"""
+    return queryset.filter(
+        Q(name__icontains=query) |
+        Q(description__icontains=query)
+    )
+
+
+def search_product_ids(queryset, query: str):
+    """Return the ids of products in queryset matching query, best match first
+
+    At most ``PRODUCT_SEARCH_LIMIT`` ids are returned, ranked by the index
+    among the products the queryset allows.
+    """
+    limit = getattr(settings, 'PRODUCT_SEARCH_LIMIT', 500)
+    if search_backend() != 'icontains':
+        try:
+            # Savepoint so a missing index does not poison ATOMIC_REQUESTS
+            with transaction.atomic():
+                return _ranked_ids(queryset, query, limit)
+        except DatabaseError as e:
+            logger.warning(f"Search index unavailable, falling back to icontains: {str(e)}")
+
+    return list(icontains_search(queryset, query).values_list('id', flat=True)[:limit])
+
+
+def products_in_order(queryset, ids):
+    """Fetch the given product ids from queryset, keeping the order of ids"""
+    products = queryset.in_bulk(ids)
+    return [products[product_id] for product_id in ids if product_id in products]
+
+
+def search_products(queryset, query: str):
+    """Return the products in queryset matching query as a list, best match first"""
+    return products_in_order(queryset, search_product_ids(queryset, query))
+
+
+def index_products(products):
+    """Insert or refresh the FTS5 rows for the given products"""
+    if search_backend() != 'fts5':
+        return
+    rows = [(product.id, product.name, product.description) for product in products]
+    if not rows:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+                rows,
+            )
+    except DatabaseError as e:
+        logger.warning(f"Could not update search index: {str(e)}")
+
+
+def unindex_products(product_ids):
+    """Drop the FTS5 rows for the given product ids"""
+    if search_backend() != 'fts5' or not product_ids:
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(pk,) for pk in product_ids])
+    except DatabaseError as e:
+        logger.warning(f"Could not update search index: {str(e)}")
+
+
+def rebuild_index():
+    """Rebuild the FTS5 table from scratch from the product table"""
+    if search_backend() != 'fts5':
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(SQLITE_CREATE_SQL)
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+            f"SELECT id, name, description FROM main_product"
+        )
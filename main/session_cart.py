@@ -0,0 +1,141 @@
+"""
+Anonymous carts kept in the cache
+
+Visitors who are not logged in get a cart stored entirely in the cache backend
+under a random token saved in their session, so browsing and editing the cart
+never writes to the database. When the visitor logs in (normally on the way to
+checkout) the cart is merged into their persistent Cart/CartItem rows with a
+single bulk upsert and the cache entry is dropped.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.crypto import get_random_string
+
+from .models import Cart, CartItem, Product
+
+SESSION_KEY = 'cart_token'
+CACHE_KEY = 'cart:anonymous:{}'
+
+
+def cart_timeout() -> int:
+    return getattr(settings, 'ANONYMOUS_CART_TIMEOUT', 60 * 60 * 24)
+
+
+class SessionCartItem:
+    """Mirrors the CartItem attributes the cart templates use
+
+    id is the product id: anonymous items have no row of their own, so the
+    cart endpoints address them by product.
+    """
+
+    def __init__(self, product, quantity):
+        self.id = product.id
+        self.product = product
+        self.quantity = quantity
+
+    @property
+    def total_price(self):
+        return self.quantity * self.product.price
+
+
+class SessionCart:
+    def __init__(self, request):
+        self.session = request.session
+        self.token = self.session.get(SESSION_KEY)
+        self.lines = cache.get(self.key, {}) if self.token else {}
+
+    @property
+    def key(self):
+        return CACHE_KEY.format(self.token)
+
+    def save(self):
+        if not self.token:
+            self.token = get_random_string(32)
+            self.session[SESSION_KEY] = self.token
+        cache.set(self.key, self.lines, cart_timeout())
+
+    def quantity(self, product_id) -> int:
+        return self.lines.get(str(product_id), 0)
+
+    def set(self, product_id, quantity):
+        """Set a product's quantity; zero or less removes it"""
+        if quantity > 0:
+            self.lines[str(product_id)] = quantity
+        else:
+            self.lines.pop(str(product_id), None)
+        self.save()
+
+    def add(self, product_id, quantity=1):
+        self.set(product_id, self.quantity(product_id) + quantity)
+
+    def remove(self, product_id):
+        self.set(product_id, 0)
+
+    def clear(self):
+        self.lines = {}
+        if self.token:
+            cache.delete(self.key)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def items(self):
+        """Cart lines with their products, loaded in one query"""
+        if not hasattr(self, '_items'):
+            products = Product.objects.select_related('category').in_bulk([int(pk) for pk in self.lines])
+            self._items = [
+                SessionCartItem(products[int(pk)], quantity)
+                for pk, quantity in self.lines.items() if int(pk) in products
+            ]
+        return self._items
+
+    @property
+    def total_items(self):
+        return sum(self.lines.values())
+
+    @property
+    def total_price(self):
+        return sum((item.total_price for item in self.items()), Decimal('0.00'))
+
+
+def merge_into_user_cart(request, user):
+    """Move the anonymous cart into user's persistent cart
+
+    Quantities are added to whatever the user's cart already holds (capped at
+    the product's stock) and written with one INSERT ... ON CONFLICT DO UPDATE.
+    """
+    session_cart = SessionCart(request)
+    if not session_cart.lines:
+        return
+    with transaction.atomic():
+        cart, created = Cart.objects.select_for_update().get_or_create(user=user)
+        existing = dict(
+            CartItem.objects.filter(cart=cart, product_id__in=[int(pk) for pk in session_cart.lines])
+            .values_list('product_id', 'quantity')
+        )
+        stock = dict(
+            Product.objects.filter(pk__in=[int(pk) for pk in session_cart.lines], available=True)
+            .values_list('pk', 'stock')
+        )
+        items = [
+            CartItem(
+                cart=cart,
+                product_id=product_id,
+                quantity=min(existing.get(product_id, 0) + quantity, stock[product_id]),
+            )
+            for product_id, quantity in ((int(pk), quantity) for pk, quantity in session_cart.lines.items())
+            if stock.get(product_id)
+        ]
+        CartItem.objects.bulk_create(
+            items,
+            update_conflicts=True,
+            unique_fields=['cart', 'product'],
+            update_fields=['quantity', 'updated_at'],
+        )
+        if getattr(settings, 'CART_DENORMALIZED_TOTALS', False):
+            # bulk_create does not send the signals that maintain them
+            Cart.objects.filter(pk=cart.pk).refresh_totals()
+    session_cart.clear()
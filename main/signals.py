@@ -0,0 +1,94 @@
+"""
+Model signal handlers for the main app
+"""
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import catalog_cache, images, search, session_cart
+from .models import Cart, CartItem, Category, InventoryMovement, Product
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    """Keep the product search index in sync with saved products"""
+    search.index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    """Remove deleted products from the search index"""
+    search.unindex_products([instance.pk])
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_placement(sender, instance, **kwargs):
+    """Note the stored category, slug, price and stock so a change also updates what used the old ones"""
+    instance._catalog_previous = None
+    if instance.pk:
+        instance._catalog_previous = (
+            Product.objects.filter(pk=instance.pk).values_list('category_id', 'slug', 'price', 'stock').first()
+        )
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    """Bump the catalog cache versions a product change affects"""
+    scopes = {'products', f'category:{instance.category_id}', f'product:{instance.slug}'}
+    previous = getattr(instance, '_catalog_previous', None)
+    if previous:
+        scopes.update({f'category:{previous[0]}', f'product:{previous[1]}'})
+    catalog_cache.bump(*scopes)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    """Bump the catalog cache versions a category change affects"""
+    # Listings and product pages show the category name
+    catalog_cache.bump('categories', 'products', f'category:{instance.pk}')
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+def generate_image_variants(sender, instance, **kwargs):
+    """Build resized derivatives when an image is uploaded or replaced"""
+    if getattr(settings, 'IMAGE_DERIVATIVES_ON_SAVE', True):
+        images.update_variants(instance)
+
+
+@receiver(post_save, sender=Product)
+def record_stock_change(sender, instance, created, **kwargs):
+    """Record stock edited through save() (e.g. in the admin) in the inventory ledger"""
+    previous = getattr(instance, '_catalog_previous', None)
+    change = int(instance.stock) - (previous[3] if previous else 0)
+    if change:
+        InventoryMovement.objects.create(product=instance, quantity=change, reason='adjustment')
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def refresh_cart_totals(sender, instance, **kwargs):
+    """Keep the denormalized cart totals in step with the cart's items"""
+    # Bulk deletes (a queryset, or the cart itself) refresh once on their own
+    if kwargs.get('origin', instance) is not instance:
+        return
+    if getattr(settings, 'CART_DENORMALIZED_TOTALS', False):
+        Cart.objects.filter(pk=instance.cart_id).refresh_totals()
+
+
+@receiver(post_save, sender=Product)
+def reprice_carts(sender, instance, created, **kwargs):
+    """Refresh the denormalized totals of carts holding a product whose price changed"""
+    previous = getattr(instance, '_catalog_previous', None)
+    if getattr(settings, 'CART_DENORMALIZED_TOTALS', False) and previous and previous[2] != instance.price:
+        Cart.objects.filter(items__product=instance).refresh_totals()
+
+
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    """Move the cart a visitor built before logging in into their account"""
+    if request is not None:
+        session_cart.merge_into_user_cart(request, user)
@@ -0,0 +1,37 @@
+from django import template
+from django.utils.html import format_html
+
+from main.images import srcset
+
+register = template.Library()
+
+DEFAULT_SIZES = '(max-width: 576px) 100vw, (max-width: 992px) 50vw, 33vw'
+
+
+@register.simple_tag
+def responsive_image(obj, alt='', sizes=DEFAULT_SIZES, css_class='', loading='lazy'):
+    """Render obj.image as a <picture> with WebP and JPEG srcsets.
+
+    Falls back to a plain <img> of the original upload until derivatives
+    have been generated for it.
+    """
+    if not obj.image:
+        return ''
+    manifest = obj.image_variants or {}
+    storage = obj.image.storage
+    if manifest.get('source') != obj.image.name:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" loading="{}">',
+            obj.image.url, alt, css_class, loading
+        )
+
+    largest = str(manifest['widths'][-1])
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" class="{}" loading="{}">'
+        '</picture>',
+        srcset(manifest, 'webp', storage), sizes,
+        storage.url(manifest['jpeg'][largest]), srcset(manifest, 'jpeg', storage), sizes,
+        manifest['width'], manifest['height'], alt, css_class, loading
+    )
@@ -1,3 +1,556 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import requests
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import redirect
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import (
+    catalog_cache, gateways, idempotency, payment_events, payment_states, receipt_images, reservations, views,
+    webhooks,
+)
+from .search import search_product_ids
+from .models import (
+    Cart, CartItem, Category, InventoryMovement, MpesaPayment, Order, PaymentTransaction, Product,
+    StockReservation, WebhookEvent,
+)
+from .mpesa import token as mpesa_token
+from .mpesa import transport
+from .mpesa.mpesa import AsyncMpesaClient, MpesaClient
+
+
+class AddQuantityConcurrencyTests(TransactionTestCase):
+    """CartItem.objects.add_quantity from several threads at once, each with its own connection"""
+
+    threads = 8
+
+    def setUp(self):
+        category = Category.objects.create(name='Tools', slug='tools')
+        self.product = Product.objects.create(
+            category=category, name='Hammer', slug='hammer', price='10.00', stock=100, available=True
+        )
+        self.cart = Cart.objects.create(user=User.objects.create_user('shopper', 'shopper@example.com', 'pw'))
+
+    def add_concurrently(self, quantity):
+        barrier = threading.Barrier(self.threads)
+        results = []
+        errors = []
+
+        def add():
+            try:
+                barrier.wait()
+                results.append(CartItem.objects.add_quantity(self.cart, self.product, quantity))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=add) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_no_lost_updates(self):
+        results = self.add_concurrently(3)
+        self.assertEqual(results, [True] * self.threads)
+        self.assertEqual(CartItem.objects.get(cart=self.cart, product=self.product).quantity, 3 * self.threads)
+
+    def test_stock_is_never_exceeded(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=20)
+        self.product.refresh_from_db()
+        results = self.add_concurrently(3)
+        # Six adds of 3 fit in a stock of 20; the other two are refused
+        self.assertEqual(results.count(True), 6)
+        self.assertEqual(CartItem.objects.get(cart=self.cart, product=self.product).quantity, 18)
+
+
+class PaymentFulfilmentTests(TestCase):
+    """Completing a payment places the order from the payer's cart"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Tools', slug='tools')
+        self.product = Product.objects.create(
+            category=category, name='Hammer', slug='hammer', price='10.00', stock=5, available=True
+        )
+        self.cart = Cart.objects.create(user=User.objects.create_user('shopper', 'shopper@example.com', 'pw'))
+        CartItem.objects.add_quantity(self.cart, self.product, 2)
+        reservations.reserve_cart(self.cart)
+        self.payment = PaymentTransaction.objects.create(
+            payment_method='mpesa', amount='30.00', reference='PAY-1', customer_phone='254712345678',
+            customer_email='shopper@example.com', user=self.cart.user, lines=[[self.product.pk, 2]],
+            full_name='Jane Shopper', shipping_address='1 Main St, Nairobi',
+        )
+
+    def test_holds_become_the_order(self):
+        order = payment_states.complete('PAY-1')
+        self.assertEqual(order.payment, self.payment)
+        self.assertEqual(order.status, 'processing')
+        self.assertEqual((order.full_name, order.address), ('Jane Shopper', '1 Main St, Nairobi'))
+        self.assertEqual(list(order.items.values_list('product_id', 'quantity')), [(self.product.pk, 2)])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(self.cart.items.exists())
+        self.assertEqual(InventoryMovement.objects.get(order=order, reason='sale').quantity, -2)
+        # A repeated completion is a no-op
+        self.assertIsNone(payment_states.complete('PAY-1'))
+
+    def test_payment_keeps_holds_past_checkout_ttl(self):
+        reservations.reserve_cart(self.cart, payment=self.payment)
+        later = timezone.now() + timedelta(hours=1)
+        self.assertEqual(reservations.release_expired(now=later), 0)
+        self.assertEqual(payment_states.complete('PAY-1').items.get().quantity, 2)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_hold_ttl_depends_on_payment_method(self):
+        paypal = PaymentTransaction.objects.create(payment_method='paypal', amount='30.00', reference='PAY-2')
+        with self.settings(PAYMENT_RESERVATION_TTLS={'mpesa': 86400, 'paypal': 3600}):
+            expires_at = reservations.reserve_cart(self.cart, payment=paypal)
+            self.assertLessEqual(expires_at, timezone.now() + timedelta(hours=1))
+            # An abandoned PayPal payment no longer holds the stock after its TTL
+            later = timezone.now() + timedelta(hours=2)
+            self.assertEqual(reservations.release_expired(now=later), 1)
+
+    def test_failed_payment_releases_holds(self):
+        reservations.reserve_cart(self.cart, payment=self.payment)
+        self.assertEqual(reservations.available_to_sell([self.product.pk]), {self.product.pk: 3})
+        payment_states.fail('PAY-1')
+        self.assertEqual(reservations.available_to_sell([self.product.pk]), {self.product.pk: 5})
+        self.assertEqual(reservations.release_expired(), 1)
+
+    def test_order_has_what_was_paid_for(self):
+        # Another account with the same email, and a cart changed after paying
+        User.objects.create_user('other', 'shopper@example.com', 'pw')
+        CartItem.objects.add_quantity(self.cart, self.product, 1)
+        order = payment_states.complete('PAY-1')
+        self.assertEqual(order.user, self.cart.user)
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertEqual(order.amount, Decimal('30.00'))
+
+    def test_amount_mismatch_is_refused(self):
+        Product.objects.filter(pk=self.product.pk).update(price='12.00')
+        with self.assertLogs('main.orders', 'ERROR'):
+            self.assertIsNone(payment_states.complete('PAY-1'))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_sold_out_cart_leaves_the_payment_for_staff(self):
+        StockReservation.objects.all().delete()
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        with self.assertLogs('main.orders', 'ERROR'):
+            self.assertIsNone(payment_states.complete('PAY-1'))
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertTrue(self.cart.items.exists())
+
+
+class SearchTests(TestCase):
+    """Full-text search ranks within the products a listing allows"""
+
+    def setUp(self):
+        self.tools = Category.objects.create(name='Tools', slug='tools')
+        self.garden = Category.objects.create(name='Garden', slug='garden')
+        for n in range(3):
+            Product.objects.create(
+                category=self.tools, name=f'Hammer {n}', slug=f'hammer-{n}', price='10.00', stock=5, available=True
+            )
+        self.rake = Product.objects.create(
+            category=self.garden, name='Rake', slug='rake', description='Hangs next to a hammer',
+            price='10.00', stock=5, available=True,
+        )
+
+    def test_category_hits_outside_the_catalog_top_hits(self):
+        # The FTS5 index answers, not the icontains fallback
+        with self.settings(PRODUCT_SEARCH_LIMIT=2), self.assertNoLogs('main.search', 'WARNING'):
+            self.assertEqual(search_product_ids(Product.objects.filter(category=self.garden), 'hammer'), [self.rake.pk])
+            self.assertEqual(len(search_product_ids(Product.objects.all(), 'hammer')), 2)
+
+    def test_name_hits_rank_first(self):
+        ids = search_product_ids(Product.objects.filter(available=True), 'hammer')
+        self.assertEqual(ids[-1], self.rake.pk)
+        self.assertEqual(len(ids), 4)
+
+
+class ImportCatalogTests(TestCase):
+    """import_catalog upserts products and invalidates what they moved out of"""
+
+    def run_import(self, *rows):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as handle:
+            handle.write(''.join(json.dumps(row) + '\n' for row in rows))
+        self.addCleanup(os.remove, handle.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_catalog', handle.name, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_reimport_into_another_category(self):
+        self.run_import({
+            'name': 'Hammer', 'slug': 'hammer', 'category': 'tools',
+            'description': 'Steel', 'price': '10', 'stock': 5,
+        })
+        tools = Category.objects.get(slug='tools')
+        scopes = [f'category:{tools.pk}', 'product:hammer']
+        before = catalog_cache.get_versions(scopes)
+
+        # Columns the row leaves out keep their values
+        self.run_import({'name': 'Hammer', 'slug': 'hammer', 'category': 'garden'})
+        product = Product.objects.get(slug='hammer')
+        self.assertEqual(product.category.slug, 'garden')
+        self.assertEqual((product.description, product.price, product.stock), ('Steel', Decimal('10.00'), 5))
+        after = catalog_cache.get_versions(scopes)
+        self.assertTrue(all(after[scope] > before[scope] for scope in scopes))
+        self.assertEqual(InventoryMovement.objects.filter(product=product, reason='import').count(), 1)
+
+
+class PaymentEventsTests(TestCase):
+    """Status changes wake the payment's waiters, and only those that changed"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_transition_many_publishes_only_moved_payments(self):
+        PaymentTransaction.objects.create(payment_method='mpesa', amount='10.00', reference='PAY-1')
+        PaymentTransaction.objects.create(payment_method='mpesa', amount='10.00', reference='PAY-2', status='completed')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(payment_states.transition_many(['PAY-1', 'PAY-2'], 'failed'), 1)
+        self.assertEqual(asyncio.run(payment_events.aversion('PAY-1')), 1)
+        self.assertEqual(asyncio.run(payment_events.aversion('PAY-2')), 0)
+
+    def test_waiter_is_woken_by_publish(self):
+        async def wait_for_publish():
+            asyncio.get_running_loop().call_later(0.05, payment_events.publish, 'PAY-1')
+            started = time.monotonic()
+            current = await payment_events.wait('PAY-1', 0, 5)
+            return current, time.monotonic() - started
+
+        current, waited = asyncio.run(wait_for_publish())
+        self.assertEqual(current, 1)
+        self.assertLess(waited, 1)
+
+
+class WebhookBatchTests(TestCase):
+    """process_batch retries failing events with backoff and gives up after MAX_ATTEMPTS"""
+
+    def setUp(self):
+        self.callback = {'Body': {'stkCallback': {
+            'CheckoutRequestID': 'ws_CO_1', 'ResultCode': 0, 'ResultDesc': 'Processed',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QK1'}]},
+        }}}
+        payload = json.dumps(self.callback).encode()
+        webhooks.receive('mpesa', webhooks.mpesa_event_id(self.callback, payload), payload)
+        self.now = timezone.now()
+
+    def test_callback_before_initiation_is_retried(self):
+        # The callback overtook the initiation's commit
+        self.assertEqual(webhooks.process_batch(now=self.now), {'processed': 0, 'retried': 1, 'failed': 0})
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+        self.assertEqual(event.next_attempt_at, self.now + timedelta(seconds=webhooks.BACKOFF_BASE))
+        self.assertIn('DoesNotExist', event.last_error)
+
+        PaymentTransaction.objects.create(payment_method='mpesa', amount='10.00', reference='PAY-1')
+        MpesaPayment.objects.create(reference='PAY-1', amount='10.00', checkout_request_id='ws_CO_1')
+        # Not due yet
+        later = self.now + timedelta(seconds=webhooks.BACKOFF_BASE - 1)
+        self.assertEqual(webhooks.process_batch(now=later)['processed'], 0)
+
+        later = self.now + timedelta(seconds=webhooks.BACKOFF_BASE)
+        self.assertEqual(webhooks.process_batch(now=later), {'processed': 1, 'retried': 0, 'failed': 0})
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts, event.last_error), ('processed', 2, ''))
+        self.assertEqual(MpesaPayment.objects.get().transaction_id, 'QK1')
+        self.assertEqual(PaymentTransaction.objects.get().status, 'completed')
+
+    def test_backoff_doubles_then_gives_up(self):
+        now = self.now
+        for attempt in range(1, webhooks.MAX_ATTEMPTS):
+            self.assertEqual(webhooks.process_batch(now=now)['retried'], 1)
+            event = WebhookEvent.objects.get()
+            self.assertEqual(event.next_attempt_at - now, webhooks.backoff(attempt))
+            now = event.next_attempt_at
+        self.assertEqual(webhooks.backoff(2), 2 * webhooks.backoff(1))
+        self.assertEqual(webhooks.backoff(webhooks.MAX_ATTEMPTS), timedelta(seconds=webhooks.BACKOFF_MAX))
+
+        with self.assertLogs('main.webhooks', 'ERROR'):
+            self.assertEqual(webhooks.process_batch(now=now), {'processed': 0, 'retried': 0, 'failed': 1})
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('failed', webhooks.MAX_ATTEMPTS))
+        self.assertEqual(webhooks.process_batch(now=now + timedelta(days=1))['failed'], 0)
+
+    def test_redelivery_is_dropped(self):
+        payload = json.dumps(self.callback).encode()
+        webhooks.receive('mpesa', webhooks.mpesa_event_id(self.callback, payload), payload)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+
+class StubDarajaHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self.send_json(404, {})
+        self.send_json(200, self.server.issue_token())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Authorization', '').removeprefix('Bearer ') not in self.server.valid_tokens:
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+        self.send_json(200, {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_test'})
+
+
+class StubDaraja(ThreadingHTTPServer):
+    """Local stand-in for Daraja's OAuth endpoint and STK push, counting token requests"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubDarajaHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, expires_in=3599, delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.token_requests = 0
+        self.valid_tokens = set()
+
+    def issue_token(self):
+        time.sleep(self.delay)
+        with self.lock:
+            self.token_requests += 1
+            token = f'token-{self.token_requests}'
+            self.valid_tokens.add(token)
+        return {'access_token': token, 'expires_in': str(self.expires_in)}
+
+
+class MpesaTokenTests(SimpleTestCase):
+    """The shared OAuth token, against a stub Daraja on a local port"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.daraja = StubDaraja()
+        threading.Thread(target=cls.daraja.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.daraja.shutdown()
+        cls.daraja.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        overrides = self.settings(
+            MPESA_BASE_URL=self.daraja.url,
+            MPESA_CONSUMER_KEY='key',
+            MPESA_CONSUMER_SECRET='secret',
+            MPESA_SHORTCODE='174379',
+            MPESA_PASSKEY='passkey',
+            MPESA_TOKEN_REFRESH_MARGIN=300,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.daraja.reset()
+        cache.clear()
+
+    def test_concurrent_callers_share_one_fetch(self):
+        self.daraja.reset(delay=0.3)
+        barrier = threading.Barrier(8)
+        tokens = []
+
+        def get_token():
+            barrier.wait()
+            tokens.append(MpesaClient().get_access_token())
+
+        workers = [threading.Thread(target=get_token) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(tokens, ['token-1'] * 8)
+        self.assertEqual(self.daraja.token_requests, 1)
+        self.assertEqual(mpesa_token.stats()['fetches'], 1)
+
+    def test_cached_token_is_reused(self):
+        client = MpesaClient()
+        self.assertEqual(client.get_access_token(), 'token-1')
+        self.assertEqual(MpesaClient().get_access_token(), 'token-1')
+        self.assertEqual(self.daraja.token_requests, 1)
+        self.assertEqual(mpesa_token.stats()['hits'], 1)
+
+    def test_async_client_shares_the_token(self):
+        async def get_token():
+            try:
+                return await AsyncMpesaClient().get_access_token()
+            finally:
+                await transport.aclose()
+
+        self.assertEqual(asyncio.run(get_token()), 'token-1')
+        self.assertEqual(MpesaClient().get_access_token(), 'token-1')
+        self.assertEqual(asyncio.run(get_token()), 'token-1')
+        self.assertEqual(self.daraja.token_requests, 1)
+        self.assertEqual(mpesa_token.stats(), {'fetches': 1, 'hits': 2, 'waits': 0, 'errors': 0})
+
+    def test_refreshes_before_expiry(self):
+        # A 2s token is refreshed after half its life, while it is still valid
+        self.daraja.reset(expires_in=2)
+        self.assertEqual(MpesaClient().get_access_token(), 'token-1')
+        time.sleep(1.1)
+        self.assertEqual(MpesaClient().get_access_token(), 'token-2')
+        self.assertEqual(self.daraja.token_requests, 2)
+
+    def test_refetches_after_401(self):
+        client = MpesaClient()
+        client.stk_push('0712345678', 10, 'https://example.com/cb', 'REF1', 'Test')
+        # The gateway revokes the token before it expires
+        self.daraja.valid_tokens.clear()
+        with self.assertRaisesMessage(Exception, 'STK push failed'):
+            client.stk_push('0712345678', 10, 'https://example.com/cb', 'REF2', 'Test')
+        response = client.stk_push('0712345678', 10, 'https://example.com/cb', 'REF3', 'Test')
+        self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(self.daraja.token_requests, 2)
+
+
+class PayPalTimeoutTests(SimpleTestCase):
+    """PayPal SDK calls give up on a server that never answers"""
+
+    def test_hung_server_times_out(self):
+        # Accepts connections but never reads or answers them
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        api = gateways.PayPalApi(
+            mode='sandbox', client_id='id', client_secret='secret',
+            endpoint=f'http://127.0.0.1:{listener.getsockname()[1]}', timeout=0.5,
+        )
+        started = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            gateways.call('paypal', api.get_access_token)
+        self.assertLess(time.monotonic() - started, 5)
+
+
+class ReceiptImageTests(SimpleTestCase):
+    """Receipt images are served from their signed URL, cached or not"""
+
+    def fetch(self, url):
+        token = url.rsplit('/', 1)[1].removesuffix('.png')
+        return views.receipt_image(RequestFactory().get(url), token)
+
+    def test_rendered_again_after_eviction(self):
+        url = receipt_images.image_url('barcode', 'TRK-0123456789AB')
+        self.assertEqual(receipt_images.image_url('barcode', 'TRK-0123456789AB'), url)
+        first = self.fetch(url)
+        self.assertEqual(first['Content-Type'], 'image/png')
+        cache.clear()
+        second = self.fetch(url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_forged_url_is_not_found(self):
+        url = receipt_images.image_url('qr', 'https://example.com/orders/TRK-1/')
+        with self.assertRaises(Http404):
+            self.fetch(url.replace('.png', 'x.png'))
+
+
+class IdempotencyReplayTests(TestCase):
+    """@idempotent stores a response once and replays it for retries with the same key"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'pw')
+        self.calls = 0
+        cache.clear()
+
+    def view(self, response):
+        def view(request):
+            self.calls += 1
+            return response()
+        view.__name__ = f'view_{self.id().rsplit(".", 1)[1]}'
+        return idempotency.idempotent(view)
+
+    def post(self, view, body=b'{"amount": 10}', key='key-1'):
+        request = RequestFactory().post(
+            '/pay/', body, content_type='application/json', headers={'Idempotency-Key': key}
+        )
+        request.user = self.user
+        return view(request)
+
+    def test_redirect_is_replayed(self):
+        view = self.view(lambda: redirect('/orders/TRK-1/'))
+        self.post(view)
+        replayed = self.post(view)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((replayed.status_code, replayed['Location']), (302, '/orders/TRK-1/'))
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+
+    def test_success_is_replayed_with_its_body(self):
+        view = self.view(lambda: JsonResponse({'reference': 'PAY-1'}))
+        self.post(view)
+        replayed = self.post(view)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(json.loads(replayed.content), {'reference': 'PAY-1'})
+
+    def test_server_error_may_be_retried(self):
+        view = self.view(lambda: HttpResponse(status=500))
+        self.post(view)
+        self.assertEqual(self.post(view).status_code, 500)
+        self.assertEqual(self.calls, 2)
+
+    def test_throttled_request_may_be_retried(self):
+        view = self.view(lambda: HttpResponse(status=429))
+        self.post(view)
+        self.post(view)
+        self.assertEqual(self.calls, 2)
+
+    def test_marked_server_error_is_replayed(self):
+        view = self.view(lambda: idempotency.always_store(JsonResponse({'reference': 'PAY-1'}, status=500)))
+        self.post(view)
+        replayed = self.post(view)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((replayed.status_code, json.loads(replayed.content)), (500, {'reference': 'PAY-1'}))
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        view = self.view(lambda: JsonResponse({}))
+        self.post(view)
+        self.assertEqual(self.post(view, body=b'{"amount": 20}').status_code, 422)
+        self.assertEqual(self.calls, 1)
+
+    def test_replayed_from_the_database_after_cache_eviction(self):
+        view = self.view(lambda: redirect('/orders/TRK-1/'))
+        self.post(view)
+        cache.clear()
+        self.assertEqual(self.post(view)['Location'], '/orders/TRK-1/')
+        self.assertEqual(self.calls, 1)
+
+    def test_in_flight_key_gets_409(self):
+        def view(request):
+            self.calls += 1
+            return self.post(wrapped)
+        view.__name__ = 'view_in_flight'
+        wrapped = idempotency.idempotent(view)
+        self.assertEqual(self.post(wrapped).status_code, 409)
+        self.assertEqual(self.calls, 1)
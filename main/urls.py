@@ -9,16 +9,27 @@ urlpatterns = [
     path('products/<slug:slug>/', views.product_detail, name='product_detail'),
     path('cart/', views.cart_detail, name='cart_detail'),
     path('cart/add/<int:product_id>/', views.cart_add, name='cart_add'),
+    path('cart/items/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:product_id>/', views.cart_remove, name='cart_remove'),
+    path('cart/items/<int:item_id>/update/', views.update_cart, name='update_cart'),
+    path('cart/items/<int:item_id>/remove/', views.remove_from_cart, name='remove_from_cart'),
+    path('cart/batch/', views.cart_batch, name='cart_batch'),
     path('wishlist/', views.wishlist_detail, name='wishlist_detail'),
     path('wishlist/add/<int:product_id>/', views.wishlist_add, name='wishlist_add'),
     path('wishlist/remove/<int:product_id>/', views.wishlist_remove, name='wishlist_remove'),
     path('checkout/', views.checkout, name='checkout'),
     path('payment/initiate/', views.initiate_payment, name='initiate_payment'),
     path('payment/process/', views.process_payment, name='process_payment'),
+    path('payment/status/<str:reference>/', views.check_payment_status, name='check_payment_status'),
+    path('payment/async/initiate/', views.initiate_payment_async, name='initiate_payment_async'),
+    path('payment/async/status/<str:reference>/', views.check_payment_status_async, name='check_payment_status_async'),
+    path('payment/events/<str:reference>/', views.payment_status_events, name='payment_status_events'),
     path('payment/callback/', views.payment_callback, name='payment_callback'),
+    path('health/mpesa/', views.mpesa_health, name='mpesa_health'),
     path('orders/', views.order_history, name='order_history'),
     path('orders/<str:tracking_number>/', views.track_order_detail, name='track_order_detail'),
+    path('orders/<str:tracking_number>/receipt/', views.order_receipt, name='order_receipt'),
+    path('receipts/images/<str:token>.png', views.receipt_image, name='receipt_image'),
     path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
     path('paypal/callback/', views.paypal_callback, name='paypal_callback'),
     path('stripe/webhook/', views.stripe_webhook, name='stripe_webhook'),
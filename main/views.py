@@ -1,20 +1,35 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse, HttpResponse
+from django.urls import reverse
+from django.http import Http404, JsonResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_http_methods
 from django.core.validators import validate_email, URLValidator
 from django.core.exceptions import ValidationError
 from django.utils.html import escape
 from django.conf import settings
 from django.core.cache import cache
+from django.db.transaction import non_atomic_requests
 from django.utils.crypto import get_random_string
+from asgiref.sync import sync_to_async
+from rest_framework.authentication import CSRFCheck
 from rest_framework.decorators import api_view, permission_classes, throttle_classes
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.throttling import UserRateThrottle, ScopedRateThrottle
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.throttling import UserRateThrottle
 from rest_framework.response import Response
 from rest_framework import status
-from .mpesa.mpesa import MpesaClient
-from .models import MpesaPayment, PaymentTransaction, Order, Product, Category, Cart, CartItem, Wishlist, TrackingUpdate
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from . import catalog_cache, gateways, orders, payment_events, payment_states, receipt_images, reservations, webhooks
+from .idempotency import always_store, idempotent
+from .mpesa import token as mpesa_token
+from .mpesa.mpesa import AsyncMpesaClient, MpesaClient, whole_shillings
+from .mpesa.transport import GatewayUnavailable, breaker as mpesa_breaker
+from .pagination import InvalidCursor, get_page_size, paginate_list, paginate_queryset
+from .search import products_in_order, search_product_ids
+from .session_cart import SessionCart
+from .models import MpesaPayment, PaymentTransaction, Order, Product, Category, Cart, CartItem, Wishlist
+import asyncio
 import json
 import re
 import paypalrestsdk
@@ -23,32 +38,44 @@ import hmac
 import hashlib
 import logging
 from datetime import datetime, timedelta
+from functools import partial, wraps
 from typing import Optional, Dict, Any
 from django.contrib.auth.decorators import login_required
-from django.template.loader import get_template
+from django.template.loader import get_template, render_to_string
 from django.utils import timezone
-import qrcode
-import barcode
-from barcode.writer import ImageWriter
 import io
 from PIL import Image
 from django.contrib import messages
-from django.db.models import Q
+from django.db.models import Count, Max
 from decimal import Decimal
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 # Configure payment gateways
-paypalrestsdk.configure({
+paypal_options = {
     "mode": settings.PAYPAL_MODE,
     "client_id": settings.PAYPAL_CLIENT_ID,
     "client_secret": settings.PAYPAL_CLIENT_SECRET
-})
+}
+if settings.PAYPAL_API_BASE:
+    paypal_options["endpoint"] = settings.PAYPAL_API_BASE
+paypal_api = gateways.PayPalApi(paypal_options, timeout=settings.PAYPAL_NETWORK_TIMEOUT)
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
+if settings.STRIPE_API_BASE:
+    stripe.api_base = settings.STRIPE_API_BASE
+stripe.default_http_client = stripe.RequestsClient(timeout=settings.STRIPE_NETWORK_TIMEOUT)
 
-class PaymentRateThrottle(ScopedRateThrottle):
+PAYPAL_APPROVAL_URL_KEY = 'paypal:approval_url:{}'
+
+# Keyset orderings; each is backed by a composite index on its model
+PRODUCT_LIST_ORDERING = ('-created_at', '-id')
+ORDER_HISTORY_ORDERING = ('-created', '-id')
+
+class PaymentRateThrottle(UserRateThrottle):
+    # A ScopedRateThrottle would need throttle_scope on the view and
+    # otherwise lets everything through
     scope = 'payment'
 
 def generate_transaction_reference() -> str:
@@ -151,62 +178,43 @@ def index(request):
     return render(request, 'index.html')
 
 @csrf_exempt
+@non_atomic_requests
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 @throttle_classes([PaymentRateThrottle])
+@idempotent
 def initiate_payment(request):
     """Initiate payment based on selected payment method"""
     try:
-        # Validate request body
-        try:
-            data = json.loads(request.body)
-        except json.JSONDecodeError:
-            return JsonResponse({
-                'error': 'Invalid JSON payload'
-            }, status=400)
-
-        # Get and validate payment method
-        payment_method = data.get('payment_method', '').lower()
-        if not payment_method or payment_method not in settings.ALLOWED_PAYMENT_METHODS:
-            return JsonResponse({
-                'error': 'Invalid payment method'
-            }, status=400)
-
-        # Validate amount
-        amount = data.get('amount')
-        if not validate_amount(amount):
-            return JsonResponse({
-                'error': 'Invalid amount'
-            }, status=400)
-
-        # Rate limit check using cache
-        cache_key = f"payment_attempt_{request.user.id}"
-        attempts = cache.get(cache_key, 0)
-        if attempts >= 10:  # Max 10 attempts per minute
-            return JsonResponse({
-                'error': 'Too many payment attempts. Please try again later.'
-            }, status=429)
-        cache.set(cache_key, attempts + 1, 60)  # 1 minute expiry
+        data, error = parse_payment_request(request)
+        if error:
+            return error
 
         # Generate unique reference
         reference = generate_transaction_reference()
 
         # Create initial transaction record
         transaction = PaymentTransaction.objects.create(
-            payment_method=payment_method,
-            amount=amount,
+            payment_method=data['payment_method'],
+            amount=data['amount'],
             status='pending',
             reference=reference,
             customer_phone=data.get('phone_number'),
-            customer_email=request.user.email
+            customer_email=request.user.email,
+            user=request.user,
+            full_name=data['full_name'],
+            shipping_address=data['shipping_address']
         )
+        error = hold_cart_for_payment(request.user, transaction)
+        if error:
+            return error
 
         # Process payment based on method
-        if payment_method == 'mpesa':
+        if transaction.payment_method == 'mpesa':
             return initiate_mpesa_payment(request, transaction)
-        elif payment_method == 'paypal':
+        elif transaction.payment_method == 'paypal':
             return initiate_paypal_payment(request, transaction)
-        elif payment_method == 'card':
+        elif transaction.payment_method == 'card':
             return initiate_card_payment(request, transaction)
 
     except Exception as e:
@@ -215,6 +223,85 @@ def initiate_payment(request):
             'error': 'An error occurred while processing your payment'
         }, status=500)
 
+def shipping_details(source):
+    """(contact, address) from the checkout form's fields in source, a QueryDict or a JSON body"""
+    contact = {field: str(source.get(field) or '').strip() for field in ('full_name', 'email', 'phone')}
+    address = ', '.join(filter(None, (
+        str(source.get(field) or '').strip() for field in ('address', 'city', 'state', 'postal_code', 'country')
+    )))
+    return contact, address
+
+def parse_payment_request(request):
+    """Validate a payment initiation body; returns (data, None) or (None, error response)
+
+    The checkout form's shipping fields are collected into data['full_name']
+    and data['shipping_address'], for the order placed when the payment
+    completes. Also applies the per-user limit of 10 attempts a minute.
+    """
+    # Validate request body
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return None, JsonResponse({
+            'error': 'Invalid JSON payload'
+        }, status=400)
+
+    # Get and validate payment method
+    payment_method = str(data.get('payment_method', '')).lower()
+    if not payment_method or payment_method not in settings.ALLOWED_PAYMENT_METHODS:
+        return None, JsonResponse({
+            'error': 'Invalid payment method'
+        }, status=400)
+    data['payment_method'] = payment_method
+
+    # Validate amount
+    if not validate_amount(data.get('amount')):
+        return None, JsonResponse({
+            'error': 'Invalid amount'
+        }, status=400)
+    if payment_method == 'mpesa':
+        # M-Pesa charges whole shillings; the transaction records what is charged
+        data['amount'] = whole_shillings(data['amount'])
+        if data['amount'] <= 0:
+            return None, JsonResponse({
+                'error': 'Invalid amount'
+            }, status=400)
+
+    contact, data['shipping_address'] = shipping_details(data)
+    data['full_name'] = contact['full_name'][:100]
+
+    # Rate limit check using cache
+    cache_key = f"payment_attempt_{request.user.id}"
+    attempts = cache.get(cache_key, 0)
+    if attempts >= 10:  # Max 10 attempts per minute
+        return None, JsonResponse({
+            'error': 'Too many payment attempts. Please try again later.'
+        }, status=429)
+    cache.set(cache_key, attempts + 1, 60)  # 1 minute expiry
+    return data, None
+
+def hold_cart_for_payment(user, transaction: PaymentTransaction):
+    """Record the user's cart lines on the payment and renew their holds for it
+
+    The holds then last until the payment settles, and completing it turns
+    the recorded lines into the order (see orders.fulfil_payment). Returns an
+    error response if the stock has gone.
+    """
+    cart = Cart.objects.filter(user=user).first()
+    if cart is None:
+        return None
+    lines = dict(cart.items.values_list('product_id', 'quantity'))
+    transaction.lines = sorted(lines.items())
+    transaction.save(update_fields=['lines'])
+    try:
+        reservations.reserve_cart(cart, payment=transaction, lines=lines)
+    except reservations.InsufficientStock:
+        payment_states.fail(transaction.reference)
+        return JsonResponse({
+            'error': 'Sorry, some items in your cart are no longer in stock'
+        }, status=409)
+    return None
+
 def initiate_mpesa_payment(request, transaction: PaymentTransaction):
     """Initiate M-Pesa payment"""
     try:
@@ -223,8 +310,7 @@ def initiate_mpesa_payment(request, transaction: PaymentTransaction):
         
         # Validate phone number
         if not validate_phone_number(phone_number):
-            transaction.status = 'failed'
-            transaction.save()
+            payment_states.fail(transaction.reference)
             return JsonResponse({
                 'error': 'Invalid phone number'
             }, status=400)
@@ -250,6 +336,7 @@ def initiate_mpesa_payment(request, transaction: PaymentTransaction):
                 phone_number=phone_number,
                 amount=transaction.amount,
                 reference=transaction.reference,
+                checkout_request_id=response.get('CheckoutRequestID', ''),
                 description="Payment for logistics services",
                 status='Pending'
             )
@@ -260,19 +347,25 @@ def initiate_mpesa_payment(request, transaction: PaymentTransaction):
                 'checkout_request_id': response.get('CheckoutRequestID')
             })
         else:
-            transaction.status = 'failed'
-            transaction.save()
+            payment_states.fail(transaction.reference)
             return JsonResponse({
                 'error': response.get('ResponseDescription', 'Payment initiation failed')
             }, status=400)
             
+    except GatewayUnavailable as e:
+        logger.warning(f"M-Pesa payment refused: {str(e)}")
+        payment_states.fail(transaction.reference)
+        return JsonResponse({
+            'error': 'M-Pesa is temporarily unavailable. Please try again shortly.'
+        }, status=503)
     except Exception as e:
         logger.error(f"M-Pesa payment error: {str(e)}")
-        transaction.status = 'failed'
-        transaction.save()
-        return JsonResponse({
-            'error': str(e)
-        }, status=500)
+        payment_states.fail(transaction.reference)
+        # The push may have reached the customer; a retry must not send another
+        return always_store(JsonResponse({
+            'error': str(e),
+            'reference': transaction.reference
+        }, status=500))
 
 def initiate_paypal_payment(request, transaction: PaymentTransaction):
     """Initiate PayPal payment"""
@@ -295,9 +388,17 @@ def initiate_paypal_payment(request, transaction: PaymentTransaction):
                 "description": "Wave Logistics Services",
                 "custom": transaction.reference
             }]
-        })
+        }, api=paypal_api)
 
-        if payment.create():
+        try:
+            created = gateways.call(
+                'paypal', payment.create,
+                on_late=partial(finish_paypal_payment, transaction.reference, payment),
+            )
+        except gateways.DeadlineExceeded:
+            return payment_pending_response(transaction)
+
+        if created:
             # Extract approval URL
             approval_url = next(link.href for link in payment.links if link.rel == "approval_url")
             
@@ -307,19 +408,38 @@ def initiate_paypal_payment(request, transaction: PaymentTransaction):
                 'approval_url': approval_url
             })
         else:
-            transaction.status = 'failed'
-            transaction.save()
+            payment_states.fail(transaction.reference)
             return JsonResponse({
                 'error': payment.error
             }, status=400)
             
+    except gateways.GatewayBusy as e:
+        logger.warning(f"PayPal payment refused: {str(e)}")
+        payment_states.fail(transaction.reference)
+        return gateway_busy_response('PayPal')
     except Exception as e:
         logger.error(f"PayPal payment error: {str(e)}")
-        transaction.status = 'failed'
-        transaction.save()
-        return JsonResponse({
-            'error': str(e)
-        }, status=500)
+        payment_states.fail(transaction.reference)
+        # The gateway may have acted on the call; a retry must not repeat it
+        return always_store(JsonResponse({
+            'error': str(e),
+            'reference': transaction.reference
+        }, status=500))
+
+def finish_paypal_payment(reference, payment, created, error):
+    """Apply a PayPal payment creation that outlived its request
+
+    The approval URL is published with the payment's status (see
+    payment_status_data), so a client following payment_status_events can
+    still send the customer to PayPal.
+    """
+    if error is not None or not created:
+        logger.error(f"Late PayPal payment creation failed for {reference}: {error or payment.error}")
+        payment_states.fail(reference)
+        return
+    approval_url = next(link.href for link in payment.links if link.rel == "approval_url")
+    cache.set(PAYPAL_APPROVAL_URL_KEY.format(reference), approval_url, 3 * 60 * 60)
+    payment_events.publish(reference)
 
 def initiate_card_payment(request, transaction: PaymentTransaction):
     """Initiate card payment using Stripe"""
@@ -328,27 +448,29 @@ def initiate_card_payment(request, transaction: PaymentTransaction):
         token = data.get('token')
         
         if not token:
-            transaction.status = 'failed'
-            transaction.save()
+            payment_states.fail(transaction.reference)
             return JsonResponse({
                 'error': 'Card token is required'
             }, status=400)
             
         # Create Stripe charge
-        charge = stripe.Charge.create(
-            amount=int(transaction.amount * 100),  # Convert to cents
-            currency='usd',
-            source=token,
-            description='Wave Logistics Services',
-            metadata={
-                'reference': transaction.reference
-            }
-        )
+        try:
+            charge = gateways.call(
+                'stripe', stripe.Charge.create,
+                amount=int(transaction.amount * 100),  # Convert to cents
+                currency='usd',
+                source=token,
+                description='Wave Logistics Services',
+                metadata={
+                    'reference': transaction.reference
+                },
+                on_late=partial(finish_card_payment, transaction.reference),
+            )
+        except gateways.DeadlineExceeded:
+            return payment_pending_response(transaction)
         
         if charge.paid:
-            transaction.status = 'completed'
-            transaction.transaction_id = charge.id
-            transaction.save()
+            payment_states.complete(transaction.reference, transaction_id=charge.id)
             
             return JsonResponse({
                 'status': 'success',
@@ -356,182 +478,259 @@ def initiate_card_payment(request, transaction: PaymentTransaction):
                 'charge_id': charge.id
             })
         else:
-            transaction.status = 'failed'
-            transaction.save()
+            payment_states.fail(transaction.reference)
             return JsonResponse({
                 'error': 'Payment failed'
             }, status=400)
             
     except stripe.error.CardError as e:
         logger.error(f"Stripe card error: {str(e)}")
-        transaction.status = 'failed'
-        transaction.save()
+        payment_states.fail(transaction.reference)
         return JsonResponse({
             'error': str(e.error.message)
         }, status=400)
+    except gateways.GatewayBusy as e:
+        logger.warning(f"Card payment refused: {str(e)}")
+        payment_states.fail(transaction.reference)
+        return gateway_busy_response('The card processor')
     except Exception as e:
         logger.error(f"Stripe payment error: {str(e)}")
-        transaction.status = 'failed'
-        transaction.save()
+        payment_states.fail(transaction.reference)
+        # The gateway may have acted on the call; a retry must not repeat it
+        return always_store(JsonResponse({
+            'error': str(e),
+            'reference': transaction.reference
+        }, status=500))
+
+def finish_card_payment(reference, charge, error):
+    """Apply a Stripe charge that outlived its request"""
+    if error is None and charge.paid:
+        payment_states.complete(reference, transaction_id=charge.id)
+    else:
+        logger.error(f"Late Stripe charge failed for {reference}: {error}")
+        payment_states.fail(reference)
+
+def payment_pending_response(transaction):
+    """Answer for a gateway call still running after its deadline
+
+    The transaction is parked as processing; the client follows it on
+    payment_status_events.
+    """
+    payment_states.transition(transaction.reference, 'processing')
+    return JsonResponse({
+        'status': 'processing',
+        'reference': transaction.reference,
+        'events_url': reverse('main:payment_status_events', args=[transaction.reference])
+    }, status=202)
+
+def gateway_busy_response(gateway):
+    response = JsonResponse({
+        'error': f'{gateway} is busy. Please try again shortly.'
+    }, status=503)
+    response['Retry-After'] = '5'
+    return response
+
+def async_api_view(view):
+    """Authenticate an async API view the way DRF would for initiate_payment
+
+    A JWT bearer token is tried first, then the session (with DRF's CSRF
+    check). Async views cannot run under ATOMIC_REQUESTS, so they are also
+    marked non-atomic; their writes autocommit.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.headers.get('Authorization', '').startswith('Bearer '):
+            try:
+                result = await sync_to_async(JWTAuthentication().authenticate)(request)
+            except AuthenticationFailed:
+                result = None
+            user = result[0] if result else None
+        else:
+            user = await request.auser()
+            if user.is_authenticated:
+                reason = CSRFCheck(lambda request: None).process_view(request, None, (), {})
+                if reason is not None:
+                    return JsonResponse({'detail': 'CSRF Failed'}, status=403)
+        if user is None or not user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        request.user = user
+        return await view(request, *args, **kwargs)
+
+    return csrf_exempt(non_atomic_requests(wrapper))
+
+def async_throttle(*throttle_classes):
+    """Apply DRF throttles to an async view below @async_api_view, as @throttle_classes does"""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            for throttle_class in throttle_classes:
+                throttle = throttle_class()
+                # DRF throttles use the sync cache API; keep it off the event loop
+                if not await sync_to_async(throttle.allow_request)(request, view):
+                    throttled = Throttled(throttle.wait())
+                    response = JsonResponse({'detail': str(throttled.detail)}, status=throttled.status_code)
+                    if throttled.wait is not None:
+                        response['Retry-After'] = str(throttled.wait)
+                    return response
+            return await view(request, *args, **kwargs)
+
+        return wrapper
+    return decorator
+
+@require_http_methods(["POST"])
+@async_api_view
+@async_throttle(PaymentRateThrottle)
+@idempotent
+async def initiate_payment_async(request):
+    """initiate_payment for ASGI workers
+
+    The M-Pesa STK push is awaited on the shared httpx pool instead of holding
+    a worker thread, so one worker can keep hundreds of pushes in flight.
+    PayPal and Stripe SDK calls still run in a thread.
+    """
+    try:
+        # Its attempt limit uses the sync cache API
+        data, error = await sync_to_async(parse_payment_request)(request)
+        if error:
+            return error
+
+        transaction = await PaymentTransaction.objects.acreate(
+            payment_method=data['payment_method'],
+            amount=data['amount'],
+            status='pending',
+            reference=generate_transaction_reference(),
+            customer_phone=data.get('phone_number'),
+            customer_email=request.user.email,
+            user=request.user,
+            full_name=data['full_name'],
+            shipping_address=data['shipping_address']
+        )
+        error = await sync_to_async(hold_cart_for_payment)(request.user, transaction)
+        if error:
+            return error
+
+        if transaction.payment_method == 'mpesa':
+            return await initiate_mpesa_payment_async(request, data, transaction)
+        elif transaction.payment_method == 'paypal':
+            return await sync_to_async(initiate_paypal_payment)(request, transaction)
+        elif transaction.payment_method == 'card':
+            return await sync_to_async(initiate_card_payment)(request, transaction)
+
+    except Exception as e:
+        logger.error(f"Payment initiation error: {str(e)}")
         return JsonResponse({
-            'error': str(e)
+            'error': 'An error occurred while processing your payment'
         }, status=500)
 
+async def initiate_mpesa_payment_async(request, data, transaction: PaymentTransaction):
+    """initiate_mpesa_payment on AsyncMpesaClient"""
+    phone_number = data.get('phone_number')
+    if not validate_phone_number(phone_number or ''):
+        await payment_states.atransition(transaction.reference, 'failed')
+        return JsonResponse({
+            'error': 'Invalid phone number'
+        }, status=400)
+
+    try:
+        response = await AsyncMpesaClient().stk_push(
+            phone_number=phone_number,
+            amount=transaction.amount,
+            callback_url=request.build_absolute_uri('/mpesa/callback/'),
+            account_reference=transaction.reference,
+            transaction_desc="Payment for logistics services"
+        )
+    except GatewayUnavailable as e:
+        logger.warning(f"M-Pesa payment refused: {str(e)}")
+        await payment_states.atransition(transaction.reference, 'failed')
+        return JsonResponse({
+            'error': 'M-Pesa is temporarily unavailable. Please try again shortly.'
+        }, status=503)
+    except Exception as e:
+        logger.error(f"M-Pesa payment error: {str(e)}")
+        await payment_states.atransition(transaction.reference, 'failed')
+        # The push may have reached the customer; a retry must not send another
+        return always_store(JsonResponse({
+            'error': str(e),
+            'reference': transaction.reference
+        }, status=500))
+
+    if response.get('ResponseCode') != '0':
+        await payment_states.atransition(transaction.reference, 'failed')
+        return JsonResponse({
+            'error': response.get('ResponseDescription', 'Payment initiation failed')
+        }, status=400)
+
+    await MpesaPayment.objects.acreate(
+        phone_number=phone_number,
+        amount=transaction.amount,
+        reference=transaction.reference,
+        checkout_request_id=response.get('CheckoutRequestID', ''),
+        description="Payment for logistics services",
+        status='Pending'
+    )
+    return JsonResponse({
+        'status': 'success',
+        'reference': transaction.reference,
+        'checkout_request_id': response.get('CheckoutRequestID')
+    })
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@non_atomic_requests
 def mpesa_callback(request):
-    """Handle M-Pesa payment callback"""
+    """Queue a verified M-Pesa callback for process_webhooks"""
+    if not verify_webhook_signature(request, settings.MPESA_WEBHOOK_SECRET):
+        logger.error("Invalid M-Pesa callback signature")
+        return HttpResponse(status=400)
     try:
-        # Verify callback signature
-        if not verify_webhook_signature(request, settings.MPESA_WEBHOOK_SECRET):
-            logger.error("Invalid M-Pesa callback signature")
-            return HttpResponse(status=400)
-            
-        # Parse callback data
         data = json.loads(request.body)
-        checkout_request_id = data.get('CheckoutRequestID')
-        
-        # Get M-Pesa payment
-        mpesa_payment = get_object_or_404(MpesaPayment, checkout_request_id=checkout_request_id)
-        transaction = mpesa_payment.transaction
-        
-        # Update payment status
-        result_code = data.get('ResultCode')
-        if result_code == '0':  # Success
-            transaction.status = 'completed'
-            # Create or update order
-            create_or_update_order(transaction)
-        else:
-            transaction.status = 'failed'
-            
-        transaction.save()
-        
-        # Update M-Pesa payment details
-        mpesa_payment.result_code = str(result_code)
-        mpesa_payment.result_description = data.get('ResultDesc', '')
-        mpesa_payment.save()
-        
-        return HttpResponse(status=200)
-        
-    except Exception as e:
-        logger.error(f"M-Pesa callback error: {str(e)}")
-        return HttpResponse(status=500)
+    except json.JSONDecodeError:
+        return HttpResponse(status=400)
+    webhooks.receive('mpesa', webhooks.mpesa_event_id(data, request.body), request.body)
+    return HttpResponse(status=200)
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@non_atomic_requests
 def paypal_callback(request):
-    """Handle PayPal payment callback"""
+    """Queue a verified PayPal callback for process_webhooks"""
+    if not verify_webhook_signature(request, settings.PAYPAL_WEBHOOK_SECRET):
+        logger.error("Invalid PayPal callback signature")
+        return HttpResponse(status=400)
     try:
-        # Verify callback signature
-        if not verify_webhook_signature(request, settings.PAYPAL_WEBHOOK_SECRET):
-            logger.error("Invalid PayPal callback signature")
-            return HttpResponse(status=400)
-            
-        # Parse callback data
         data = json.loads(request.body)
-        reference = data.get('custom_id')  # Transaction reference stored in custom_id
-        
-        # Get transaction
-        transaction = get_object_or_404(PaymentTransaction, reference=reference)
-        
-        # Update payment status based on PayPal event type
-        event_type = data.get('event_type')
-        if event_type == 'PAYMENT.CAPTURE.COMPLETED':
-            transaction.status = 'completed'
-            # Create or update order
-            create_or_update_order(transaction)
-        elif event_type in ['PAYMENT.CAPTURE.DENIED', 'PAYMENT.CAPTURE.DECLINED']:
-            transaction.status = 'failed'
-            
-        transaction.save()
-        
-        return HttpResponse(status=200)
-        
-    except Exception as e:
-        logger.error(f"PayPal callback error: {str(e)}")
-        return HttpResponse(status=500)
+    except json.JSONDecodeError:
+        return HttpResponse(status=400)
+    webhooks.receive('paypal', str(data.get('id') or webhooks.payload_event_id(request.body)), request.body)
+    return HttpResponse(status=200)
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@non_atomic_requests
 def stripe_webhook(request):
-    """Handle Stripe payment webhook"""
+    """Queue a verified Stripe event for process_webhooks"""
     try:
-        # Verify Stripe signature
-        payload = request.body
-        sig_header = request.headers.get('Stripe-Signature')
-        
-        try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-            )
-        except ValueError as e:
-            logger.error("Invalid payload")
-            return HttpResponse(status=400)
-        except stripe.error.SignatureVerificationError as e:
-            logger.error("Invalid signature")
-            return HttpResponse(status=400)
-            
-        # Handle the event
-        if event.type == 'payment_intent.succeeded':
-            payment_intent = event.data.object
-            reference = payment_intent.metadata.get('reference')
-            
-            # Get transaction
-            transaction = get_object_or_404(PaymentTransaction, reference=reference)
-            transaction.status = 'completed'
-            transaction.save()
-            
-            # Create or update order
-            create_or_update_order(transaction)
-            
-        elif event.type == 'payment_intent.payment_failed':
-            payment_intent = event.data.object
-            reference = payment_intent.metadata.get('reference')
-            
-            # Update transaction status
-            transaction = get_object_or_404(PaymentTransaction, reference=reference)
-            transaction.status = 'failed'
-            transaction.save()
-            
-        return HttpResponse(status=200)
-        
-    except Exception as e:
-        logger.error(f"Stripe webhook error: {str(e)}")
-        return HttpResponse(status=500)
-
-def create_or_update_order(transaction):
-    """Create or update order after successful payment"""
-    try:
-        # Get cart
-        cart = Cart.objects.get(user=transaction.customer_email)
-        
-        # Create order
-        order = Order.objects.create(
-            user=cart.user,
-            full_name=cart.user.get_full_name(),
-            email=transaction.customer_email,
-            phone=transaction.customer_phone,
-            amount=transaction.amount,
-            status='processing',
-            tracking_number=f"TRK-{get_random_string(12).upper()}"
-        )
-        
-        # Create initial tracking update
-        TrackingUpdate.objects.create(
-            order=order,
-            status='processing',
-            location='Processing Center',
-            description='Order received and being processed'
+        event = stripe.Webhook.construct_event(
+            request.body, request.headers.get('Stripe-Signature'), settings.STRIPE_WEBHOOK_SECRET
         )
-        
-        # Clear cart
-        cart.delete()
-        
-        return order
-        
-    except Exception as e:
-        logger.error(f"Error creating order: {str(e)}")
-        raise
+    except ValueError:
+        logger.error("Invalid payload")
+        return HttpResponse(status=400)
+    except stripe.error.SignatureVerificationError:
+        logger.error("Invalid signature")
+        return HttpResponse(status=400)
+    webhooks.receive('stripe', event.id, request.body)
+    return HttpResponse(status=200)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def mpesa_health(request):
+    """M-Pesa circuit breaker state and token counters, for monitoring"""
+    state = mpesa_breaker.state()
+    return Response({
+        'breaker': state,
+        'token': mpesa_token.stats(),
+    }, status=503 if state['state'] == 'open' else 200)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -546,71 +745,173 @@ def check_payment_status(request, reference: str):
             return JsonResponse({
                 'error': 'Transaction not found'
             }, status=404)
-            
-        # Check if transaction belongs to user
-        if transaction.customer_email != request.user.email:
+
+        mpesa_payment = None
+        if transaction.payment_method == 'mpesa':
+            mpesa_payment = MpesaPayment.objects.filter(reference=reference).first()
+        tracking_number = paid_order_tracking_number(transaction).first()
+        return payment_status_response(request, transaction, mpesa_payment, tracking_number)
+
+    except Exception as e:
+        logger.error(f"Payment status check error: {str(e)}")
+        return JsonResponse({
+            'error': str(e)
+        }, status=500)
+
+@require_http_methods(["GET"])
+@async_api_view
+async def check_payment_status_async(request, reference: str):
+    """check_payment_status for ASGI workers"""
+    try:
+        transaction = await PaymentTransaction.objects.filter(reference=reference).afirst()
+        if transaction is None:
             return JsonResponse({
-                'error': 'Unauthorized'
-            }, status=403)
-        
-        response = {
-            'status': transaction.status,
-            'payment_method': transaction.payment_method,
-            'amount': str(transaction.amount),
-            'transaction_date': transaction.transaction_date.isoformat() if transaction.transaction_date else None
-        }
-        
+                'error': 'Transaction not found'
+            }, status=404)
+
+        mpesa_payment = None
         if transaction.payment_method == 'mpesa':
-            try:
-                mpesa_payment = MpesaPayment.objects.get(reference=reference)
-                response.update({
-                    'mpesa_receipt': mpesa_payment.transaction_id,
-                    'result_description': mpesa_payment.result_description
-                })
-            except MpesaPayment.DoesNotExist:
-                pass
-                
-        return JsonResponse(response)
-        
+            mpesa_payment = await MpesaPayment.objects.filter(reference=reference).afirst()
+        tracking_number = await paid_order_tracking_number(transaction).afirst()
+        return payment_status_response(request, transaction, mpesa_payment, tracking_number)
+
     except Exception as e:
         logger.error(f"Payment status check error: {str(e)}")
         return JsonResponse({
             'error': str(e)
         }, status=500)
 
+def payment_status_response(request, transaction, mpesa_payment=None, tracking_number=None):
+    # Check if transaction belongs to user
+    if transaction.customer_email != request.user.email:
+        return JsonResponse({
+            'error': 'Unauthorized'
+        }, status=403)
+    return JsonResponse(payment_status_data(transaction, mpesa_payment, tracking_number))
+
+def paid_order_tracking_number(transaction):
+    """Query for the tracking number of the order a completed transaction paid for"""
+    if transaction.status != 'completed':
+        return Order.objects.none().values_list('tracking_number', flat=True)
+    return Order.objects.filter(payment_id=transaction.pk).values_list('tracking_number', flat=True)
+
+def payment_status_data(transaction, mpesa_payment=None, tracking_number=None):
+    response = {
+        'status': transaction.status,
+        'payment_method': transaction.payment_method,
+        'amount': str(transaction.amount),
+        'transaction_date': transaction.transaction_date.isoformat() if transaction.transaction_date else None
+    }
+    if mpesa_payment is not None:
+        response.update({
+            'mpesa_receipt': mpesa_payment.transaction_id,
+            'result_description': mpesa_payment.result_description
+        })
+    if transaction.payment_method == 'paypal' and transaction.status == 'processing':
+        # Set when the PayPal call outlived the initiation request
+        response['approval_url'] = cache.get(PAYPAL_APPROVAL_URL_KEY.format(transaction.reference))
+    if tracking_number:
+        # The order placed when the payment completed
+        response['order_url'] = reverse('main:track_order_detail', args=[tracking_number])
+    return response
+
+@require_http_methods(["GET"])
+@async_api_view
+async def payment_status_events(request, reference: str):
+    """Server-sent events with the payment's status, now and whenever it changes
+
+    Replaces polling check_payment_status: the stream waits on
+    payment_events, sends a `status` event per change and ends once the
+    payment is completed or failed. Serve it from the ASGI entry point; a
+    sync worker would be held for the whole stream.
+    """
+    # Read before the transaction, so a change in between is not missed
+    version = await payment_events.aversion(reference)
+    transaction = await PaymentTransaction.objects.filter(reference=reference).afirst()
+    if transaction is None:
+        return JsonResponse({
+            'error': 'Transaction not found'
+        }, status=404)
+    if transaction.customer_email != request.user.email:
+        return JsonResponse({
+            'error': 'Unauthorized'
+        }, status=403)
+
+    response = StreamingHttpResponse(
+        payment_status_stream(transaction, version), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
+
+async def payment_status_stream(transaction, version):
+    reference = transaction.reference
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.PAYMENT_EVENTS_MAX_DURATION
+    sent = None
+    yield f"retry: {settings.PAYMENT_EVENTS_RETRY_MS}\n\n"
+    while True:
+        mpesa_payment = None
+        if transaction.payment_method == 'mpesa':
+            mpesa_payment = await MpesaPayment.objects.filter(reference=reference).afirst()
+        tracking_number = await paid_order_tracking_number(transaction).afirst()
+        data = payment_status_data(transaction, mpesa_payment, tracking_number)
+        if data != sent:
+            yield f"event: status\ndata: {json.dumps(data)}\n\n"
+            sent = data
+        if transaction.status in ('completed', 'failed'):
+            return
+
+        # Wait for a change, sending a comment every heartbeat to keep proxies from timing out
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                # The browser reconnects after the retry delay
+                return
+            current = await payment_events.wait(
+                reference, version, min(settings.PAYMENT_EVENTS_HEARTBEAT, remaining)
+            )
+            if current != version:
+                version = current
+                break
+            yield ": keepalive\n\n"
+        transaction = await PaymentTransaction.objects.aget(pk=transaction.pk)
+
 @login_required
-def order_receipt(request, reference_number):
-    order = get_object_or_404(Order, reference_number=reference_number)
+def order_receipt(request, tracking_number):
+    order = get_object_or_404(Order, tracking_number=tracking_number)
     
     # Check if user has permission to view this receipt
     if order.user != request.user and not request.user.is_staff:
         return HttpResponse('Unauthorized', status=401)
 
-    # Generate QR code for tracking
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    tracking_url = request.build_absolute_uri(order.get_tracking_url())
-    qr.add_data(tracking_url)
-    qr.make(fit=True)
-    qr_image = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save QR code
-    qr_path = f'static/main/img/qr/qr_{order.reference_number}.png'
-    qr_image.save(qr_path)
-
-    # Generate barcode
-    code128 = barcode.get_barcode_class('code128')
-    barcode_path = f'static/main/img/barcode/barcode_{order.reference_number}'
-    code128(order.reference_number, writer=ImageWriter()).save(barcode_path)
-
+    # Rendered on first request and served from the cache by receipt_image
+    tracking_url = request.build_absolute_uri(reverse('main:track_order_detail', args=[order.tracking_number]))
     context = {
         'order': order,
-        'qr_code': f'qr/qr_{order.reference_number}.png',
-        'barcode': f'barcode/barcode_{order.reference_number}.png',
+        'items': order.items.select_related('product'),
+        'qr_code_url': receipt_images.image_url('qr', tracking_url),
+        'barcode_url': receipt_images.image_url('barcode', order.tracking_number),
         'current_time': timezone.now(),
     }
     
     return render(request, 'main/receipt.html', context)
 
+def receipt_image_etag(request, token):
+    image = receipt_images.load(token)
+    return receipt_images.digest(*image) if image else None
+
+@require_http_methods(["GET", "HEAD"])
+@condition(etag_func=receipt_image_etag)
+def receipt_image(request, token):
+    """A receipt QR code or barcode; the URL names its content, so it is cached for good"""
+    image = receipt_images.load(token)
+    if image is None:
+        raise Http404('Image not found')
+    response = HttpResponse(receipt_images.get(*image), content_type='image/png')
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @login_required
 def download_receipt_pdf(request, reference_number):
     order = get_object_or_404(Order, reference_number=reference_number)
@@ -650,7 +951,87 @@ def track_order(request, tracking_number):
     
     return render(request, 'main/track_order.html', context)
 
+def make_etag(*parts) -> str:
+    return hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+def has_pending_messages(request) -> bool:
+    # A 304 would leave queued flash messages undelivered
+    return len(messages.get_messages(request)) > 0
+
+def product_list_etag(request):
+    """ETag for product_list from one aggregate over the listed products"""
+    if has_pending_messages(request):
+        return None
+    products = Product.objects.filter(available=True)
+    category_slug = request.GET.get('category')
+    if category_slug:
+        products = products.filter(category__slug=category_slug)
+    stats = products.aggregate(
+        updated=Max('updated_at'),
+        category_updated=Max('category__updated_at'),
+        count=Count('id'),
+    )
+    # The category menu lists every category, so follow its cache version too
+    categories = catalog_cache.get_versions(['categories'])['categories']
+    return make_etag(
+        stats['updated'], stats['category_updated'], stats['count'], categories,
+        request.get_full_path(), request.user.pk
+    )
+
+def product_detail_validators(request, slug):
+    """Return (etag, last_modified) for product_detail from one aggregate query"""
+    if has_pending_messages(request):
+        return None, None
+    stats = Product.objects.filter(slug=slug, available=True).aggregate(
+        updated=Max('updated_at'),
+        category_updated=Max('category__updated_at'),
+        category_id=Max('category_id'),
+        product_id=Max('id'),
+        # Reservations change availability without touching the product row
+        available=Max(reservations.available_expression()),
+    )
+    if stats['updated'] is None:
+        return None, None
+    # Related products are other rows; their changes show up in these versions
+    scopes = related_scopes(Product(pk=stats['product_id'], category_id=stats['category_id']))
+    versions = catalog_cache.get_versions(scopes)
+    etag = make_etag(
+        stats['updated'], stats['category_updated'], stats['available'], *[versions[scope] for scope in scopes],
+        request.get_full_path(), request.user.pk
+    )
+    return etag, max(stats['updated'], stats['category_updated'])
+
+def track_order_validators(request, tracking_number):
+    """Return (etag, last_modified) for track_order_detail from one aggregate query"""
+    if not request.user.is_authenticated or has_pending_messages(request):
+        return None, None
+    stats = Order.objects.filter(tracking_number=tracking_number, user=request.user).aggregate(
+        updated=Max('updated'),
+        tracked=Max('tracking_updates__timestamp'),
+        updates=Count('tracking_updates'),
+    )
+    if stats['updated'] is None:
+        return None, None
+    last_modified = max(filter(None, [stats['updated'], stats['tracked']]))
+    return make_etag(stats['updated'], stats['tracked'], stats['updates'], request.user.pk), last_modified
+
+def memoized_validators(func):
+    """Let condition() ask for the ETag and Last-Modified without querying twice"""
+    def validators(request, *args, **kwargs):
+        if not hasattr(request, '_validators'):
+            request._validators = func(request, *args, **kwargs)
+        return request._validators
+    return (
+        lambda request, *args, **kwargs: validators(request, *args, **kwargs)[0],
+        lambda request, *args, **kwargs: validators(request, *args, **kwargs)[1],
+    )
+
+product_detail_etag, product_detail_last_modified = memoized_validators(product_detail_validators)
+track_order_etag, track_order_last_modified = memoized_validators(track_order_validators)
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=track_order_etag, last_modified_func=track_order_last_modified)
 def track_order_detail(request, tracking_number):
     """View detailed tracking information for an order"""
     try:
@@ -678,49 +1059,153 @@ def track_order_detail(request, tracking_number):
         messages.error(request, 'An error occurred while retrieving tracking information.')
         return redirect('main:order_history')
 
+def product_to_dict(request, product) -> Dict[str, Any]:
+    """Serialize a product for the JSON listing"""
+    return {
+        'id': product.id,
+        'name': product.name,
+        'slug': product.slug,
+        'price': str(product.price),
+        'stock': product.stock,
+        'category': product.category.slug,
+        'image': product.image.url if product.image else None,
+        'url': request.build_absolute_uri(reverse('main:product_detail', args=[product.slug])),
+    }
+
+def page_links(request, page) -> Dict[str, Optional[str]]:
+    """Build next/previous URLs for a KeysetPage, keeping the other query params"""
+    links = {}
+    for name, cursor in (('next', page.next_cursor), ('previous', page.previous_cursor)):
+        if cursor:
+            params = request.GET.copy()
+            params['cursor'] = cursor
+            links[name] = f"{request.path}?{params.urlencode()}"
+        else:
+            links[name] = None
+    return links
+
+def wants_json(request) -> bool:
+    return request.GET.get('format') == 'json'
+
+def get_categories():
+    """Return all categories, cached until a category changes"""
+    return catalog_cache.get_or_build('categories', ['categories'], lambda: list(Category.objects.all()))
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=product_list_etag)
 def product_list(request):
     """Display list of products"""
     try:
         category_slug = request.GET.get('category')
         search_query = request.GET.get('q')
+        cursor = request.GET.get('cursor')
+        page_size = get_page_size(request)
         
-        products = Product.objects.filter(available=True)
-        categories = Category.objects.all()
+        products = Product.objects.filter(available=True).select_related('category')
+        categories = get_categories()
+        scopes = ['products']
         
         if category_slug:
-            category = get_object_or_404(Category, slug=category_slug)
+            category = next((c for c in categories if c.slug == category_slug), None)
+            if category is None:
+                raise Http404('No Category matches the given query.')
             products = products.filter(category=category)
-            
-        if search_query:
-            products = products.filter(
-                Q(name__icontains=search_query) |
-                Q(description__icontains=search_query)
-            )
+            scopes = [f'category:{category.id}']
+
+        def build_page():
+            if search_query:
+                # Ranked hits are bounded, so page through them by position
+                page = paginate_list(search_product_ids(products, search_query), cursor, page_size)
+                page.object_list = products_in_order(products, page.object_list)
+                return page
+            return paginate_queryset(products, PRODUCT_LIST_ORDERING, cursor, page_size)
+
+        listing = (category_slug, search_query, cursor, page_size)
+        page = catalog_cache.get_or_build('product_page', scopes, build_page, *listing)
+
+        if wants_json(request):
+            return JsonResponse({
+                'results': [product_to_dict(request, product) for product in page],
+                **page_links(request, page),
+            })
+
+        product_grid = catalog_cache.get_or_build(
+            'product_grid', scopes,
+            lambda: render_to_string('main/product_grid.html', {'products': page}),
+            *listing
+        )
             
         context = {
-            'products': products,
+            'products': page,
+            'product_grid': product_grid,
+            'page_links': page_links(request, page),
             'categories': categories,
             'current_category': category_slug,
             'search_query': search_query
         }
         return render(request, 'main/product_list.html', context)
         
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
     except Exception as e:
         logger.error(f"Error accessing product list: {str(e)}")
         messages.error(request, "Error loading products.")
         return redirect('main:index')
 
+def get_related_products(product, limit: int = 4):
+    """Products most often bought together with product, else others from its category"""
+    related = list(
+        Product.objects.filter(associated_with__product=product, available=True)
+        .select_related('category')
+        .order_by('-associated_with__score')[:limit]
+    )
+    if not related:
+        related = list(
+            Product.objects.filter(category_id=product.category_id, available=True)
+            .select_related('category')
+            .exclude(id=product.id)[:limit]
+        )
+    return related
+
+def related_scopes(product):
+    """Cache scopes of product's related products: its category, the associations and each related product"""
+    scopes = [f'category:{product.category_id}', 'related']
+    slugs = catalog_cache.get_or_build(
+        'related_slugs', scopes,
+        lambda: [related.slug for related in get_related_products(product)],
+        product.pk
+    )
+    # Stock sold from a related product bumps only that product's version
+    return scopes + [f'product:{slug}' for slug in slugs]
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=product_detail_etag, last_modified_func=product_detail_last_modified)
 def product_detail(request, slug):
     """Display product details"""
     try:
-        product = get_object_or_404(Product, slug=slug, available=True)
-        related_products = Product.objects.filter(
-            category=product.category
-        ).exclude(id=product.id)[:4]
+        product = catalog_cache.get_or_build(
+            'product', [f'product:{slug}', 'categories'],
+            lambda: get_object_or_404(Product.objects.select_related('category'), slug=slug, available=True),
+            slug
+        )
+        scopes = related_scopes(product)
+        related_products = catalog_cache.get_or_build(
+            'related_products', scopes,
+            lambda: get_related_products(product),
+            product.id
+        )
+        related_grid = catalog_cache.get_or_build(
+            'related_grid', scopes,
+            lambda: render_to_string('main/related_products.html', {'related_products': related_products}),
+            product.id
+        )
         
         context = {
             'product': product,
-            'related_products': related_products
+            'related_products': related_products,
+            'related_grid': related_grid,
+            # Live, not cached: stock less units held by other checkouts
+            'available_to_sell': reservations.available_to_sell([product.id]).get(product.id, 0)
         }
         return render(request, 'main/product_detail.html', context)
         
@@ -729,16 +1214,17 @@ def product_detail(request, slug):
         messages.error(request, "Error loading product details.")
         return redirect('main:product_list')
 
+def cart_items(cart):
+    return cart.items.select_related('product', 'product__category').order_by('created_at', 'id')
+
 @login_required
 def cart_summary(request):
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    return render(request, 'main/cart.html', {'cart': cart})
+    cart, created = Cart.objects.with_totals().get_or_create(user=request.user)
+    return render(request, 'main/cart.html', {'cart': cart, 'cart_items': cart_items(cart)})
 
-@login_required
 def add_to_cart(request, product_id):
     if request.method == 'POST':
-        product = get_object_or_404(Product, id=product_id, is_available=True)
-        cart, created = Cart.objects.get_or_create(user=request.user)
+        product = get_object_or_404(Product, id=product_id, available=True)
         quantity = int(request.POST.get('quantity', 1))
         
         if quantity <= 0:
@@ -751,19 +1237,25 @@ def add_to_cart(request, product_id):
                 'error': 'Not enough stock available'
             }, status=400)
         
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        
-        if not created:
-            cart_item.quantity += quantity
-            if cart_item.quantity > product.stock:
+        if not request.user.is_authenticated:
+            session_cart = SessionCart(request)
+            if session_cart.quantity(product.id) + quantity > product.stock:
                 return JsonResponse({
                     'error': 'Not enough stock available'
                 }, status=400)
-            cart_item.save()
+            session_cart.add(product.id, quantity)
+            return JsonResponse({
+                'message': 'Product added to cart',
+                'cart_total': session_cart.total_items
+            })
+        
+        # Locking the cart row serializes edits to the same cart
+        cart, created = Cart.objects.select_for_update().get_or_create(user=request.user)
+        
+        if not CartItem.objects.add_quantity(cart, product, quantity):
+            return JsonResponse({
+                'error': 'Not enough stock available'
+            }, status=400)
         
         return JsonResponse({
             'message': 'Product added to cart',
@@ -772,26 +1264,24 @@ def add_to_cart(request, product_id):
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
-@login_required
 def update_cart(request, item_id):
     if request.method == 'POST':
-        cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+        if not request.user.is_authenticated:
+            return update_session_cart(request, item_id)
+        cart = get_object_or_404(Cart.objects.select_for_update(), user=request.user)
+        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
         quantity = int(request.POST.get('quantity', 0))
         
         if quantity <= 0:
             cart_item.delete()
             message = 'Item removed from cart'
         else:
-            if quantity > cart_item.product.stock:
+            if not CartItem.objects.set_quantity(cart_item, quantity):
                 return JsonResponse({
                     'error': 'Not enough stock available'
                 }, status=400)
-            
-            cart_item.quantity = quantity
-            cart_item.save()
             message = 'Cart updated'
         
-        cart = cart_item.cart
         return JsonResponse({
             'message': message,
             'cart_total': cart.total_items,
@@ -800,11 +1290,45 @@ def update_cart(request, item_id):
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
-@login_required
+def update_session_cart(request, product_id):
+    """update_cart for anonymous visitors, whose items are addressed by product id"""
+    session_cart = SessionCart(request)
+    if not session_cart.quantity(product_id):
+        raise Http404("No such cart item")
+    quantity = int(request.POST.get('quantity', 0))
+    
+    if quantity <= 0:
+        session_cart.remove(product_id)
+        message = 'Item removed from cart'
+    else:
+        product = get_object_or_404(Product, id=product_id)
+        if quantity > product.stock:
+            return JsonResponse({
+                'error': 'Not enough stock available'
+            }, status=400)
+        session_cart.set(product_id, quantity)
+        message = 'Cart updated'
+    
+    return JsonResponse({
+        'message': message,
+        'cart_total': session_cart.total_items,
+        'cart_subtotal': float(session_cart.total_price)
+    })
+
 def remove_from_cart(request, item_id):
     if request.method == 'POST':
-        cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
-        cart = cart_item.cart
+        if not request.user.is_authenticated:
+            session_cart = SessionCart(request)
+            if not session_cart.quantity(item_id):
+                raise Http404("No such cart item")
+            session_cart.remove(item_id)
+            return JsonResponse({
+                'message': 'Item removed from cart',
+                'cart_total': session_cart.total_items,
+                'cart_subtotal': float(session_cart.total_price)
+            })
+        cart = get_object_or_404(Cart.objects.select_for_update(), user=request.user)
+        cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
         cart_item.delete()
         
         return JsonResponse({
@@ -815,59 +1339,165 @@ def remove_from_cart(request, item_id):
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
+CART_BATCH_MAX_OPERATIONS = 100
+
+def parse_cart_operations(data):
+    """Validate a cart batch payload into [(op, product_id, quantity)], raising ValueError"""
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non-empty list')
+    if len(operations) > CART_BATCH_MAX_OPERATIONS:
+        raise ValueError(f'At most {CART_BATCH_MAX_OPERATIONS} operations per request')
+    parsed = []
+    for index, operation in enumerate(operations):
+        try:
+            op = operation['op']
+            product_id = int(operation['product_id'])
+            quantity = int(operation.get('quantity', 1 if op == 'add' else 0))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Operation {index} must have op, product_id and an integer quantity')
+        if op not in ('add', 'set', 'remove'):
+            raise ValueError(f'Operation {index} has unknown op {op!r}')
+        if (op == 'add' and quantity <= 0) or quantity < 0:
+            raise ValueError(f'Operation {index} has an invalid quantity')
+        parsed.append((op, product_id, quantity))
+    return parsed
+
+def fold_cart_operations(current, operations) -> Dict[int, int]:
+    """Apply operations in order to {product_id: quantity}; returns the final quantity of each product touched"""
+    final = {}
+    for op, product_id, quantity in operations:
+        before = final.get(product_id, current.get(product_id, 0))
+        if op == 'add':
+            final[product_id] = before + quantity
+        elif op == 'set':
+            final[product_id] = quantity
+        else:
+            final[product_id] = 0
+    return final
+
+def check_cart_stock(final) -> list:
+    """Check every line being kept against stock in a single query"""
+    wanted = {product_id: quantity for product_id, quantity in final.items() if quantity > 0}
+    stock = dict(Product.objects.filter(pk__in=wanted, available=True).values_list('pk', 'stock'))
+    errors = []
+    for product_id, quantity in wanted.items():
+        if product_id not in stock:
+            errors.append({'product_id': product_id, 'error': 'Product not available'})
+        elif quantity > stock[product_id]:
+            errors.append({
+                'product_id': product_id,
+                'error': 'Not enough stock available',
+                'available': stock[product_id],
+            })
+    return errors
+
+def cart_state(request, items) -> Dict[str, Any]:
+    """Serialize cart lines and their totals"""
+    lines = [
+        dict(product_to_dict(request, item.product), quantity=item.quantity, line_total=str(item.total_price))
+        for item in items
+    ]
+    return {
+        'items': lines,
+        'total_items': sum(item.quantity for item in items),
+        'subtotal': str(sum((item.total_price for item in items), Decimal('0.00'))),
+    }
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def cart_batch(request):
+    """Apply a list of add/set/remove operations to the cart and return the resulting cart
+
+    The whole batch succeeds or fails together: if any line cannot be met from
+    stock nothing is changed and the offending products are listed.
+    """
+    try:
+        operations = parse_cart_operations(request.data)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    product_ids = {product_id for _, product_id, _ in operations}
+
+    if not request.user.is_authenticated:
+        session_cart = SessionCart(request)
+        final = fold_cart_operations({int(pk): quantity for pk, quantity in session_cart.lines.items()}, operations)
+        errors = check_cart_stock(final)
+        if errors:
+            return Response({'errors': errors}, status=status.HTTP_409_CONFLICT)
+        for product_id, quantity in final.items():
+            if quantity > 0:
+                session_cart.lines[str(product_id)] = quantity
+            else:
+                session_cart.lines.pop(str(product_id), None)
+        session_cart.save()
+        return Response(cart_state(request, session_cart.items()))
+
+    # Runs inside the request transaction (ATOMIC_REQUESTS); the row lock
+    # serializes this batch with other edits to the same cart
+    cart, created = Cart.objects.select_for_update().get_or_create(user=request.user)
+    current = dict(
+        CartItem.objects.filter(cart=cart, product_id__in=product_ids).values_list('product_id', 'quantity')
+    )
+    final = fold_cart_operations(current, operations)
+    errors = check_cart_stock(final)
+    if errors:
+        return Response({'errors': errors}, status=status.HTTP_409_CONFLICT)
+
+    CartItem.objects.bulk_create(
+        [CartItem(cart=cart, product_id=product_id, quantity=quantity)
+         for product_id, quantity in final.items() if quantity > 0],
+        update_conflicts=True,
+        unique_fields=['cart', 'product'],
+        update_fields=['quantity', 'updated_at'],
+    )
+    removed = [product_id for product_id, quantity in final.items() if quantity == 0 and product_id in current]
+    if removed:
+        CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+    if settings.CART_DENORMALIZED_TOTALS:
+        # bulk_create does not send the signals that maintain them
+        Cart.objects.filter(pk=cart.pk).refresh_totals()
+    return Response(cart_state(request, list(cart_items(cart))))
+
 @login_required
+@idempotent
 def checkout(request):
     cart = get_object_or_404(Cart, user=request.user)
     
-    if cart.items.count() == 0:
+    if not cart.items.exists():
         messages.error(request, 'Your cart is empty')
-        return redirect('cart_summary')
+        return redirect('main:cart_detail')
     
     if request.method == 'POST':
-        # Create the order
-        order = Order.objects.create(
-            user=request.user,
-            full_name=request.POST.get('full_name'),
-            email=request.POST.get('email'),
-            phone=request.POST.get('phone'),
-            address=request.POST.get('address'),
-            city=request.POST.get('city'),
-            state=request.POST.get('state'),
-            postal_code=request.POST.get('postal_code'),
-            country=request.POST.get('country'),
-            payment_method=request.POST.get('payment_method'),
-            shipping_cost=Decimal('10.00'),  # You can make this dynamic
-            total_amount=cart.total_price + Decimal('10.00')
-        )
+        contact, address = shipping_details(request.POST)
+        if not all(contact.values()) or not address:
+            messages.error(request, 'Please fill in all required fields')
+            return redirect('main:checkout')
         
-        # Create order items
-        for cart_item in cart.items.all():
-            if cart_item.quantity > cart_item.product.stock:
-                order.delete()
-                messages.error(request, f'Sorry, {cart_item.product.name} is out of stock')
-                return redirect('cart_summary')
-            
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price=cart_item.product.price
-            )
-            
-            # Update product stock
-            product = cart_item.product
-            product.stock -= cart_item.quantity
-            product.save()
-        
-        # Clear the cart
-        cart.items.all().delete()
+        # Convert the stock held since checkout started into the order
+        try:
+            order = orders.place_order(cart, address=address, **contact)
+        except orders.EmptyCart:
+            messages.error(request, 'Your cart is empty')
+            return redirect('main:cart_detail')
+        except reservations.InsufficientStock:
+            messages.error(request, 'Sorry, some items in your cart are no longer in stock')
+            return redirect('main:cart_detail')
         
         messages.success(request, 'Order placed successfully!')
-        return redirect('order_confirmation', order_number=order.order_number)
+        return redirect('main:track_order_detail', tracking_number=order.tracking_number)
+    
+    # Hold the cart's stock while the customer pays
+    try:
+        reservation_expires = reservations.reserve_cart(cart)
+    except reservations.InsufficientStock as e:
+        names = ', '.join(Product.objects.filter(pk__in=e.shortages).values_list('name', flat=True))
+        messages.error(request, f'Sorry, not enough stock is available for: {names}')
+        return redirect('main:cart_detail')
     
     context = {
         'cart': cart,
-        'shipping_cost': Decimal('10.00')  # You can make this dynamic
+        'shipping_cost': orders.SHIPPING_COST,
+        'reservation_expires': reservation_expires
     }
     return render(request, 'main/checkout.html', context)
 
@@ -887,8 +1517,29 @@ def order_confirmation(request, order_number):
 def order_history(request):
     """Display user's order history"""
     try:
-        orders = Order.objects.filter(user=request.user).order_by('-created')
-        return render(request, 'main/order_history.html', {'orders': orders})
+        user_orders = Order.objects.filter(user=request.user)
+        page = paginate_queryset(user_orders, ORDER_HISTORY_ORDERING, request.GET.get('cursor'), get_page_size(request))
+
+        if wants_json(request):
+            return JsonResponse({
+                'results': [{
+                    'tracking_number': order.tracking_number,
+                    'status': order.status,
+                    'amount': str(order.amount),
+                    'created': order.created.isoformat(),
+                    'url': request.build_absolute_uri(
+                        reverse('main:track_order_detail', args=[order.tracking_number])
+                    ),
+                } for order in page],
+                **page_links(request, page),
+            })
+
+        return render(request, 'main/order_history.html', {
+            'orders': page,
+            'page_links': page_links(request, page),
+        })
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
     except Exception as e:
         logger.error(f"Error accessing order history: {str(e)}")
         messages.error(request, "Error accessing order history.")
@@ -996,94 +1647,55 @@ def process_payment(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@non_atomic_requests
 def payment_callback(request):
-    """Handle payment gateway callbacks"""
+    """Queue a verified payment gateway callback for process_webhooks"""
+    if not verify_webhook_signature(request, settings.WEBHOOK_SECRET):
+        return HttpResponse(status=401)
     try:
-        # Verify callback signature
-        if not verify_webhook_signature(request, settings.WEBHOOK_SECRET):
-            return HttpResponse(status=401)
-
-        # Parse callback data
-        try:
-            data = json.loads(request.body)
-        except json.JSONDecodeError:
-            return HttpResponse(status=400)
-
-        # Get payment reference
-        reference = data.get('reference')
-        if not reference:
-            return HttpResponse(status=400)
-
-        # Get transaction
-        try:
-            transaction = PaymentTransaction.objects.get(reference=reference)
-        except PaymentTransaction.DoesNotExist:
-            return HttpResponse(status=404)
-
-        # Update transaction status
-        status = data.get('status', '').lower()
-        if status == 'success':
-            transaction.status = 'completed'
-            transaction.completed_at = timezone.now()
-            
-            # Create or update order
-            order = Order.objects.create(
-                user=transaction.user,
-                total_amount=transaction.amount,
-                payment_method=transaction.payment_method,
-                payment_reference=transaction.reference,
-                status='processing'
-            )
-            
-            # Clear user's cart
-            Cart.objects.filter(user=transaction.user).delete()
-            
-        elif status == 'failed':
-            transaction.status = 'failed'
-            transaction.failure_reason = data.get('reason', 'Payment failed')
-        
-        transaction.save()
-
-        return HttpResponse(status=200)
-
-    except Exception as e:
-        logger.error(f"Payment callback error: {str(e)}")
-        return HttpResponse(status=500)
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return HttpResponse(status=400)
+    if not data.get('reference'):
+        return HttpResponse(status=400)
+    webhooks.receive('gateway', str(data.get('event_id') or webhooks.payload_event_id(request.body)), request.body)
+    return HttpResponse(status=200)
 
-@login_required
 def cart_detail(request):
     """Display cart details"""
+    if not request.user.is_authenticated:
+        session_cart = SessionCart(request)
+        context = {
+            'cart': session_cart,
+            'cart_items': session_cart.items(),
+            'total': session_cart.total_price
+        }
+        return render(request, 'main/cart.html', context)
     try:
-        cart = Cart.objects.get(user=request.user)
-        cart_items = cart.items.all()
-        total = cart.get_total()
-        
+        cart = Cart.objects.with_totals().get(user=request.user)
         context = {
             'cart': cart,
-            'cart_items': cart_items,
-            'total': total
+            'cart_items': cart_items(cart),
+            'total': cart.total_price
         }
-        return render(request, 'main/cart_detail.html', context)
+        return render(request, 'main/cart.html', context)
     except Cart.DoesNotExist:
         cart = Cart.objects.create(user=request.user)
-        return render(request, 'main/cart_detail.html', {'cart': cart, 'cart_items': [], 'total': 0})
+        return render(request, 'main/cart.html', {'cart': cart, 'cart_items': [], 'total': 0})
 
-@login_required
 def cart_add(request, product_id):
     """Add a product to cart"""
     try:
         product = get_object_or_404(Product, id=product_id)
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': 1}
-        )
+        if not request.user.is_authenticated:
+            SessionCart(request).add(product.id)
+            messages.success(request, f"{product.name} added to cart.")
+            return redirect('main:cart_detail')
+        cart, created = Cart.objects.select_for_update().get_or_create(user=request.user)
         
-        if not created:
-            cart_item.quantity += 1
-            cart_item.save()
+        if not CartItem.objects.add_quantity(cart, product, 1):
+            messages.error(request, f"Sorry, there is not enough {product.name} in stock.")
+            return redirect('main:cart_detail')
             
         messages.success(request, f"{product.name} added to cart.")
         return redirect('main:cart_detail')
@@ -1093,11 +1705,15 @@ def cart_add(request, product_id):
         messages.error(request, "Error adding product to cart.")
         return redirect('main:product_list')
 
-@login_required
 def cart_remove(request, product_id):
     """Remove a product from cart"""
     try:
-        cart = Cart.objects.get(user=request.user)
+        if not request.user.is_authenticated:
+            product = get_object_or_404(Product, id=product_id)
+            SessionCart(request).remove(product.id)
+            messages.success(request, f"{product.name} removed from cart.")
+            return redirect('main:cart_detail')
+        cart = Cart.objects.select_for_update().get(user=request.user)
         product = get_object_or_404(Product, id=product_id)
         cart_item = get_object_or_404(CartItem, cart=cart, product=product)
         cart_item.delete()
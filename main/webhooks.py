@@ -0,0 +1,150 @@
+"""
+Payment webhook inbox
+
+Gateway callbacks are acknowledged as soon as they are verified: the views
+store the raw payload as a WebhookEvent with one INSERT ... ON CONFLICT DO
+NOTHING on (provider, event_id), which also drops redeliveries of an event
+we already have. Everything else (payment status, orders, tracking, carts)
+happens later in the process_webhooks worker, which drains pending events in
+batches and settles payments through payment_states. An event whose
+processing fails is retried with exponential backoff and marked failed after
+MAX_ATTEMPTS.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import payment_states
+from .models import MpesaPayment, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 10
+BACKOFF_BASE = 30
+BACKOFF_MAX = 60 * 60
+
+
+def receive(provider: str, event_id: str, payload: bytes):
+    """Store a verified callback unless it was already received"""
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(provider=provider, event_id=event_id, payload=payload.decode('utf-8'))],
+        ignore_conflicts=True,
+    )
+
+
+def payload_event_id(payload: bytes) -> str:
+    """Fallback ID for callbacks without one: identical redeliveries collapse"""
+    return hashlib.sha256(payload).hexdigest()
+
+
+def mpesa_callback_data(data: dict) -> dict:
+    """The stkCallback object, accepting both the Daraja envelope and a bare callback"""
+    return (data.get('Body') or {}).get('stkCallback') or data
+
+
+def mpesa_event_id(data: dict, payload: bytes) -> str:
+    # One final callback per STK push
+    return mpesa_callback_data(data).get('CheckoutRequestID') or payload_event_id(payload)
+
+
+def handle_mpesa(data):
+    callback = mpesa_callback_data(data)
+    # Raises DoesNotExist if the callback overtook the initiation's commit;
+    # the retry will find it
+    mpesa_payment = MpesaPayment.objects.get(checkout_request_id=callback['CheckoutRequestID'])
+    completed = str(callback.get('ResultCode')) == '0'
+    metadata = {
+        item.get('Name'): item.get('Value')
+        for item in (callback.get('CallbackMetadata') or {}).get('Item', [])
+    }
+    fields = {
+        'status': 'Completed' if completed else 'Failed',
+        'result_code': str(callback.get('ResultCode'))[:5],
+        'result_description': callback.get('ResultDesc', ''),
+        'updated_at': timezone.now(),
+    }
+    if metadata.get('MpesaReceiptNumber'):
+        fields['transaction_id'] = metadata['MpesaReceiptNumber']
+        fields['transaction_date'] = timezone.now()
+    # Only the first final report for a payment counts
+    if MpesaPayment.objects.filter(pk=mpesa_payment.pk, status='Pending').update(**fields):
+        payment_states.settle(mpesa_payment.reference, completed)
+
+
+def handle_paypal(data):
+    event_type = data.get('event_type')
+    reference = data.get('custom_id') or (data.get('resource') or {}).get('custom_id')
+    if event_type == 'PAYMENT.CAPTURE.COMPLETED':
+        payment_states.settle(reference, True)
+    elif event_type in ('PAYMENT.CAPTURE.DENIED', 'PAYMENT.CAPTURE.DECLINED'):
+        payment_states.settle(reference, False)
+
+
+def handle_stripe(data):
+    if data.get('type') not in ('payment_intent.succeeded', 'payment_intent.payment_failed'):
+        return
+    reference = data['data']['object'].get('metadata', {}).get('reference')
+    payment_states.settle(reference, data['type'] == 'payment_intent.succeeded')
+
+
+def handle_gateway(data):
+    status = data.get('status', '').lower()
+    if status in ('success', 'failed'):
+        payment_states.settle(data['reference'], status == 'success')
+
+
+HANDLERS = {
+    'mpesa': handle_mpesa,
+    'paypal': handle_paypal,
+    'stripe': handle_stripe,
+    'gateway': handle_gateway,
+}
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX))
+
+
+def process_batch(batch_size=100, now=None) -> dict:
+    """Apply up to batch_size due events; returns {'processed': n, 'retried': n, 'failed': n}
+
+    The batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED so several
+    workers can drain the inbox at once, and committed as one transaction
+    with a savepoint per event, so a failing event only rolls back its own
+    changes.
+    """
+    now = now or timezone.now()
+    counts = {'processed': 0, 'retried': 0, 'failed': 0}
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        for event in events:
+            event.attempts += 1
+            try:
+                with transaction.atomic():
+                    HANDLERS[event.provider](json.loads(event.payload))
+            except Exception as e:
+                event.last_error = f"{type(e).__name__}: {e}"
+                if event.attempts >= MAX_ATTEMPTS:
+                    event.status = 'failed'
+                    counts['failed'] += 1
+                    logger.error(f"Webhook {event} gave up after {event.attempts} attempts: {event.last_error}")
+                else:
+                    event.next_attempt_at = now + backoff(event.attempts)
+                    counts['retried'] += 1
+            else:
+                event.status = 'processed'
+                event.processed_at = now
+                event.last_error = ''
+                counts['processed'] += 1
+        WebhookEvent.objects.bulk_update(
+            events, ['status', 'attempts', 'next_attempt_at', 'last_error', 'processed_at']
+        )
+    return counts
@@ -1,4 +1,4 @@
-const CACHE_NAME = 'wave-logistics-v1';
+const CACHE_NAME = 'wave-logistics-v2';
 const STATIC_CACHE_URLS = [
     '/',
     '/static/css/main.css',
@@ -48,6 +48,26 @@ self.addEventListener('fetch', event => {
         return;
     }
     
+    // Pages: always revalidate with the server. The browser sends the stored
+    // ETag / Last-Modified, so an unchanged page costs a bodiless 304 and is
+    // served from the HTTP cache; the SW copy is only used when offline.
+    if (event.request.mode === 'navigate') {
+        event.respondWith(
+            fetch(event.request, { cache: 'no-cache' })
+                .then(response => {
+                    if (response && response.status === 200 && response.type === 'basic') {
+                        const responseToCache = response.clone();
+                        caches.open(CACHE_NAME)
+                            .then(cache => cache.put(event.request, responseToCache));
+                    }
+                    return response;
+                })
+                .catch(() => caches.match(event.request)
+                    .then(response => response || caches.match('/offline.html')))
+        );
+        return;
+    }
+
     event.respondWith(
         caches.match(event.request)
             .then(response => {
@@ -77,12 +97,6 @@ self.addEventListener('fetch', event => {
                             });
                         
                         return response;
-                    })
-                    .catch(() => {
-                        // Return offline page for navigation requests
-                        if (event.request.mode === 'navigate') {
-                            return caches.match('/offline.html');
-                        }
                     });
             })
     );
@@ -63,6 +63,7 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'idempotency-key',
     'origin',
     'user-agent',
     'x-csrftoken',
@@ -83,10 +84,34 @@ STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
+# Shared secrets for the X-Webhook-Signature HMAC on gateway callbacks
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+MPESA_WEBHOOK_SECRET = os.getenv('MPESA_WEBHOOK_SECRET')
+PAYPAL_WEBHOOK_SECRET = os.getenv('PAYPAL_WEBHOOK_SECRET')
+
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID')
 PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET')
 PAYPAL_MODE = os.getenv('PAYPAL_MODE', 'sandbox')
 
+# Override the Stripe and PayPal API hosts, e.g. for the fake_gateway command
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+PAYPAL_API_BASE = os.getenv('PAYPAL_API_BASE')
+
+# Stripe and PayPal SDK calls (main.gateways): seconds a request waits for
+# an answer, and calls in flight per gateway and process
+GATEWAY_DEADLINES = {
+    'stripe': float(os.getenv('STRIPE_CALL_DEADLINE', '8')),
+    'paypal': float(os.getenv('PAYPAL_CALL_DEADLINE', '8')),
+}
+GATEWAY_MAX_CONCURRENCY = {
+    'stripe': int(os.getenv('STRIPE_MAX_CONCURRENCY', '10')),
+    'paypal': int(os.getenv('PAYPAL_MAX_CONCURRENCY', '10')),
+}
+# Network timeouts inside the Stripe and PayPal SDKs, bounding how long a late
+# call holds its slot
+STRIPE_NETWORK_TIMEOUT = int(os.getenv('STRIPE_NETWORK_TIMEOUT', '30'))
+PAYPAL_NETWORK_TIMEOUT = int(os.getenv('PAYPAL_NETWORK_TIMEOUT', '30'))
+
 MPESA_ENVIRONMENT = os.getenv('MPESA_ENVIRONMENT', 'sandbox')
 MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY')
 MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
@@ -96,9 +121,46 @@ MPESA_SHORTCODE_TYPE = os.getenv('MPESA_SHORTCODE_TYPE', 'paybill')
 MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
 MPESA_INITIATOR_USERNAME = os.getenv('MPESA_INITIATOR_USERNAME')
 MPESA_INITIATOR_SECURITY_CREDENTIAL = os.getenv('MPESA_INITIATOR_SECURITY_CREDENTIAL')
+# Overrides the Daraja URL picked from MPESA_ENVIRONMENT, e.g. for the fake_gateway command
+MPESA_BASE_URL = os.getenv('MPESA_BASE_URL')
+MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', '300'))
+MPESA_CONNECT_TIMEOUT = float(os.getenv('MPESA_CONNECT_TIMEOUT', '3.05'))
+MPESA_READ_TIMEOUT = float(os.getenv('MPESA_READ_TIMEOUT', '10'))
+MPESA_MAX_RETRIES = int(os.getenv('MPESA_MAX_RETRIES', '2'))
+MPESA_POOL_SIZE = int(os.getenv('MPESA_POOL_SIZE', '10'))
+MPESA_ASYNC_MAX_CONNECTIONS = int(os.getenv('MPESA_ASYNC_MAX_CONNECTIONS', '200'))
+MPESA_BREAKER_THRESHOLD = int(os.getenv('MPESA_BREAKER_THRESHOLD', '5'))
+MPESA_BREAKER_RESET = int(os.getenv('MPESA_BREAKER_RESET', '30'))
 
 ALLOWED_PAYMENT_METHODS = ['mpesa', 'paypal', 'card']
 
+# Idempotency-Key support on payment initiation and checkout
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(60 * 60 * 24)))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '60'))
+
+# Server-sent payment status events
+PAYMENT_EVENTS_MAX_DURATION = int(os.getenv('PAYMENT_EVENTS_MAX_DURATION', '300'))
+PAYMENT_EVENTS_HEARTBEAT = int(os.getenv('PAYMENT_EVENTS_HEARTBEAT', '15'))
+PAYMENT_EVENTS_RETRY_MS = int(os.getenv('PAYMENT_EVENTS_RETRY_MS', '3000'))
+
+# Catalog Settings
+PRODUCT_SEARCH_LIMIT = int(os.getenv('PRODUCT_SEARCH_LIMIT', '500'))
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 960, 1280)
+IMAGE_DERIVATIVES_ON_SAVE = os.getenv('IMAGE_DERIVATIVES_ON_SAVE', 'True').lower() == 'true'
+
+# Cart Settings
+CART_DENORMALIZED_TOTALS = os.getenv('CART_DENORMALIZED_TOTALS', 'False').lower() == 'true'
+ANONYMOUS_CART_TIMEOUT = int(os.getenv('ANONYMOUS_CART_TIMEOUT', str(60 * 60 * 24)))
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', str(15 * 60)))
+# Seconds the holds renewed when a payment starts last, by payment method. An
+# M-Pesa payment can still be settled by reconcile_mpesa_payments for its
+# --max-age; PayPal approvals and card charges finish within the session.
+PAYMENT_RESERVATION_TTLS = {
+    'mpesa': int(os.getenv('MPESA_RESERVATION_TTL', str(24 * 60 * 60))),
+    'paypal': int(os.getenv('PAYPAL_RESERVATION_TTL', str(60 * 60))),
+    'card': int(os.getenv('CARD_RESERVATION_TTL', str(15 * 60))),
+}
+
 # Mobile App Settings
 MOBILE_APP_VERSIONS = {
     'ios': '1.0.0',
@@ -208,7 +270,12 @@ DATABASES = {
         'CONN_MAX_AGE': 600,
         'OPTIONS': {
             'timeout': 20,
-        }
+        },
+        # A file rather than shared-cache memory, so concurrency tests wait on
+        # locks like production does instead of failing with "table is locked"
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -252,6 +319,8 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
 STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]